@@ -7,17 +7,405 @@ from urllib.parse import urlparse
 import anthropic
 import sqlite3
 import json
+import re
+import hashlib
 import csv
 import signal
+import tempfile
+import queue
+import itertools
+import threading
+import random
+import asyncio
+import collections
+import sys
+import argparse
+import contextlib
+import hmac
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+
+# Limits shared by all worker processes of a multi-repository run (see init_worker).
+# They stay None when a single repository is processed.
+SCAN_SLOTS = None
+MODEL_SLOTS = None
+# Index of this worker process (0, 1, ...), e.g. to give each one its own webhook port
+WORKER_INDEX = None
+
+@contextlib.contextmanager
+def shared_slot(slot):
+    """Hold one slot of a cross-process semaphore, or do nothing if there is no limit."""
+    if slot is None:
+        yield
+        return
+    slot.acquire()
+    try:
+        yield
+    finally:
+        slot.release()
+
+@contextlib.asynccontextmanager
+async def shared_slot_async(slot):
+    """Like shared_slot, but waits for the slot in a thread so the event loop keeps running."""
+    if slot is None:
+        yield
+        return
+    await asyncio.to_thread(slot.acquire)
+    try:
+        yield
+    finally:
+        slot.release()
+
+class Metrics:
+    """
+    Instrumentation for one pipeline run: timed spans (with Metrics.span(...)) and
+    counters (Metrics.count(...)). Written out as an OpenMetrics text file, for
+    aggregating across runs, and as Chrome trace JSON (chrome://tracing or Perfetto)
+    to see where the wall time of a run went.
+    """
+    PREFIX = "cqe"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.events = []
+            self.spans = {}
+            self.counters = collections.Counter()
+
+    def track_id(self):
+        # Concurrent model calls share one thread, so each asyncio task gets its own track
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return id(task) if task is not None else threading.get_ident()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.events.append({
+                    "name": name, "ph": "X", "pid": os.getpid(), "tid": self.track_id(),
+                    "ts": round((start - self.started) * 1e6), "dur": round((end - start) * 1e6),
+                    "args": {key: str(value) for key, value in args.items()}
+                })
+                stats = self.spans.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+                stats["count"] += 1
+                stats["sum"] += end - start
+                stats["max"] = max(stats["max"], end - start)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def write_openmetrics(self, path, labels=None):
+        base_labels = [f'{key}="{self.escape_label(value)}"' for key, value in (labels or {}).items()]
+
+        def series(name, **extra):
+            pairs = base_labels + [f'{key}="{self.escape_label(value)}"' for key, value in extra.items()]
+            return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+        with self.lock:
+            spans = {name: dict(stats) for name, stats in self.spans.items()}
+            counters = dict(self.counters)
+        stage = f"{self.PREFIX}_stage_seconds"
+        stage_max = f"{self.PREFIX}_stage_max_seconds"
+        lines = [f"# TYPE {stage} summary", f"# UNIT {stage} seconds",
+                 f"# HELP {stage} Wall time spent in each pipeline stage."]
+        for name, stats in sorted(spans.items()):
+            lines.append(f"{series(stage + '_count', stage=name)} {stats['count']}")
+            lines.append(f"{series(stage + '_sum', stage=name)} {stats['sum']:.6f}")
+        lines += [f"# TYPE {stage_max} gauge", f"# UNIT {stage_max} seconds",
+                  f"# HELP {stage_max} Longest single span of each stage."]
+        for name, stats in sorted(spans.items()):
+            lines.append(f"{series(stage_max, stage=name)} {stats['max']:.6f}")
+        for name, value in sorted(counters.items()):
+            metric = f"{self.PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{series(metric + '_total')} {value}")
+        lines.append("# EOF")
+        self._write(path, "\n".join(lines) + "\n")
+
+    @staticmethod
+    def escape_label(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def write_chrome_trace(self, path):
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms",
+                     "otherData": {"counters": dict(self.counters)}}
+        self._write(path, json.dumps(trace))
+
+    def _write(self, path, text):
+        # Written to a temporary file first so a reader never sees a partial file
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".metrics-", suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+# Instrumentation of the current run; reset by run_pipeline
+METRICS = Metrics()
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available or
+    until a pause requested by the remote side (Retry-After, rate-limit reset) is over.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(float(rate), 0.01)
+
+class HttpTransport:
+    """
+    Shared HTTP layer for the GitHub and SonarCloud clients: one keep-alive
+    requests.Session with pooled connections, a token bucket per host that follows
+    the Retry-After and X-RateLimit-* headers, and retries with jittered backoff.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, pool_connections=4, pool_maxsize=16, rate=10, burst=20,
+                 max_retries=5, backoff=1.0, max_backoff=60, timeout=30):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        bucket = self.bucket(url)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.jittered_delay(attempt)
+                METRICS.count("http_retries")
+                print(f"[Retry] {method} {url} failed: {e}. Retrying in {delay:.1f} seconds...", flush=True)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            rate_limited = self.observe_rate_limit(bucket, response)
+            if (response.status_code in self.RETRY_STATUSES or rate_limited) and attempt < self.max_retries:
+                delay = self.retry_after(response)
+                if delay is None:
+                    delay = self.jittered_delay(attempt)
+                METRICS.count("http_retries")
+                print(f"[Retry] {method} {url} returned {response.status_code}. Retrying in {delay:.1f} seconds...", flush=True)
+                bucket.pause(delay)
+                attempt += 1
+                continue
+            return response
+
+    def jittered_delay(self, attempt):
+        # "Full jitter" exponential backoff keeps parallel clients from retrying in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt))) + 0.1
+
+    def retry_after(self, response):
+        value = response.headers.get("Retry-After")
+        if value is None:
+            reset = response.headers.get("X-RateLimit-Reset")
+            if response.headers.get("X-RateLimit-Remaining") == "0" and reset:
+                try:
+                    return max(float(reset) - time.time(), 0) + 1
+                except ValueError:
+                    return None
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                return None
+
+    def observe_rate_limit(self, bucket, response):
+        """
+        Adjust the host's bucket to the remaining quota. Returns True if the
+        response is a rate-limit rejection that should be retried.
+        """
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return response.status_code == 429
+        try:
+            remaining = int(remaining)
+            window = max(float(reset) - time.time(), 1)
+        except ValueError:
+            return response.status_code == 429
+        if remaining == 0:
+            bucket.pause(window)
+            return response.status_code in (403, 429)
+        # Spread the remaining quota over the rest of the window
+        bucket.set_rate(min(self.rate, remaining / window))
+        return response.status_code == 429
+
+class GitRepo:
+    """
+    Git operations on one local checkout. Every command runs with cwd set to the
+    checkout (the process working directory is never changed), and multi-path
+    operations are done in a single git call.
+    """
+    # Push errors that mean the remote has commits we don't have yet
+    REJECTED_MARKERS = ("non-fast-forward", "fetch first", "[rejected]")
+
+    def __init__(self, path):
+        self.path = path
+
+    def run(self, args, check=True):
+        # Output is captured so failures can be reported with git's own message
+        return subprocess.run(["git", *args], cwd=self.path, check=check, capture_output=True, text=True)
+
+    def tracked_paths(self, paths):
+        """
+        Return the subset of the given top-level paths that have tracked files, with one ls-files call.
+        """
+        paths = [path for path in paths if os.path.exists(os.path.join(self.path, path))]
+        if not paths:
+            return []
+        output = self.run(["ls-files", "-z", "--", *paths]).stdout
+        tracked = {entry.split("/", 1)[0] for entry in output.split("\0") if entry}
+        return [path for path in paths if path in tracked]
+
+    def untrack(self, paths):
+        """
+        Remove the given paths from the index (keeping the files), with one rm call.
+        Returns the paths that were tracked.
+        """
+        tracked = self.tracked_paths(paths)
+        if tracked:
+            self.run(["rm", "-r", "--cached", "--quiet", "--", *tracked])
+        return tracked
+
+    def stage_all(self):
+        self.run(["add", "-A"])
+
+    def has_staged_changes(self):
+        return self.run(["diff", "--cached", "--quiet"], check=False).returncode != 0
+
+    def commit(self, message):
+        self.run(["commit", "-m", message])
+
+    def current_branch(self):
+        return self.run(["rev-parse", "--abbrev-ref", "HEAD"]).stdout.strip()
+
+    def changed_files(self, since):
+        """
+        Return (changed, deleted) paths of tracked files that differ between commit `since`
+        and the working tree, including uncommitted changes, with one diff call.
+        """
+        entries = self.run(["diff", "--name-status", "--no-renames", "-z", since]).stdout.split("\0")
+        changed, deleted = [], []
+        for status, path in zip(entries[0::2], entries[1::2]):
+            (deleted if status == "D" else changed).append(path)
+        return changed, deleted
+
+    def push(self, branch, remote="origin"):
+        """
+        Push the branch. Only if the remote rejects it as non-fast-forward, rebase onto
+        the remote branch and push again.
+        """
+        result = self.run(["push", remote, branch], check=False)
+        if result.returncode == 0:
+            return
+        if not any(marker in result.stderr for marker in self.REJECTED_MARKERS):
+            raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+        print(f"Push rejected, {remote}/{branch} has new commits. Rebasing and pushing again.")
+        rebase = self.run(["pull", "--rebase", remote, branch], check=False)
+        if rebase.returncode != 0:
+            self.run(["rebase", "--abort"], check=False)
+            raise subprocess.CalledProcessError(rebase.returncode, rebase.args, rebase.stdout, rebase.stderr)
+        self.run(["push", remote, branch])
 
 class GitHubRepoManager:
-    def __init__(self, github_token, local_dir):
+    """
+    Forks, clones, commits and pushes GitHub repositories.
+    Clone options:
+        clone_depth  - shallow clone with this much history (e.g. 1)
+        clone_filter - partial clone filter (e.g. 'blob:none' fetches file contents on demand)
+        mirror_dir   - directory of bare mirrors kept across runs; checkouts become
+                       worktrees of the mirror, so a repeat run only fetches new objects
+    api_url points the client at a GitHub Enterprise server or a local stub.
+    """
+    def __init__(self, github_token, local_dir, transport=None, clone_depth=None, clone_filter=None, mirror_dir=None,
+                 api_url="https://api.github.com"):
         self.github_token = github_token
+        self.api_url = api_url.rstrip("/")
         self.headers = {
             "Authorization": f"token {self.github_token}",
             "Accept": "application/vnd.github.v3+json"
         }
+        self.transport = transport or HttpTransport()
         self.local_dir = local_dir
+        self.clone_depth = clone_depth
+        self.clone_filter = clone_filter
+        self.mirror_dir = mirror_dir
         os.makedirs(local_dir, exist_ok=True)
 
     def fork_repo(self, repo_url):
@@ -30,10 +418,10 @@ class GitHubRepoManager:
             raise ValueError("Invalid GitHub repository URL format.")
         
         owner, repo = path_parts
-        api_url = f"https://api.github.com/repos/{owner}/{repo}/forks"
+        api_url = f"{self.api_url}/repos/{owner}/{repo}/forks"
 
         print(f"Forking repo: {owner}/{repo}")
-        response = requests.post(api_url, headers=self.headers)
+        response = self.transport.post(api_url, headers=self.headers)
         if response.status_code == 202:
             print("Successfully forked the repository.")
             fork_data = response.json()
@@ -44,14 +432,24 @@ class GitHubRepoManager:
 
 
     def clone_repo(self, clone_url, force_delete=False, max_retries=5):
+        """
+        Clone the repo into local_dir. An existing checkout is kept as it is, unless
+        force_delete is set: then a checkout of the same remote is fetched and reset to
+        the remote branch (much cheaper than re-cloning), and anything else is deleted
+        and cloned again.
+        """
         repo_name = clone_url.split("/")[-1].replace(".git", "")
         dest_path = os.path.join(self.local_dir, repo_name)
 
         def do_clone():
+            if self.mirror_dir:
+                mirror_path = self.update_mirror(clone_url)
+                print(f"Checking out worktree of {mirror_path} into {dest_path}")
+                self.add_worktree(mirror_path, dest_path)
+                return
             print(f"Cloning repo into {dest_path}")
             # Capture output for error analysis
-            result = subprocess.run(["git", "clone", clone_url, dest_path], check=True, capture_output=True, text=True)
-            return result
+            self.run_git(["clone", *self.clone_options(), clone_url, dest_path])
 
         # Retry logic for transient errors (e.g., 503, GH100)
         attempt = 0
@@ -59,12 +457,17 @@ class GitHubRepoManager:
         while True:
             try:
                 if os.path.exists(dest_path):
-                    if force_delete:
+                    if not force_delete:
+                        print(f"Repository already exists at {dest_path}")
+                    elif self.is_checkout_of(dest_path, clone_url):
+                        print(f"Refreshing existing checkout at {dest_path}")
+                        if self.mirror_dir:
+                            self.update_mirror(clone_url)
+                        self.refresh_checkout(dest_path)
+                    else:
                         print(f"Deleting existing directory at {dest_path}")
                         shutil.rmtree(dest_path)
                         do_clone()
-                    else:
-                        print(f"Repository already exists at {dest_path}")
                 else:
                     do_clone()
                 break  # Success
@@ -98,6 +501,14 @@ class GitHubRepoManager:
                     print(f"git clone failed: {err_output}")
                     raise
 
+        self.ignore_build_outputs(dest_path)
+        return dest_path
+
+    def ignore_build_outputs(self, dest_path):
+        """
+        Add build output directories to .gitignore and remove them from git tracking, so
+        they are never committed. The changes are staged but not committed.
+        """
         # --- Begin: Clean up tracked build artifacts and update .gitignore ---
         build_artifacts = [
             ".scannerwork",
@@ -124,20 +535,95 @@ class GitHubRepoManager:
             with open(gitignore_path, "w") as f:
                 f.write("\n".join(gitignore_lines) + "\n")
             print("Updated .gitignore with build artifacts.")
-        # Remove build artifacts from git tracking if present
-        for artifact in build_artifacts:
-            artifact_path = os.path.join(dest_path, artifact)
-            if os.path.exists(artifact_path):
-                # Only try to untrack if it's tracked
-                result = subprocess.run(["git", "ls-files", "--error-unmatch", artifact], cwd=dest_path, capture_output=True)
-                if result.returncode == 0:
-                    subprocess.run(["git", "rm", "-r", "--cached", artifact], cwd=dest_path, check=False)
-                    print(f"Removed {artifact} from git tracking.")
+        # Remove build artifacts from git tracking if present (one ls-files and one rm for all of them)
+        git_repo = GitRepo(dest_path)
+        for artifact in git_repo.untrack(build_artifacts):
+            print(f"Removed {artifact} from git tracking.")
         # Stage .gitignore changes (but do not commit here)
-        subprocess.run(["git", "add", ".gitignore"], cwd=dest_path, check=False)
+        git_repo.run(["add", ".gitignore"], check=False)
         # --- End: Clean up tracked build artifacts and update .gitignore ---
 
-        return dest_path
+    def run_git(self, args, cwd=None):
+        # Output is captured so failures can be analysed (see clone_repo)
+        return GitRepo(cwd).run(args)
+
+    def clone_options(self):
+        options = []
+        if self.clone_depth:
+            options += ["--depth", str(self.clone_depth)]
+        if self.clone_filter:
+            options.append(f"--filter={self.clone_filter}")
+        return options
+
+    def fetch_options(self):
+        # A partial clone remembers its filter, only the depth has to be repeated
+        return ["--depth", str(self.clone_depth)] if self.clone_depth else []
+
+    def is_checkout_of(self, path, clone_url):
+        """
+        True if path is a git checkout whose origin is clone_url.
+        """
+        # A worktree has a .git file instead of a directory
+        if not os.path.exists(os.path.join(path, ".git")):
+            return False
+        result = subprocess.run(["git", "remote", "get-url", "origin"], cwd=path, capture_output=True, text=True)
+        if result.returncode != 0:
+            return False
+        normalize = lambda url: url.strip().rstrip("/").removesuffix(".git")
+        return normalize(result.stdout) == normalize(clone_url)
+
+    def mirror_path(self, clone_url):
+        name = urlparse(clone_url).path.strip("/").removesuffix(".git").replace("/", "__")
+        return os.path.join(self.mirror_dir, f"{name}.git")
+
+    def update_mirror(self, clone_url):
+        """
+        Create the bare mirror of clone_url on first use, then fetch new objects into it.
+        """
+        mirror_path = self.mirror_path(clone_url)
+        if not os.path.isdir(mirror_path):
+            print(f"Creating mirror cache at {mirror_path}")
+            os.makedirs(self.mirror_dir, exist_ok=True)
+            self.run_git(["clone", "--bare", *self.clone_options(), clone_url, mirror_path])
+            # Keep remote branches under refs/remotes/origin so worktrees can track them
+            self.run_git(["config", "remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*"], cwd=mirror_path)
+        print(f"Fetching into mirror cache {mirror_path}")
+        self.run_git(["fetch", "--prune", *self.fetch_options(), "origin"], cwd=mirror_path)
+        return mirror_path
+
+    def add_worktree(self, mirror_path, dest_path):
+        branch = self.run_git(["symbolic-ref", "--short", "HEAD"], cwd=mirror_path).stdout.strip()
+        # Forget worktrees whose directories were deleted, then check out a fresh one
+        self.run_git(["worktree", "prune"], cwd=mirror_path)
+        self.run_git(["worktree", "add", "--force", "-B", branch, os.path.abspath(dest_path), f"origin/{branch}"], cwd=mirror_path)
+
+    def refresh_checkout(self, repo_path):
+        """
+        Bring an existing checkout to the state of a fresh clone: fetch, hard reset to
+        the remote branch and remove untracked files. Ignored build outputs are kept,
+        so incremental builds can reuse them.
+        """
+        self.run_git(["fetch", "--prune", *self.fetch_options(), "origin"], cwd=repo_path)
+        branch = self.run_git(["rev-parse", "--abbrev-ref", "HEAD"], cwd=repo_path).stdout.strip()
+        self.run_git(["reset", "--hard", f"origin/{branch}"], cwd=repo_path)
+        self.run_git(["clean", "-fd"], cwd=repo_path)
+
+    def restore_checkout(self, repo_path, commit_sha):
+        """
+        Move a checkout back to commit_sha, dropping any uncommitted (and so unverified)
+        changes to tracked files. Untracked files such as build outputs are left alone,
+        and the .gitignore/untrack step of clone_repo is applied again.
+        """
+        self.run_git(["reset", "--quiet", commit_sha], cwd=repo_path)
+        self.run_git(["checkout", commit_sha, "--", "."], cwd=repo_path)
+        self.ignore_build_outputs(repo_path)
+
+    def head_commit(self, repo_path):
+        """
+        Return the SHA of HEAD in the local checkout, or None if it is not a git repository.
+        """
+        result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_path, capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
 
     def download_local_version(self, repo_path):
         # Lists the downloaded files
@@ -150,47 +636,31 @@ class GitHubRepoManager:
 
     def commit_and_push_changes(self, repo_path, commit_message="Apply automated changes"):
         print(f"Checking for changes in {repo_path}")
-        original_cwd = os.getcwd()
-        os.chdir(repo_path)
-
+        git_repo = GitRepo(repo_path)
         try:
             # Remove .scannerwork from git tracking if present
-            if os.path.isdir(os.path.join(repo_path, ".scannerwork")):
-                subprocess.run(["git", "rm", "-r", "--cached", ".scannerwork"], check=False)
+            git_repo.untrack([".scannerwork"])
 
             # Stage all changes (including deletions and additions)
-            subprocess.run(["git", "add", "-A"], check=True)
+            git_repo.stage_all()
 
             # Check if there is anything to commit
-            result = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True)
-            if result.stdout.strip() == "":
+            if not git_repo.has_staged_changes():
                 print("No changes to commit.")
                 return
 
-            # Commit
-            subprocess.run(["git", "commit", "-m", commit_message], check=True)
+            git_repo.commit(commit_message)
             print("Changes committed.")
 
-            # Get current branch name
-            branch_result = subprocess.run(["git", "rev-parse", "--abbrev-ref", "HEAD"], capture_output=True, text=True, check=True)
-            current_branch = branch_result.stdout.strip()
-            # Always pull before push to avoid non-fast-forward errors
-            try:
-                subprocess.run(["git", "pull", "origin", current_branch], check=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Warning: git pull failed: {e}")
-            # Only push to the current branch, never create new branches or set upstream
-            try:
-                subprocess.run(["git", "push", "origin", current_branch], check=True)
-                print(f"Pushed changes to origin/{current_branch}")
-                return
-            except subprocess.CalledProcessError as e:
-                print(f"git push failed: {e}")
-                raise
+            # Only push to the current branch, never create new branches or set upstream;
+            # pull (with rebase) only if the push is rejected as non-fast-forward
+            current_branch = git_repo.current_branch()
+            git_repo.push(current_branch)
+            print(f"Pushed changes to origin/{current_branch}")
+        except subprocess.CalledProcessError as e:
+            print(f"{' '.join(e.cmd)} failed: {(e.stderr or '').strip() or e}")
+            raise
 
-        finally:
-            os.chdir(original_cwd)
-            
 class SonarCloudAnalyzer:
     def create_project(self, project_key, name, organization=None, visibility="public"):
         """
@@ -201,7 +671,7 @@ class SonarCloudAnalyzer:
             organization (str, optional): SonarCloud organization key. Required for SonarCloud.
             visibility (str): 'public' or 'private'. Default is 'public'.
         """
-        url = "https://sonarcloud.io/api/projects/create"
+        url = f"{self.base_url}/api/projects/create"
         data = {
             "project": project_key,
             "name": name,
@@ -209,7 +679,7 @@ class SonarCloudAnalyzer:
         }
         if organization:
             data["organization"] = organization
-        response = requests.post(url, headers=self.headers, data=data)
+        response = self.transport.post(url, headers=self.headers, data=data)
         if response.status_code == 200:
             print(f"Project '{name}' created successfully in SonarCloud.")
             print(f"Project details: {response.json()}")
@@ -220,25 +690,577 @@ class SonarCloudAnalyzer:
         else:
             print(f"Failed to create project: {response.status_code} - {response.text}")
             raise Exception(f"SonarCloud project creation error: {response.status_code}")
-    def __init__(self, sonar_token):
+    def __init__(self, sonar_token, transport=None, base_url="https://sonarcloud.io"):
         self.sonar_token = sonar_token
-        self.url = "https://sonarcloud.io/api/issues/search"
+        # Point base_url at a SonarQube-compatible server (or a mock) to run offline
+        self.base_url = base_url.rstrip("/")
+        self.url = f"{self.base_url}/api/issues/search"
         self.headers = {"Authorization": f"Bearer {self.sonar_token}"}
+        self.transport = transport or HttpTransport()
+
+    # api/issues/search refuses to page past this many results for one query
+    MAX_RESULTS = 10000
+    # Facets that can be used to split a project into queries below MAX_RESULTS,
+    # mapped to the search parameter that filters on a single facet value
+    SLICE_FACETS = {"rules": "rules", "severities": "severities", "directories": "directories"}
+    # Without it the search also returns closed and resolved issues
+    OPEN_ONLY = {"resolved": "false"}
 
-    def analyze_repo(self, repo_name):
-        parameters = {"componentKeys": repo_name}
-        response = requests.get(self.url, headers=self.headers, params=parameters)
+    def _search_issues(self, params):
+        response = self.transport.get(self.url, headers=self.headers, params=params)
         if response.status_code == 200:
-            print(f"Successfully fetched issues for {repo_name}.")
-            print(f"Number of issues found: {len(response.json().get('issues', []))}")
             return response.json()
         else:
             print(f"Error fetching issues from SonarCloud: {response.status_code} - {response.text}")
             raise Exception(f"SonarCloud API error: {response.status_code}")
 
+    def analyze_repo(self, repo_name, page_size=100):
+        """
+        Fetch the first page of issues for a project. Use iter_issues to walk all of them.
+        """
+        data = self._search_issues({"componentKeys": repo_name, "ps": page_size, **self.OPEN_ONLY})
+        print(f"Successfully fetched issues for {repo_name}.")
+        print(f"Number of issues found: {len(data.get('issues', []))} of {self.issue_total(data)}")
+        return data
+
+    def count_issues(self, repo_name, filters=None):
+        """
+        Return the total number of issues matching the query without downloading them.
+        """
+        params = {"componentKeys": repo_name, "ps": 1, **self.OPEN_ONLY}
+        params.update(filters or {})
+        return self.issue_total(self._search_issues(params))
+
+    def iter_issue_pages(self, repo_name, page_size=500, filters=None):
+        """
+        Yield the issues of a project one page (list of issues) at a time.
+        Stops at the last page or at MAX_RESULTS, whichever comes first.
+        """
+        page = 1
+        fetched = 0
+        while True:
+            params = {"componentKeys": repo_name, "p": page, "ps": page_size, **self.OPEN_ONLY}
+            params.update(filters or {})
+            data = self._search_issues(params)
+            issues = data.get('issues', [])
+            fetched += len(issues)
+            total = self.issue_total(data)
+            if issues:
+                yield issues
+            if not issues or fetched >= min(total, self.MAX_RESULTS):
+                if total > self.MAX_RESULTS:
+                    print(f"[Warning] Query {filters or {}} matches {total} issues; only the first {self.MAX_RESULTS} can be fetched. Use slice_by to split it.", flush=True)
+                return
+            page += 1
+
+    def facet_slices(self, repo_name, slice_by, filters=None):
+        """
+        Split a project's issues into filters on single facet values (e.g. one per rule),
+        so each slice can be paged on its own below MAX_RESULTS.
+        """
+        if slice_by not in self.SLICE_FACETS:
+            raise ValueError(f"Unsupported slice facet: {slice_by}. Use one of {', '.join(self.SLICE_FACETS)}.")
+        params = {"componentKeys": repo_name, "ps": 1, "facets": slice_by, **self.OPEN_ONLY}
+        params.update(filters or {})
+        data = self._search_issues(params)
+        values = []
+        for facet in data.get('facets', []):
+            if facet.get('property') == slice_by:
+                values = [value for value in facet.get('values', []) if value.get('count', 0) > 0]
+        covered = sum(value['count'] for value in values)
+        total = self.issue_total(data)
+        if covered < total:
+            print(f"[Warning] Facet '{slice_by}' covers {covered} of {total} issues; some issues will not be fetched.", flush=True)
+        return [{**(filters or {}), self.SLICE_FACETS[slice_by]: value['val']} for value in values]
+
+    def iter_issues(self, repo_name, page_size=500, slice_by=None, prefetch=2, filters=None):
+        """
+        Yield every issue of a project, page by page, as the pages arrive.
+        Args:
+            repo_name (str): SonarCloud project key.
+            page_size (int): Issues per request (SonarCloud allows up to 500).
+            slice_by (str, optional): 'rules', 'severities' or 'directories' to split the
+                query into facet slices and get past the MAX_RESULTS cap.
+            prefetch (int): Number of pages to download ahead in a background thread,
+                so callers can start working on page 1 while later pages download.
+                Use 0 to fetch pages only when they are needed.
+            filters (dict, optional): Extra search parameters, e.g. {"branch": name}.
+        """
+        slices = self.facet_slices(repo_name, slice_by, filters) if slice_by else [filters]
+
+        def pages():
+            for filters in slices:
+                yield from self.iter_issue_pages(repo_name, page_size=page_size, filters=filters)
+
+        page_iter = prefetch_iter(pages(), prefetch) if prefetch else pages()
+        for issues in page_iter:
+            yield from issues
+
+    @staticmethod
+    def issue_total(data):
+        # Newer responses report the total under 'paging', older ones at the top level
+        return data.get('paging', {}).get('total', data.get('total', len(data.get('issues', []))))
+
+    TASK_DONE_STATUSES = ("SUCCESS", "FAILED", "CANCELED")
+
+    def wait_for_task(self, task_id, timeout=3600, min_interval=1.0, max_interval=10.0, webhook=None, webhook_timeout=600):
+        """
+        Wait for the Compute Engine task created by one scanner run (its ceTaskId), so the
+        state of an earlier analysis is never mistaken for this one. With a webhook
+        receiver the result is pushed to us; otherwise (or if no call arrives within
+        webhook_timeout) api/ce/task is polled, starting at min_interval and backing off
+        to max_interval. Returns 'SUCCESS', 'FAILED' or 'CANCELED', or None on timeout.
+        """
+        started = time.monotonic()
+        if webhook is not None:
+            status = webhook.wait(task_id, min(timeout, webhook_timeout))
+            if status:
+                print(f"[Done] Analysis task {task_id} finished with status {status} in {time.monotonic() - started:.1f}s (webhook).", flush=True)
+                return status
+            print(f"[Warning] No webhook call for analysis task {task_id} after {webhook_timeout}s; polling instead.", flush=True)
+        interval = min_interval
+        while time.monotonic() - started < timeout:
+            try:
+                response = self.transport.get(f"{self.base_url}/api/ce/task", headers=self.headers, params={"id": task_id})
+                if response.status_code == 200:
+                    task = response.json().get('task', {})
+                    status = task.get('status')
+                    if status in self.TASK_DONE_STATUSES:
+                        print(f"[Done] Analysis task {task_id} finished with status {status} in {time.monotonic() - started:.1f}s.", flush=True)
+                        if status != "SUCCESS" and task.get('errorMessage'):
+                            print(f"[Error] {task['errorMessage']}", flush=True)
+                        return status
+                else:
+                    print(f"[Error] Error checking analysis task {task_id}: {response.status_code} - {response.text}", flush=True)
+            except requests.RequestException as e:
+                print(f"[Error] Checking analysis task {task_id}: {e}", flush=True)
+            time.sleep(interval)
+            interval = min(max_interval, interval * 1.5)
+        print(f"[Error] Analysis task {task_id} did not finish within {timeout}s.", flush=True)
+        return None
+
+    def ensure_webhook(self, project_key, url, secret=None, organization=None, name="CQE"):
+        """
+        Register a project webhook pointing at url, unless one already exists. A webhook
+        of the same name that points elsewhere is updated instead of adding another.
+        """
+        params = {"project": project_key}
+        if organization:
+            params["organization"] = organization
+        response = self.transport.get(f"{self.base_url}/api/webhooks/list", headers=self.headers, params=params)
+        hooks = response.json().get('webhooks', []) if response.status_code == 200 else []
+        if any(hook.get('url') == url for hook in hooks):
+            return True
+        stale = next((hook for hook in hooks if hook.get('name') == name), None)
+        if stale is not None:
+            # Registered by an earlier run, e.g. from another worker's port: point it at this receiver
+            data, action = {"webhook": stale.get('key'), "name": name, "url": url}, "update"
+        else:
+            data, action = dict(params, name=name, url=url), "create"
+        if secret:
+            data["secret"] = secret
+        response = self.transport.post(f"{self.base_url}/api/webhooks/{action}", headers=self.headers, data=data)
+        if response.status_code == 200:
+            print(f"[Done] Registered analysis webhook {url} for {project_key}.", flush=True)
+            return True
+        print(f"[Warning] Could not register webhook: {response.status_code} - {response.text}", flush=True)
+        return False
+
+class AnalysisWebhook:
+    """
+    Local receiver for SonarCloud/SonarQube project webhooks. Each analysis POSTs its
+    taskId and status here as soon as it finishes, which replaces polling. If a secret
+    is set, calls must carry a valid X-Sonar-Webhook-HMAC-SHA256 signature.
+    The receiver must be reachable from the server (e.g. through a tunnel or a public host).
+    """
+    def __init__(self, port=0, secret=None, host="0.0.0.0"):
+        self.secret = secret
+        self.statuses = {}
+        self.condition = threading.Condition()
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if not webhook.verify(body, self.headers.get('X-Sonar-Webhook-HMAC-SHA256')):
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                try:
+                    webhook.deliver(json.loads(body))
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print(f"[Stage] Listening for analysis webhooks on port {self.port}", flush=True)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def verify(self, body, signature):
+        if not self.secret:
+            return True
+        expected = hmac.new(self.secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or "")
+
+    def deliver(self, payload):
+        task_id = payload.get('taskId')
+        if not task_id:
+            return
+        with self.condition:
+            self.statuses[task_id] = payload.get('status')
+            self.condition.notify_all()
+
+    def wait(self, task_id, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: task_id in self.statuses, timeout)
+            return self.statuses.get(task_id)
+
+class IssueView:
+    """
+    Local copy of a project's open issues, grouped by file component, for incremental
+    scans. It is loaded from a full analysis and then updated file by file with the
+    results of scoped analyses, which only report issues for the files they analyzed.
+    """
+    def __init__(self):
+        self.by_component = {}
+        self.loaded = False
+
+    def load(self, issues):
+        self.by_component = {}
+        for issue in issues:
+            self.by_component.setdefault(issue['component'], []).append(issue)
+        self.loaded = True
+
+    def merge(self, components, issues):
+        """
+        Replace the issues of the given file components with those found by a scoped
+        analysis of them. Components without issues in the new results are now clean.
+        """
+        updated = {component: [] for component in components}
+        for issue in issues:
+            if issue['component'] in updated:
+                updated[issue['component']].append(issue)
+        # Existing components keep their place, so the queue order stays stable
+        self.by_component.update(updated)
+
+    def total(self):
+        return sum(len(issues) for issues in self.by_component.values())
+
+    def iter_issues(self):
+        # Iterate over a snapshot: merges replace lists, so a scan mid-iteration is safe
+        for issues in list(self.by_component.values()):
+            yield from issues
+
+class SharedBackoff:
+    """
+    One backoff budget shared by every concurrent model call. When any call is
+    rate limited (429) or the API is overloaded (529), all callers pause together
+    instead of each retrying on its own schedule. The delay doubles once per burst of
+    throttled responses, not once per in-flight call that was caught in it.
+    """
+    def __init__(self, base_delay=5, max_delay=120, max_retries=20):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = base_delay
+        self.pause = 0
+        self.retries_left = max_retries
+        self.paused_until = 0.0
+
+    async def wait(self):
+        while True:
+            remaining = self.paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    def throttled(self):
+        """
+        Record a 429/529 and pause all callers. Returns False once the budget is spent.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            # Same burst: the calls sent before the pause began; extend it without escalating
+            self.paused_until = max(self.paused_until, now + self.pause)
+            return True
+        if self.retries_left <= 0:
+            return False
+        self.retries_left -= 1
+        self.pause = self.delay
+        self.paused_until = now + self.pause
+        self.delay = min(self.delay * 2, self.max_delay)
+        return True
+
+    def succeeded(self):
+        self.delay = self.base_delay
+
+class FixRequestFailed(Exception):
+    """
+    A model request that was given up on: a fatal error, or a retryable one that ran
+    out of attempts or time. Carries the cause and the number of attempts made.
+    """
+    def __init__(self, cause, attempts, error_type=None):
+        self.error_type = error_type or type(cause).__name__
+        super().__init__(f"{self.error_type} after {attempts} attempt(s): {cause}")
+        self.cause = cause
+        self.attempts = attempts
+
+class RetryPolicy:
+    """
+    Classifies failed model calls and decides whether to retry them.
+    Retryable: connection errors, timeouts, rate limits (429), overload (529) and
+    server errors. Everything else (bad request, input too large, ...) is fatal and
+    fails the request at once. Retries are capped by attempt count and total elapsed
+    time, with full-jitter exponential backoff (or the server's Retry-After).
+    """
+    RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+    def __init__(self, max_attempts=6, max_elapsed=600, base_delay=5, max_delay=120):
+        self.max_attempts = max_attempts
+        self.max_elapsed = max_elapsed
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    THROTTLE_STATUSES = {429, 529}
+
+    def is_retryable(self, error):
+        if isinstance(error, anthropic.APIConnectionError):
+            return True
+        if isinstance(error, anthropic.APIStatusError):
+            return error.status_code in self.RETRYABLE_STATUSES
+        return False
+
+    def is_outage(self, error):
+        """
+        Whether a failure points at the service being down (connection errors, timeouts,
+        server errors) rather than at throttling, which the backoff handles, or at the
+        request itself. Only these feed the CircuitBreaker.
+        """
+        if isinstance(error, anthropic.APIStatusError) and error.status_code in self.THROTTLE_STATUSES:
+            return False
+        return self.is_retryable(error)
+
+    def allows(self, attempt, started):
+        return attempt < self.max_attempts and time.monotonic() - started < self.max_elapsed
+
+    def next_delay(self, error, attempt, started):
+        """
+        Return how long to wait before the next attempt, or None to give up.
+        """
+        if not self.is_retryable(error) or not self.allows(attempt, started):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))) + 0.1
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        if time.monotonic() - started + delay > self.max_elapsed:
+            return None
+        return delay
+
+class CircuitBreaker:
+    """
+    Pauses every model call when the recent error rate spikes. Outcomes of the last
+    `window` calls are kept; once at least `min_calls` are known and the share of
+    failures reaches `failure_ratio`, the breaker opens for `cooldown` seconds and all
+    callers wait. After the cooldown the window starts empty again.
+    """
+    def __init__(self, window=20, min_calls=10, failure_ratio=0.5, cooldown=60):
+        self.outcomes = collections.deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.open_until = 0.0
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return self.open_until - time.monotonic()
+
+    def wait(self):
+        while self.remaining() > 0:
+            time.sleep(self.remaining())
+
+    async def async_wait(self):
+        while self.remaining() > 0:
+            await asyncio.sleep(self.remaining())
+
+    def record(self, success):
+        with self.lock:
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) < self.min_calls or failures / len(self.outcomes) < self.failure_ratio:
+                return
+            self.open_until = time.monotonic() + self.cooldown
+            self.trips += 1
+            METRICS.count("circuit_breaker_trips")
+            print(f"[Warning] {failures} of the last {len(self.outcomes)} model calls failed; pausing all model calls for {self.cooldown} seconds.", flush=True)
+            self.outcomes.clear()
+
+class PromptPlanner:
+    """
+    Sizes model requests before they are sent. Estimates tokens from the code shown to
+    the model, picks a model tier from the Sonar severity of the issues, and sets
+    max_tokens so the whole reply fits; a request that no tier can answer in full is
+    rejected instead of being silently truncated. Keeps token and cost totals per run.
+    Tiers are tried from cheapest to strongest; each has:
+        model, max_output_tokens, min_rank (lowest severity rank it is chosen for),
+        input_cost / output_cost (USD per million tokens)
+    Pass tiers to use other models, or set CQE_MODEL_TIERS to a JSON list of tiers
+    (see from_env).
+    """
+    CHARS_PER_TOKEN = 3  # Code is token-dense; errs on the side of larger estimates
+    MIN_OUTPUT_TOKENS = 1000
+    BATCH_PRICE_FACTOR = 0.5  # Message Batches are billed at half price
+    # Legacy severities and the software-quality impact severities of newer Sonar versions
+    SEVERITY_RANK = {"INFO": 0, "LOW": 1, "MINOR": 1, "MEDIUM": 2, "MAJOR": 2, "HIGH": 3, "CRITICAL": 3, "BLOCKER": 4}
+    # Both models can write far longer replies; max_output_tokens stays below the size the
+    # SDK refuses to request without streaming (about 21k tokens)
+    DEFAULT_TIERS = [
+        {"model": "claude-haiku-4-5-20251001", "max_output_tokens": 16000, "min_rank": 0, "input_cost": 1.0, "output_cost": 5.0},
+        {"model": "claude-sonnet-4-5-20250929", "max_output_tokens": 16000, "min_rank": 3, "input_cost": 3.0, "output_cost": 15.0},
+    ]
+    TIER_KEYS = ("model", "max_output_tokens", "min_rank", "input_cost", "output_cost")
+
+    def __init__(self, tiers=None, budget_usd=None):
+        self.tiers = [dict(tier) for tier in (tiers or self.DEFAULT_TIERS)]
+        for tier in self.tiers:
+            missing = [key for key in self.TIER_KEYS if key not in tier]
+            if missing:
+                raise ValueError(f"Model tier {tier} is missing {', '.join(missing)}.")
+        self.budget_usd = budget_usd
+        self.unavailable = set()
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, budget_usd=None, env_var="CQE_MODEL_TIERS"):
+        """
+        Build a planner from the JSON list of tiers in env_var, or the default tiers if it is
+        not set, e.g. CQE_MODEL_TIERS='[{"model": "claude-haiku-4-5", "max_output_tokens": 16000,
+        "min_rank": 0, "input_cost": 1.0, "output_cost": 5.0}]'.
+        """
+        value = os.getenv(env_var)
+        return cls(tiers=json.loads(value) if value else None, budget_usd=budget_usd)
+
+    def base_model(self):
+        return self.tiers[0]["model"]
+
+    def estimate_tokens(self, text):
+        return len(text) // self.CHARS_PER_TOKEN + 1
+
+    def needed_output(self, text):
+        # The reply repeats the code shown, plus headroom for the fix itself
+        return max(self.MIN_OUTPUT_TOKENS, int(self.estimate_tokens(text) * 1.3) + 256)
+
+    def issue_rank(self, issues):
+        rank = 0
+        for issue in issues:
+            rank = max(rank, self.SEVERITY_RANK.get(str(issue.get('severity', '')).upper(), 0))
+            for impact in issue.get('impacts') or []:
+                rank = max(rank, self.SEVERITY_RANK.get(str(impact.get('severity', '')).upper(), 0))
+        return rank
+
+    def choose(self, issues, text):
+        """
+        Return (model, max_tokens) for a request whose reply repeats text, or (None, needed)
+        if no available tier can return that many tokens.
+        """
+        needed = self.needed_output(text)
+        rank = self.issue_rank(issues)
+        tiers = [tier for tier in self.tiers if tier["model"] not in self.unavailable] or self.tiers[:1]
+        preferred = max((i for i, tier in enumerate(tiers) if tier["min_rank"] <= rank), default=0)
+        # Escalate to a stronger tier only when the preferred one cannot hold the reply
+        for tier in tiers[preferred:]:
+            if tier["max_output_tokens"] >= needed:
+                return tier["model"], needed
+        return None, needed
+
+    def tier_for(self, model):
+        return next((tier for tier in self.tiers if tier["model"] == model), self.tiers[0])
+
+    def mark_unavailable(self, model):
+        """
+        Stop choosing a model the API key cannot use. Returns the model to retry with,
+        or None if the base model itself is unavailable.
+        """
+        if model == self.base_model():
+            return None
+        self.unavailable.add(model)
+        print(f"[Warning] Model {model} is not available; falling back to {self.base_model()}.", flush=True)
+        return self.base_model()
+
+    def record(self, model, input_tokens, output_tokens, batch=False):
+        tier = self.tier_for(model)
+        cost = (input_tokens * tier["input_cost"] + output_tokens * tier["output_cost"]) / 1e6
+        if batch:
+            cost *= self.BATCH_PRICE_FACTOR
+        with self.lock:
+            entry = self.totals.setdefault(model, {"requests": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0})
+            entry["requests"] += 1
+            entry["input_tokens"] += input_tokens
+            entry["output_tokens"] += output_tokens
+            entry["cost"] += cost
+
+    def cost(self):
+        with self.lock:
+            return sum(entry["cost"] for entry in self.totals.values())
+
+    def within_budget(self):
+        return self.budget_usd is None or self.cost() < self.budget_usd
+
+    def summary(self):
+        with self.lock:
+            parts = [f"{model}: {entry['requests']} requests, {entry['input_tokens']} in / {entry['output_tokens']} out tokens"
+                     for model, entry in self.totals.items()]
+        return f"{'; '.join(parts) or 'no model calls'} (estimated cost ${self.cost():.4f})"
+
 class IssueProcessor:
-    def __init__(self, anthropic_api_key):
-        self.client = anthropic.Anthropic(api_key=anthropic_api_key)
+    MAX_TOKENS = 1000
+    THROTTLE_STATUSES = RetryPolicy.THROTTLE_STATUSES  # Handled by SharedBackoff, not the circuit breaker
+    # Files longer than this are fixed window by window instead of being regenerated whole
+    PATCH_THRESHOLD_LINES = 200
+    # Lines of context kept around each issue's text range in a window
+    WINDOW_MARGIN = 15
+    # Message Batches mode: longest wait between status polls, and when to give up on a batch
+    BATCH_POLL_INTERVAL = 60
+    BATCH_TIMEOUT = 24 * 3600
+
+    def __init__(self, anthropic_api_key, max_concurrency=4, cache=None, planner=None, base_url=None, retry_policy=None, breaker=None):
+        self.anthropic_api_key = anthropic_api_key
+        # base_url points the clients at another endpoint (e.g. a local stub); None uses
+        # ANTHROPIC_BASE_URL or the public API
+        self.base_url = base_url
+        # SDK-level retries are off; RetryPolicy decides what is retried
+        self.client = anthropic.Anthropic(api_key=anthropic_api_key, base_url=base_url, max_retries=0)
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self.planner = planner or PromptPlanner()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        # Requests given up on, per file (or other label) since they were last popped
+        self.failures = {}
+        # Token usage per file (or other label) since it was last popped
+        self.usage = {}
+        # Fix cache keys served or stored per file, until the fix's outcome is known
+        self.cache_keys = {}
 
     def extract_code_block(self, text):
         """
@@ -278,146 +1300,1881 @@ class IssueProcessor:
             return "\n".join(code_lines).strip("\n")
         return text.strip()
 
-    def process_issue(self, issue, file_path):
-        with open(file_path, "r") as input_file:
-            input_text = input_file.read()
-
+    def build_prompt(self, issue, input_text):
         prompt = (
             f"{issue['message']}. Here is an issue with some code. Write changes that can be made to the code to fix it. "
             "Please write the entire code file with all of its changes as a response. Do not add any reasoning or description, only the code. "
             "If there are any comments in the code, do not remove them. Do not explain why there is an issue, or state anything, just provide the fixed code."
         )
+        return [{"role": "user", "content": f"{prompt}\n\n{input_text}"}]
 
-        retries = 0
-        delay = 5
-        while True:
-            try:
-                response = self.client.messages.create(
-                    model="claude-3-haiku-20240307",  # Use Claude 3 Haiku model (widest availability)
-                    max_tokens=1000,
-                    messages=[
-                        {"role": "user", "content": f"{prompt}\n\n{input_text}"}
-                    ]
-                )
-                # The response content is a list of message blocks; join them if needed
-                if hasattr(response, 'content'):
-                    if isinstance(response.content, list):
-                        ai_output = "".join([block.text if hasattr(block, 'text') else str(block) for block in response.content])
-                    else:
-                        ai_output = str(response.content)
-                else:
-                    ai_output = str(response)
-                return self.extract_code_block(ai_output)
-            except anthropic.NotFoundError as e:
-                print("Model not found. Please check your Anthropic dashboard and API key permissions. Error details:")
-                print(e)
-                raise
-            except Exception as e:
-                print(f"Error: {e}. Retrying in {delay} seconds...")
-                time.sleep(delay)
-                retries += 1
-                delay = min(delay * 2, 120)  # Exponential backoff with max delay of 2 minutes
-                
-class DatabaseManager:
-    def export_issues_to_csv(self, csv_path="issues_export.csv"):
-
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute("SELECT * FROM issues")
-        rows = c.fetchall()
-        headers = [description[0] for description in c.description]
-        with open(csv_path, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(headers)
-            writer.writerows(rows)
-        conn.close()
-        print(f"Exported {len(rows)} issues to {csv_path}")
-    def __init__(self, db_path):
-        self.db_path = db_path
-        self.initialize_db()
+    def build_file_prompt(self, issues, input_text):
+        """
+        Build one prompt that asks for every issue of a file to be fixed in a single rewrite.
+        """
+        issue_lines = []
+        for number, issue in enumerate(issues, start=1):
+            text_range = issue.get('textRange') or {}
+            location = f"line {issue.get('line', text_range.get('startLine', '?'))}"
+            if text_range:
+                location += (f" (lines {text_range.get('startLine')}-{text_range.get('endLine')}, "
+                             f"columns {text_range.get('startOffset')}-{text_range.get('endOffset')})")
+            issue_lines.append(f"{number}. [{issue.get('rule', 'unknown rule')}] {location}: {issue['message']}")
+        prompt = (
+            "Here is a code file with the following issues:\n" + "\n".join(issue_lines) + "\n"
+            "Write changes that can be made to the code to fix all of them. "
+            "Please write the entire code file with all of its changes as a response. Do not add any reasoning or description, only the code. "
+            "If there are any comments in the code, do not remove them. Do not explain why there is an issue, or state anything, just provide the fixed code."
+        )
+        return [{"role": "user", "content": f"{prompt}\n\n{input_text}"}]
 
-    def initialize_db(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS issues (
-                id TEXT PRIMARY KEY,
-                rule TEXT,
-                severity TEXT,
-                component TEXT,
-                project TEXT,
-                hash TEXT,
-                message TEXT,
-                resolution TEXT,
-                status TEXT,
-                effort TEXT,
-                debt TEXT,
-                author TEXT,
-                creationDate TEXT,
-                updateDate TEXT,
-                closeDate TEXT,
-                type TEXT,
-                organization TEXT,
-                cleanCodeAttribute TEXT,
-                cleanCodeAttributeCategory TEXT,
-                tags TEXT,
-                impacts TEXT
-            )
-        """)
-        conn.commit()
-        conn.close()
+    def response_text(self, response):
+        # The response content is a list of message blocks; join them if needed
+        if hasattr(response, 'content'):
+            if isinstance(response.content, list):
+                return "".join([block.text if hasattr(block, 'text') else str(block) for block in response.content])
+            return str(response.content)
+        return str(response)
 
-    def issue_exists(self, issue_id):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM issues WHERE id = ?", (issue_id,))
-        exists = c.fetchone() is not None
-        conn.close()
-        return exists
+    def process_issue(self, issue, file_path, input_text=None):
+        """
+        Ask the model to fix one issue. Pass input_text to fix a version of the file
+        that has not been written to disk yet (e.g. to chain fixes for one file).
+        Returns None if the reply was cut off by the output token limit.
+        """
+        if input_text is None:
+            with open(file_path, "r") as input_file:
+                input_text = input_file.read()
 
-    def insert_issue(self, issue_data):
+        model, max_tokens = self.planner.choose([issue], input_text)
+        if model is None:
+            print(f"[Warning] {file_path} is too long to be rewritten in one reply ({max_tokens} tokens); skipping.", flush=True)
+            return None
+        with METRICS.span("process_issue", file=file_path):
+            return self.run_request({"messages": self.build_prompt(issue, input_text), "model": model, "max_tokens": max_tokens,
+                                     "window": None, "issues": [issue], "text": input_text}, file_path)
+
+    def process_file(self, file_path, issues, input_text=None):
+        """
+        Fix every issue of one file and return the rewritten file (None if no valid fix came back).
+        Short files are regenerated with a single model call. Files over PATCH_THRESHOLD_LINES
+        are fixed window by window: the model only sees the lines around each issue and
+        returns a replacement for those lines, which is validated and spliced in locally.
+        """
+        if input_text is None:
+            with open(file_path, "r") as input_file:
+                input_text = input_file.read()
+        with METRICS.span("process_file", file=file_path, issues=len(issues)):
+            plan = self.plan_fix(issues, input_text)
+            outputs = [self.run_request(request, file_path) for request in plan]
+            return self.apply_fix_outputs(input_text, plan, outputs, file_path)
+
+    def issue_lines(self, issue):
+        text_range = issue.get('textRange') or {}
+        start = text_range.get('startLine') or issue.get('line')
+        end = text_range.get('endLine') or start
+        return start, end
+
+    def fix_windows(self, issues, line_count):
+        """
+        Group issues into non-overlapping windows of (start_line, end_line, issues),
+        1-based and inclusive, ordered from the bottom of the file to the top.
+        Issues without a line (file-level issues) get a window at the top of the file.
+        """
+        spans = []
+        for issue in issues:
+            start, end = self.issue_lines(issue)
+            if start is None:
+                start, end = 1, 1
+            spans.append((max(1, start - self.WINDOW_MARGIN), min(line_count, end + self.WINDOW_MARGIN), issue))
+        spans.sort(key=lambda span: span[0])
+        windows = []
+        for start, end, issue in spans:
+            if windows and start <= windows[-1][1] + 1:
+                windows[-1] = (windows[-1][0], max(windows[-1][1], end), windows[-1][2] + [issue])
+            else:
+                windows.append((start, end, [issue]))
+        return list(reversed(windows))
+
+    def build_window_prompt(self, issues, lines, start, end):
+        issue_lines = []
+        for number, issue in enumerate(issues, start=1):
+            issue_start, issue_end = self.issue_lines(issue)
+            location = f"lines {issue_start}-{issue_end}" if issue_start else "file level"
+            issue_lines.append(f"{number}. [{issue.get('rule', 'unknown rule')}] {location}: {issue['message']}")
+        snippet = "\n".join(lines[start - 1:end])
+        prompt = (
+            f"Here are lines {start} to {end} of a larger code file, with the following issues:\n" + "\n".join(issue_lines) + "\n"
+            "Write changes to these lines that fix the issues. Respond with only the replacement for exactly these lines "
+            f"(from line {start} to line {end}) in a single code block. Do not include any other part of the file, "
+            "do not add line numbers, and do not remove comments. Do not add any reasoning or description, only the code."
+        )
+        return [{"role": "user", "content": f"{prompt}\n\n{snippet}"}]
+
+    def plan_fix(self, issues, input_text):
+        """
+        Return the model requests needed to fix a file. Each request is a dict with
+        'messages', 'model' and 'max_tokens' (chosen by the planner), 'window' ((start, end),
+        or None for a whole-file rewrite), 'issues' and 'text' (the code the model is
+        shown, used as the cache key). Short files are rewritten whole if the reply fits
+        in one response; otherwise the file is fixed window by window.
+        """
+        lines = input_text.splitlines()
+        if len(lines) <= self.PATCH_THRESHOLD_LINES:
+            model, max_tokens = self.planner.choose(issues, input_text)
+            if model is not None:
+                return [{"messages": self.build_file_prompt(issues, input_text), "model": model, "max_tokens": max_tokens,
+                         "window": None, "issues": issues, "text": input_text}]
+        plan = []
+        for start, end, window_issues in self.fix_windows(issues, len(lines)):
+            snippet = "\n".join(lines[start - 1:end])
+            model, max_tokens = self.planner.choose(window_issues, snippet)
+            if model is None:
+                print(f"[Warning] Lines {start}-{end} are too long to be rewritten in one reply ({max_tokens} tokens); skipping.", flush=True)
+                continue
+            plan.append({"messages": self.build_window_prompt(window_issues, lines, start, end), "model": model, "max_tokens": max_tokens,
+                         "window": (start, end), "issues": window_issues, "text": snippet})
+        return plan
+
+    def cached_fix(self, request, label=None):
+        """
+        Serve a planned request from the fix cache. Returns (found, output).
+        In replay mode a miss is answered with (True, None) so no model call is made.
+        """
+        if self.cache is None:
+            return False, None
+        cache_key = self.cache.make_key(request["issues"], request["text"], request["model"])
+        output = self.cache.get(cache_key)
+        if output is not None:
+            METRICS.count("fix_cache_hits")
+            self.cache_keys.setdefault(label, []).append(cache_key)
+            return True, output
+        METRICS.count("fix_cache_misses")
+        return self.cache.replay, None
+
+    def store_fix(self, request, output, label=None):
+        if self.cache is not None and output is not None:
+            cache_key = self.cache.make_key(request["issues"], request["text"], request["model"])
+            self.cache.put(cache_key, output, request["issues"], request["text"])
+            self.cache_keys.setdefault(label, []).append(cache_key)
+
+    def was_answered(self, label):
+        """
+        Whether any reply (from the model or the fix cache) came back for a file since its
+        usage and cache keys were last popped.
+        """
+        return label in self.usage or bool(self.cache_keys.get(label))
+
+    def settle_cached_fixes(self, label, outcome):
+        """
+        Record the outcome of a file's fix against the cache entries it was built from:
+        applied fixes become servable, reverted ones are dropped so they are not served again.
+        """
+        cache_keys = self.cache_keys.pop(label, [])
+        if self.cache is None or not cache_keys:
+            return
+        if outcome == "applied":
+            self.cache.mark_applied(cache_keys)
+        elif outcome in ("reverted", "reverted_local"):
+            self.cache.invalidate(cache_keys)
+
+    def run_request(self, request, label=None):
+        found, output = self.cached_fix(request, label)
+        if not found:
+            if not self.over_budget(label):
+                try:
+                    output = self._create_fix(request["messages"], request["max_tokens"], label, request["model"])
+                except FixRequestFailed as e:
+                    self.record_failure(label, request["issues"], e)
+                    return None
+                self.store_fix(request, output, label)
+        return output
+
+    def record_failure(self, label, issues, error):
+        print(f"[Error] Giving up on a fix for {label}: {error}", flush=True)
+        METRICS.count("model_failed_requests")
+        self.failures.setdefault(label, []).append({
+            "issues": list(issues), "error_type": error.error_type, "error": str(error.cause), "attempts": error.attempts
+        })
+
+    def pop_failures(self, label):
+        """
+        Return and reset the failed requests recorded for a file, as dicts with
+        'issues', 'error_type', 'error' and 'attempts'.
+        """
+        return self.failures.pop(label, [])
+
+    def over_budget(self, label):
+        if self.planner.within_budget():
+            return False
+        print(f"[Warning] Model spend budget of ${self.planner.budget_usd:.2f} reached; not fixing {label}.", flush=True)
+        return True
+
+    def apply_fix_outputs(self, input_text, plan, outputs, label="file"):
+        """
+        Apply the model outputs of a plan to input_text. Window replacements that fail
+        validation are skipped; returns None if nothing could be applied.
+        """
+        if not plan:
+            return None
+        if len(plan) == 1 and plan[0]["window"] is None:
+            return outputs[0]
+        lines = input_text.splitlines()
+        applied = 0
+        # Windows are ordered bottom-up, so splicing one never shifts the lines of the next
+        for request, output in zip(plan, outputs):
+            if output is None:
+                continue
+            start, end = request["window"]
+            original = lines[start - 1:end]
+            replacement = output.splitlines()
+            problem = self.validate_replacement(original, replacement)
+            if problem:
+                print(f"[Warning] Rejected fix for lines {start}-{end} of {label}: {problem}", flush=True)
+                continue
+            lines[start - 1:end] = replacement
+            applied += 1
+        if not applied:
+            return None
+        return "\n".join(lines) + ("\n" if input_text.endswith("\n") else "")
+
+    def validate_replacement(self, original, replacement):
+        """
+        Cheap sanity checks on a window replacement. Returns a reason string, or None if it looks valid.
+        """
+        if not any(line.strip() for line in replacement):
+            return "empty replacement"
+        if len(replacement) > 2 * len(original) + 20:
+            return f"replacement has {len(replacement)} lines for a {len(original)}-line window"
+        original_text = "\n".join(original)
+        replacement_text = "\n".join(replacement)
+        for opening, closing in (("{", "}"), ("(", ")")):
+            if (original_text.count(opening) - original_text.count(closing)
+                    != replacement_text.count(opening) - replacement_text.count(closing)):
+                return f"unbalanced '{opening}{closing}' compared to the original lines"
+        return None
+
+    def record_usage(self, label, response, model=None, batch=False):
+        usage = getattr(response, 'usage', None)
+        input_tokens = getattr(usage, 'input_tokens', 0) or 0
+        output_tokens = getattr(usage, 'output_tokens', 0) or 0
+        entry = self.usage.setdefault(label, {"model": model or self.planner.base_model(), "input_tokens": 0, "output_tokens": 0})
+        entry["input_tokens"] += input_tokens
+        entry["output_tokens"] += output_tokens
+        self.planner.record(model or self.planner.base_model(), input_tokens, output_tokens, batch=batch)
+        METRICS.count("model_requests")
+        METRICS.count("model_input_tokens", input_tokens)
+        METRICS.count("model_output_tokens", output_tokens)
+
+    def pop_usage(self, label):
+        """
+        Return and reset the model and token totals recorded for a file.
+        """
+        return self.usage.pop(label, {"model": self.planner.base_model(), "input_tokens": 0, "output_tokens": 0})
+
+    def _create_fix(self, messages, max_tokens=None, label=None, model=None):
+        """
+        Call the model with the retry policy and circuit breaker. Raises FixRequestFailed
+        when the request is given up on.
+        """
+        model = model or self.planner.base_model()
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            self.breaker.wait()
+            attempt += 1
+            try:
+                with shared_slot(MODEL_SLOTS), METRICS.span("model_call", model=model, file=label, attempt=attempt):
+                    response = self.client.messages.create(
+                        model=model,
+                        max_tokens=max_tokens or self.MAX_TOKENS,
+                        messages=messages
+                    )
+                self.breaker.record(True)
+                self.record_usage(label, response, model)
+                return self.fix_from_response(response)
+            except anthropic.NotFoundError as e:
+                fallback = self.planner.mark_unavailable(model)
+                if fallback is None:
+                    print("Model not found. Please check your Anthropic dashboard and API key permissions. Error details:")
+                    print(e)
+                    raise
+                model, max_tokens = fallback, min(max_tokens or self.MAX_TOKENS, self.planner.tier_for(fallback)["max_output_tokens"])
+            except anthropic.AuthenticationError:
+                print("Anthropic API key was rejected. Please check ANTHROPIC_API_KEY.")
+                raise
+            except Exception as e:
+                if self.retry_policy.is_outage(e):
+                    self.breaker.record(False)
+                delay = self.retry_policy.next_delay(e, attempt, started)
+                if delay is None:
+                    raise FixRequestFailed(e, attempt)
+                METRICS.count("model_retries")
+                print(f"Error: {e}. Retrying in {delay:.0f} seconds (attempt {attempt}/{self.retry_policy.max_attempts})...")
+                time.sleep(delay)
+
+    def fix_from_response(self, response):
+        # A reply cut off by max_tokens would overwrite the file with truncated code
+        if getattr(response, 'stop_reason', None) == "max_tokens":
+            print("[Warning] Model reply hit the output token limit; discarding truncated fix.", flush=True)
+            return None
+        return self.extract_code_block(self.response_text(response))
+
+    def process_issues_concurrently(self, file_to_issues, max_concurrency=None):
+        """
+        Generate fixes for many files at once with AsyncAnthropic.
+        Files are fixed in parallel (at most max_concurrency model calls in flight),
+        each with a single request that covers all of its issues (see process_file).
+        Returns a dict of file_path -> fixed content (None if the file could not be
+        fixed) in the same order as file_to_issues, so write-back order is deterministic.
+        """
+        limit = max_concurrency or self.max_concurrency
+        results = asyncio.run(self._process_files_async(file_to_issues, limit))
+        return {file_path: results[file_path] for file_path in file_to_issues}
+
+    async def _process_files_async(self, file_to_issues, limit):
+        semaphore = asyncio.Semaphore(limit)
+        backoff = SharedBackoff()
+        # The async client is tied to the event loop, so it lives only as long as this run.
+        # SDK-level retries are off so that 429/529 handling goes through the shared backoff.
+        async with anthropic.AsyncAnthropic(api_key=self.anthropic_api_key, base_url=self.base_url, max_retries=0) as client:
+            async def fix_file(file_path, issues):
+                with METRICS.span("process_file", file=file_path, issues=len(issues)):
+                    with open(file_path, "r") as input_file:
+                        content = input_file.read()
+                    plan = self.plan_fix(issues, content)
+                    outputs = await asyncio.gather(*(run_request(request, file_path) for request in plan))
+                    return file_path, self.apply_fix_outputs(content, plan, outputs, file_path)
+
+            async def run_request(request, label):
+                found, output = self.cached_fix(request, label)
+                if not found:
+                    if self.over_budget(label):
+                        return None
+                    try:
+                        output = await self._acreate_fix(client, semaphore, backoff, request["messages"], request["max_tokens"], label, request["model"])
+                    except FixRequestFailed as e:
+                        self.record_failure(label, request["issues"], e)
+                        return None
+                    self.store_fix(request, output, label)
+                return output
+
+            results = await asyncio.gather(*(fix_file(path, issues) for path, issues in file_to_issues.items()))
+        return dict(results)
+
+    async def _acreate_fix(self, client, semaphore, backoff, messages, max_tokens, label, model=None):
+        model = model or self.planner.base_model()
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            await backoff.wait()
+            await self.breaker.async_wait()
+            attempt += 1
+            try:
+                async with semaphore, shared_slot_async(MODEL_SLOTS):
+                    with METRICS.span("model_call", model=model, file=label, attempt=attempt):
+                        response = await client.messages.create(
+                            model=model,
+                            max_tokens=max_tokens,
+                            messages=messages
+                        )
+                backoff.succeeded()
+                self.breaker.record(True)
+                self.record_usage(label, response, model)
+                return self.fix_from_response(response)
+            except anthropic.NotFoundError as e:
+                fallback = self.planner.mark_unavailable(model)
+                if fallback is None:
+                    print("Model not found. Please check your Anthropic dashboard and API key permissions. Error details:")
+                    print(e)
+                    raise
+                model, max_tokens = fallback, min(max_tokens, self.planner.tier_for(fallback)["max_output_tokens"])
+            except anthropic.AuthenticationError:
+                print("Anthropic API key was rejected. Please check ANTHROPIC_API_KEY.")
+                raise
+            except Exception as e:
+                if self.retry_policy.is_outage(e):
+                    self.breaker.record(False)
+                throttled = isinstance(e, anthropic.APIStatusError) and e.status_code in self.THROTTLE_STATUSES
+                if throttled:
+                    # Rate limits pause every worker through the shared backoff
+                    if not self.retry_policy.allows(attempt, started) or not backoff.throttled():
+                        raise FixRequestFailed(e, attempt)
+                    METRICS.count("model_throttled")
+                    print(f"API returned {e.status_code}. Pausing all workers for {backoff.paused_until - time.monotonic():.0f} seconds...", flush=True)
+                    continue
+                delay = self.retry_policy.next_delay(e, attempt, started)
+                if delay is None:
+                    raise FixRequestFailed(e, attempt)
+                METRICS.count("model_retries")
+                print(f"Error: {e}. Retrying in {delay:.0f} seconds (attempt {attempt}/{self.retry_policy.max_attempts})...")
+                await asyncio.sleep(delay)
+
+    def process_issues_batched(self, file_to_issues, poll_interval=None, timeout=None):
+        """
+        Generate fixes for many files with a single Message Batches submission instead of
+        one messages.create call per request. For bulk, non-interactive runs: results
+        can take minutes to hours but cost half as much. Cached requests are not submitted.
+        Returns the same ordered dict of file_path -> fixed content (or None) as
+        process_issues_concurrently.
+        """
+        contents, plans, outputs, pending = {}, {}, {}, {}
+        batch_requests = []
+        for file_number, (file_path, issues) in enumerate(file_to_issues.items()):
+            with open(file_path, "r") as input_file:
+                contents[file_path] = input_file.read()
+            plans[file_path] = self.plan_fix(issues, contents[file_path])
+            for request_number, request in enumerate(plans[file_path]):
+                found, output = self.cached_fix(request, file_path)
+                if found:
+                    outputs[(file_path, request_number)] = output
+                    continue
+                custom_id = f"file{file_number}-req{request_number}"
+                pending[custom_id] = (file_path, request_number)
+                batch_requests.append({"custom_id": custom_id, "params": {
+                    "model": request["model"], "max_tokens": request["max_tokens"], "messages": request["messages"]
+                }})
+        if batch_requests and not self.over_budget(f"a batch of {len(batch_requests)} requests"):
+            # Results are read as a stream and spliced in as they arrive
+            for custom_id, response in self._run_batch(batch_requests, poll_interval or self.BATCH_POLL_INTERVAL, timeout or self.BATCH_TIMEOUT):
+                file_path, request_number = pending[custom_id]
+                request = plans[file_path][request_number]
+                output = None
+                if isinstance(response, Exception):
+                    self.record_failure(file_path, request["issues"], response)
+                else:
+                    self.record_usage(file_path, response, request["model"], batch=True)
+                    output = self.fix_from_response(response)
+                outputs[(file_path, request_number)] = output
+                self.store_fix(request, output, file_path)
+        return {
+            file_path: self.apply_fix_outputs(contents[file_path], plans[file_path],
+                                              [outputs.get((file_path, number)) for number in range(len(plans[file_path]))], file_path)
+            for file_path in file_to_issues
+        }
+
+    def _run_batch(self, batch_requests, poll_interval, timeout):
+        """
+        Submit a message batch, poll until it has ended and yield (custom_id, message)
+        for every request; for requests that errored, expired or were canceled a
+        FixRequestFailed is yielded instead of the message.
+        """
+        # Submitting and polling are cheap and idempotent enough to leave to the SDK's retries
+        batches = self.client.with_options(max_retries=5).messages.batches
+        batch = batches.create(requests=batch_requests)
+        print(f"[Stage] Submitted message batch {batch.id} with {len(batch_requests)} requests.", flush=True)
+        deadline = time.monotonic() + timeout
+        delay = 5
+        with METRICS.span("message_batch_wait", batch=batch.id, requests=len(batch_requests)):
+            while batch.processing_status != "ended":
+                if time.monotonic() > deadline:
+                    print(f"[Error] Message batch {batch.id} did not finish within {timeout} seconds; canceling it.", flush=True)
+                    batches.cancel(batch.id)
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, poll_interval)
+                batch = batches.retrieve(batch.id)
+                counts = batch.request_counts
+                print(f"[Stage] Message batch {batch.id}: {batch.processing_status} "
+                      f"({counts.succeeded} succeeded, {counts.errored} errored, {counts.processing} processing)", flush=True)
+        for entry in batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                yield entry.custom_id, entry.result.message
+            else:
+                error = getattr(getattr(entry.result, 'error', None), 'error', None)
+                message = getattr(error, 'message', None) or f"batch request {entry.result.type}"
+                yield entry.custom_id, FixRequestFailed(RuntimeError(message), 1, error_type=getattr(error, 'type', None) or entry.result.type)
+
+class FixCache:
+    """
+    Persistent cache of model fixes, stored in a table of the issues database.
+    Entries are keyed by the Sonar hash and rule of the issues being fixed, the
+    SHA-256 of the code shown to the model and the model name, so rerunning on an
+    unchanged file never pays for the same fix twice. Only fixes whose outcome was
+    recorded as applied are served; fixes reverted by the build or local check are
+    invalidated. Least recently used entries are evicted once the cache exceeds
+    max_entries or max_bytes.
+    With replay=True only cached fixes are used and misses make no model call.
+    """
+    def __init__(self, db_path, max_entries=5000, max_bytes=200 * 1024 * 1024, replay=False):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.RLock()
+        self.initialize_db()
+
+    def initialize_db(self):
+        c = self.conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS fix_cache (
+                cache_key TEXT PRIMARY KEY,
+                rule TEXT,
+                issue_hash TEXT,
+                file_sha256 TEXT,
+                output TEXT,
+                size INTEGER,
+                created_at REAL,
+                last_used REAL,
+                outcome TEXT
+            )
+        """)
+        # Caches created before outcomes were recorded
+        if "outcome" not in [row[1] for row in c.execute("PRAGMA table_info(fix_cache)")]:
+            c.execute("ALTER TABLE fix_cache ADD COLUMN outcome TEXT")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_fix_cache_last_used ON fix_cache (last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(issues, text, model):
+        # The Sonar hash identifies an issue by its code, independently of its line or key
+        identities = sorted((issue.get('hash') or issue.get('key', ''), issue.get('rule', ''), issue.get('message', '')) for issue in issues)
+        payload = json.dumps({"issues": identities, "file": hashlib.sha256(text.encode()).hexdigest(), "model": model})
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, cache_key):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT output FROM fix_cache WHERE cache_key = ? AND outcome = 'applied'", (cache_key,))
+            row = c.fetchone()
+            if row is not None:
+                c.execute("UPDATE fix_cache SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+                self.conn.commit()
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def put(self, cache_key, output, issues, text):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO fix_cache (cache_key, rule, issue_hash, file_sha256, output, size, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                cache_key,
+                ",".join(sorted({issue.get('rule', '') for issue in issues})),
+                ",".join(sorted(issue.get('hash') or '' for issue in issues)),
+                hashlib.sha256(text.encode()).hexdigest(),
+                output,
+                len(output.encode()),
+                now,
+                now
+            ))
+            self.conn.commit()
+            self.evict()
+
+    def mark_applied(self, cache_keys):
+        with self.lock:
+            self.conn.executemany("UPDATE fix_cache SET outcome = 'applied' WHERE cache_key = ?", [(key,) for key in cache_keys])
+            self.conn.commit()
+
+    def invalidate(self, cache_keys):
+        with self.lock:
+            self.conn.executemany("DELETE FROM fix_cache WHERE cache_key = ?", [(key,) for key in cache_keys])
+            self.conn.commit()
+
+    def evict(self):
+        c = self.conn.cursor()
+        count, total = c.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM fix_cache").fetchone()
+        evicted = 0
+        while count > self.max_entries or total > self.max_bytes:
+            row = c.execute("SELECT cache_key, size FROM fix_cache ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            c.execute("DELETE FROM fix_cache WHERE cache_key = ?", (row[0],))
+            count -= 1
+            total -= row[1]
+            evicted += 1
+        if evicted:
+            self.conn.commit()
+            print(f"[Cache] Evicted {evicted} least recently used fixes.", flush=True)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate)"
+
+class DatabaseManager:
+    ISSUE_COLUMNS = [
+        "id", "rule", "severity", "component", "project", "hash",
+        "message", "resolution", "status", "effort", "debt",
+        "author", "creationDate", "updateDate", "closeDate",
+        "type", "organization", "cleanCodeAttribute",
+        "cleanCodeAttributeCategory", "tags", "impacts"
+    ]
+    # SQLite limits the number of bound parameters per statement
+    MAX_SQL_PARAMS = 900
+    # Schema migrations, applied in order; the last applied version is kept in PRAGMA user_version
+    MIGRATIONS = [
+        (1, "migrate_v1_indexes_children_attempts"),
+        (2, "migrate_v2_export_tracking"),
+        (3, "migrate_v3_pipeline_checkpoints"),
+        (4, "migrate_v4_dead_letters"),
+    ]
+
+    def export_issues_to_csv(self, csv_path="issues_export.csv", incremental=False, fmt="csv", batch_size=1000):
+        """
+        Stream the issues table to a file in batches of batch_size rows, so memory use
+        does not grow with the table. Rows are written to a temporary file that replaces
+        the output only once it is complete, so an interrupted export never leaves a
+        half-written file behind. Incremental exports go to their own timestamped file
+        next to csv_path (see delta_path) and leave the full export in place.
+        Args:
+            csv_path (str): Output path.
+            incremental (bool): Only export rows added or changed since the last export to this path.
+            fmt (str): 'csv', or 'parquet' for columnar output (requires pyarrow).
+            batch_size (int): Rows fetched from SQLite per batch.
+        """
+        if fmt not in ("csv", "parquet"):
+            raise ValueError(f"Unsupported export format: {fmt}")
+        export_key = os.path.abspath(csv_path)
+        # Taken before reading so rows changed during the export are picked up next time
+        started_at = time.time()
+        # A separate connection sees a consistent snapshot (WAL) without touching the
+        # main connection, which may be mid-transaction when a signal arrives.
         conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        tmp_path = None
+        try:
+            since = self.last_export_time(export_key, conn) if incremental else None
+            output_path = self.delta_path(csv_path, started_at) if since is not None else csv_path
+            c = conn.cursor()
+            query = f"SELECT {', '.join(self.ISSUE_COLUMNS)} FROM issues"
+            params = ()
+            if since is not None:
+                query += " WHERE db_updated_at > ?"
+                params = (since,)
+            c.execute(query, params)
+            headers = [description[0] for description in c.description]
+            fd, tmp_path = tempfile.mkstemp(prefix=".export-", suffix=".tmp", dir=os.path.dirname(export_key))
+            os.close(fd)
+            if fmt == "parquet":
+                count = self._write_parquet(c, headers, tmp_path, batch_size)
+            else:
+                count = self._write_csv(c, headers, tmp_path, batch_size)
+            os.replace(tmp_path, output_path)
+            tmp_path = None
+            self.set_last_export_time(export_key, started_at, conn)
+        finally:
+            conn.close()
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Exported {count} {'changed ' if since is not None else ''}issues to {output_path}")
+        return count
 
+    @staticmethod
+    def delta_path(csv_path, exported_at):
+        """
+        Path of an incremental export: csv_path with the export time added before the
+        extension, e.g. issues_export.delta-20240101-120000.csv.
+        """
+        stem, extension = os.path.splitext(csv_path)
+        return f"{stem}.delta-{time.strftime('%Y%m%d-%H%M%S', time.localtime(exported_at))}{extension}"
+
+    def _write_csv(self, cursor, headers, path, batch_size):
+        count = 0
+        with open(path, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(headers)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                count += len(rows)
+            file.flush()
+            os.fsync(file.fileno())
+        return count
+
+    def _write_parquet(self, cursor, headers, path, batch_size):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet export requires pyarrow. Install it with: pip install pyarrow")
+        schema = pyarrow.schema([(header, pyarrow.string()) for header in headers])
+        count = 0
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                columns = [[None if value is None else str(value) for value in column] for column in zip(*rows)]
+                writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, pyarrow.string()) for column in columns], schema=schema))
+                count += len(rows)
+        return count
+
+    def last_export_time(self, export_key, conn):
+        row = conn.execute("SELECT exported_at FROM export_state WHERE path = ?", (export_key,)).fetchone()
+        # None means the path was never exported, so everything is exported
+        return row[0] if row else None
+
+    def set_last_export_time(self, export_key, exported_at, conn):
+        # Written on the export's own connection: committing on the main connection from a
+        # signal handler would commit whatever transaction it was interrupted in
         try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO export_state (path, exported_at) VALUES (?, ?)", (export_key, exported_at))
+        except sqlite3.OperationalError as e:
+            # e.g. the main connection holds the write lock; the next delta then covers more rows
+            print(f"[Warning] Could not record the export time for {export_key}: {e}", flush=True)
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # One long-lived connection in WAL mode instead of a connection per call
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.RLock()
+        self.initialize_db()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def initialize_db(self):
+        with self.lock:
+            c = self.conn.cursor()
             c.execute("""
-                INSERT INTO issues (
-                    id, rule, severity, component, project, hash,
-                    message, resolution, status, effort, debt,
-                    author, creationDate, updateDate, closeDate,
-                    type, organization, cleanCodeAttribute,
-                    cleanCodeAttributeCategory, tags, impacts
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                issue_data['key'],
-                issue_data.get('rule'),
-                issue_data.get('severity'),
-                issue_data.get('component'),
-                issue_data.get('project'),
-                issue_data.get('hash'),
-                issue_data.get('message'),
-                issue_data.get('resolution'),
-                issue_data.get('status'),
-                issue_data.get('effort'),
-                issue_data.get('debt'),
-                issue_data.get('author'),
-                issue_data.get('creationDate'),
-                issue_data.get('updateDate'),
-                issue_data.get('closeDate'),
-                issue_data.get('type'),
-                issue_data.get('organization'),
-                issue_data.get('cleanCodeAttribute'),
-                issue_data.get('cleanCodeAttributeCategory'),
-                json.dumps(issue_data.get('tags', [])),
-                json.dumps(issue_data.get('impacts', []))
-            ))
-            conn.commit()
+                CREATE TABLE IF NOT EXISTS issues (
+                    id TEXT PRIMARY KEY,
+                    rule TEXT,
+                    severity TEXT,
+                    component TEXT,
+                    project TEXT,
+                    hash TEXT,
+                    message TEXT,
+                    resolution TEXT,
+                    status TEXT,
+                    effort TEXT,
+                    debt TEXT,
+                    author TEXT,
+                    creationDate TEXT,
+                    updateDate TEXT,
+                    closeDate TEXT,
+                    type TEXT,
+                    organization TEXT,
+                    cleanCodeAttribute TEXT,
+                    cleanCodeAttributeCategory TEXT,
+                    tags TEXT,
+                    impacts TEXT
+                )
+            """)
+            self.conn.commit()
+        self.migrate()
+
+    def schema_version(self):
+        with self.lock:
+            return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        """
+        Bring the database up to the latest schema version. Each migration runs in
+        its own transaction together with the version bump.
+        """
+        with self.lock:
+            version = self.schema_version()
+            for target, method_name in self.MIGRATIONS:
+                if version >= target:
+                    continue
+                print(f"[DB] Migrating {self.db_path} to schema version {target}...", flush=True)
+                # An explicit BEGIN: the sqlite3 module only opens transactions implicitly
+                # before DML, so ALTER/CREATE statements would otherwise autocommit one by one
+                self.conn.commit()
+                self.conn.execute("BEGIN")
+                try:
+                    getattr(self, method_name)(self.conn.cursor())
+                    # PRAGMA does not accept bound parameters
+                    self.conn.execute(f"PRAGMA user_version = {int(target)}")
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+                version = target
+
+    def migrate_v1_indexes_children_attempts(self, c):
+        c.execute("CREATE INDEX IF NOT EXISTS idx_issues_component ON issues (component)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_issues_rule ON issues (rule)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_issues_project_status ON issues (project, status)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS issue_tags (
+                issue_id TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                PRIMARY KEY (issue_id, tag)
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_issue_tags_tag ON issue_tags (tag)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS issue_impacts (
+                issue_id TEXT NOT NULL,
+                software_quality TEXT NOT NULL,
+                severity TEXT,
+                PRIMARY KEY (issue_id, software_quality)
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_issue_impacts_quality ON issue_impacts (software_quality, severity)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS fix_attempts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                issue_id TEXT NOT NULL,
+                rule TEXT,
+                component TEXT,
+                project TEXT,
+                attempted_at TEXT,
+                model TEXT,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                outcome TEXT,
+                build_result TEXT
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_fix_attempts_issue ON fix_attempts (issue_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_fix_attempts_rule ON fix_attempts (rule, outcome)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_fix_attempts_component ON fix_attempts (component)")
+        # Backfill the child tables from the JSON columns of existing rows
+        rows = c.execute("SELECT id, tags, impacts FROM issues").fetchall()
+        tag_rows, impact_rows = self.child_rows(
+            (issue_id, self.load_json_list(tags), self.load_json_list(impacts)) for issue_id, tags, impacts in rows
+        )
+        c.executemany("INSERT OR IGNORE INTO issue_tags (issue_id, tag) VALUES (?, ?)", tag_rows)
+        c.executemany("INSERT OR IGNORE INTO issue_impacts (issue_id, software_quality, severity) VALUES (?, ?, ?)", impact_rows)
+
+    def migrate_v2_export_tracking(self, c):
+        # Local modification time, so exports can pick up only rows changed since the last run.
+        # Checked first: databases half-migrated by older versions may already have the column
+        if "db_updated_at" not in [row[1] for row in c.execute("PRAGMA table_info(issues)")]:
+            c.execute("ALTER TABLE issues ADD COLUMN db_updated_at REAL NOT NULL DEFAULT 0")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_issues_db_updated_at ON issues (db_updated_at)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS export_state (
+                path TEXT PRIMARY KEY,
+                exported_at REAL
+            )
+        """)
+
+    def migrate_v3_pipeline_checkpoints(self, c):
+        # One row per completed pipeline stage; replacing a row moves it to the end (new id)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS pipeline_checkpoints (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_key TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                commit_sha TEXT,
+                queue_position INTEGER,
+                data TEXT,
+                updated_at REAL,
+                UNIQUE (run_key, stage)
+            )
+        """)
+
+    def migrate_v4_dead_letters(self, c):
+        # Issues whose fix request was given up on, so they can be inspected or retried later
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                issue_id TEXT NOT NULL,
+                rule TEXT,
+                component TEXT,
+                project TEXT,
+                failed_at TEXT,
+                error_type TEXT,
+                error TEXT,
+                attempts INTEGER
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_dead_letters_issue ON dead_letters (issue_id)")
+
+    @staticmethod
+    def load_json_list(value):
+        try:
+            loaded = json.loads(value) if value else []
+        except (TypeError, ValueError):
+            return []
+        return loaded if isinstance(loaded, list) else []
+
+    @staticmethod
+    def child_rows(entries):
+        """
+        Turn (issue_id, tags, impacts) entries into rows for issue_tags and issue_impacts.
+        """
+        tag_rows = []
+        impact_rows = []
+        for issue_id, tags, impacts in entries:
+            tag_rows.extend((issue_id, tag) for tag in tags)
+            impact_rows.extend(
+                (issue_id, impact.get('softwareQuality'), impact.get('severity'))
+                for impact in impacts if isinstance(impact, dict) and impact.get('softwareQuality')
+            )
+        return tag_rows, impact_rows
+
+    def issue_exists(self, issue_id):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT 1 FROM issues WHERE id = ?", (issue_id,))
+            return c.fetchone() is not None
+
+    def existing_ids(self, keys):
+        """
+        Return the subset of the given issue keys that are already in the database,
+        using one query per MAX_SQL_PARAMS keys instead of one query per key.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = set()
+        with self.lock:
+            c = self.conn.cursor()
+            for i in range(0, len(keys), self.MAX_SQL_PARAMS):
+                chunk = keys[i:i + self.MAX_SQL_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                c.execute(f"SELECT id FROM issues WHERE id IN ({placeholders})", chunk)
+                found.update(row[0] for row in c.fetchall())
+        return found
+
+    def issue_row(self, issue_data):
+        return (
+            issue_data['key'],
+            issue_data.get('rule'),
+            issue_data.get('severity'),
+            issue_data.get('component'),
+            issue_data.get('project'),
+            issue_data.get('hash'),
+            issue_data.get('message'),
+            issue_data.get('resolution'),
+            issue_data.get('status'),
+            issue_data.get('effort'),
+            issue_data.get('debt'),
+            issue_data.get('author'),
+            issue_data.get('creationDate'),
+            issue_data.get('updateDate'),
+            issue_data.get('closeDate'),
+            issue_data.get('type'),
+            issue_data.get('organization'),
+            issue_data.get('cleanCodeAttribute'),
+            issue_data.get('cleanCodeAttributeCategory'),
+            json.dumps(issue_data.get('tags', [])),
+            json.dumps(issue_data.get('impacts', []))
+        )
+
+    def insert_issue(self, issue_data):
+        with self.lock:
+            if self.issue_exists(issue_data['key']):
+                print(f"Issue {issue_data['key']} already exists. Skipping.")
+                return
+            self.insert_issues([issue_data])
             print(f"Issue {issue_data['key']} added.")
-        except sqlite3.IntegrityError:
-            print(f"Issue {issue_data['key']} already exists. Skipping.")
+
+    def insert_issues(self, issues):
+        """
+        Insert or update many issues with executemany in a single transaction.
+        Existing rows are refreshed with the latest data from SonarCloud.
+        Returns the number of issues written.
+        """
+        issues = list(issues)
+        now = time.time()
+        rows = [self.issue_row(issue) + (now,) for issue in issues]
+        if not rows:
+            return 0
+        columns = self.ISSUE_COLUMNS + ["db_updated_at"]
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns[1:])
+        # Leave unchanged rows alone so incremental exports only see real changes
+        changed = " OR ".join(f"issues.{column} IS NOT excluded.{column}" for column in self.ISSUE_COLUMNS[1:])
+        ids = [(row[0],) for row in rows]
+        tag_rows, impact_rows = self.child_rows(
+            (issue['key'], issue.get('tags', []), issue.get('impacts', [])) for issue in issues
+        )
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(f"""
+                    INSERT INTO issues ({", ".join(columns)})
+                    VALUES ({", ".join("?" * len(columns))})
+                    ON CONFLICT(id) DO UPDATE SET {updates} WHERE {changed}
+                """, rows)
+                self.conn.executemany("DELETE FROM issue_tags WHERE issue_id = ?", ids)
+                self.conn.executemany("DELETE FROM issue_impacts WHERE issue_id = ?", ids)
+                self.conn.executemany("INSERT OR IGNORE INTO issue_tags (issue_id, tag) VALUES (?, ?)", tag_rows)
+                self.conn.executemany("INSERT OR IGNORE INTO issue_impacts (issue_id, software_quality, severity) VALUES (?, ?, ?)", impact_rows)
+        print(f"Saved {len(rows)} issues.")
+        return len(rows)
+
+    def record_fix_attempts(self, issues, model, input_tokens, output_tokens, outcome, build_result):
+        """
+        Record one fix attempt per issue. Token counts are for the whole request and
+        are split evenly between the issues it covered.
+        """
+        issues = list(issues)
+        if not issues:
+            return
+        attempted_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        share = len(issues)
+        rows = [(
+            issue['key'], issue.get('rule'), issue.get('component'), issue.get('project'), attempted_at, model,
+            (input_tokens or 0) // share, (output_tokens or 0) // share, outcome, build_result
+        ) for issue in issues]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("""
+                    INSERT INTO fix_attempts (
+                        issue_id, rule, component, project, attempted_at, model,
+                        input_tokens, output_tokens, outcome, build_result
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+
+    def attempted_issue_ids(self, since, until=None):
+        """
+        Return the keys of the issues with a fix attempt recorded at or after the epoch time
+        `since` (and at or before `until`, if given).
+        """
+        since_text = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(since))
+        until_text = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(until if until is not None else time.time()))
+        with self.lock:
+            rows = self.conn.execute("SELECT DISTINCT issue_id FROM fix_attempts WHERE attempted_at >= ? AND attempted_at <= ?",
+                                     (since_text, until_text)).fetchall()
+        return {row[0] for row in rows}
+
+    def record_dead_letters(self, issues, error_type, error, attempts):
+        """
+        Record issues whose fix request failed for good (fatal error, or retries exhausted).
+        """
+        failed_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        rows = [(
+            issue['key'], issue.get('rule'), issue.get('component'), issue.get('project'), failed_at, error_type, error, attempts
+        ) for issue in issues]
+        if not rows:
+            return
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("""
+                    INSERT INTO dead_letters (
+                        issue_id, rule, component, project, failed_at, error_type, error, attempts
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+
+    def issue_counts_by_file(self, project=None, status="OPEN", limit=50):
+        """
+        Return (component, issue count) for the files with the most issues.
+        """
+        return self._grouped_counts("component", project, status, limit)
+
+    def issue_counts_by_rule(self, project=None, status="OPEN", limit=50):
+        """
+        Return (rule, issue count) for the most frequent rules.
+        """
+        return self._grouped_counts("rule", project, status, limit)
+
+    def _grouped_counts(self, column, project, status, limit):
+        clauses = []
+        params = []
+        if project:
+            clauses.append("project = ?")
+            params.append(project)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT {column}, COUNT(*) AS n FROM issues {where} GROUP BY {column} ORDER BY n DESC LIMIT ?",
+                params + [limit]
+            ).fetchall()
+
+    def fix_success_by_rule(self):
+        """
+        Return {rule: (attempts, successful attempts, total tokens)} from the fix history.
+        Requests that got no reply at all (outcome 'request_failed') are not attempts.
+        """
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT rule, COUNT(*), SUM(outcome = 'applied'), SUM(COALESCE(input_tokens, 0) + COALESCE(output_tokens, 0))
+                FROM fix_attempts WHERE outcome != 'request_failed' GROUP BY rule
+            """).fetchall()
+        return {rule: (attempts, successes or 0, tokens or 0) for rule, attempts, successes, tokens in rows}
+
+    def save_checkpoint(self, run_key, stage, status="completed", commit_sha=None, queue_position=None, data=None):
+        """
+        Record that a pipeline stage finished, with the commit SHA and queue position
+        at that point and any stage outputs needed to skip it on restart.
+        """
+        with self.lock:
+            with self.conn:
+                self.conn.execute("""
+                    INSERT OR REPLACE INTO pipeline_checkpoints (
+                        run_key, stage, status, commit_sha, queue_position, data, updated_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (run_key, stage, status, commit_sha, queue_position, json.dumps(data or {}), time.time()))
+
+    def load_checkpoints(self, run_key):
+        """
+        Return {stage: checkpoint dict} for a run, plus the most recent checkpoint under 'last'.
+        """
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT stage, status, commit_sha, queue_position, data, updated_at
+                FROM pipeline_checkpoints WHERE run_key = ? ORDER BY id
+            """, (run_key,)).fetchall()
+        checkpoints = {}
+        for stage, status, commit_sha, queue_position, data, updated_at in rows:
+            checkpoints[stage] = checkpoints['last'] = {
+                "stage": stage, "status": status, "commit_sha": commit_sha,
+                "queue_position": queue_position, "data": json.loads(data or "{}"), "updated_at": updated_at
+            }
+        return checkpoints
+
+    def clear_checkpoints(self, run_key):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM pipeline_checkpoints WHERE run_key = ?", (run_key,))
+
+class FileIndex:
+    """
+    One pass over a checkout with os.scandir, shared by every stage that needs to know
+    which files exist. Dependency, VCS and IDE directories are pruned, and build output
+    directories are not descended into. Top-level directories are walked in parallel.
+    Records:
+        files           - relative paths of all indexed files
+        language_counts - number of files per extension
+        build_files     - relative paths of Gradle/Maven build files and wrappers
+        module_dirs     - directories that can hold build outputs (root, build file and src parents)
+    """
+    PRUNE_DIRS = {
+        ".git", ".svn", ".hg", "node_modules", ".scannerwork", ".gradle", ".idea", ".vscode",
+        "venv", ".venv", "__pycache__", ".DS_Store"
+    }
+    OUTPUT_DIRS = {"build", "target", "out", "dist"}
+    BUILD_FILES = {"build.gradle", "build.gradle.kts", "settings.gradle", "settings.gradle.kts", "pom.xml", "gradlew", "mvnw"}
+
+    def __init__(self, root, workers=8):
+        self.root = root
+        self.workers = workers
+        self.files = set()
+        self.language_counts = collections.Counter()
+        self.build_files = []
+        self.module_dirs = set()
+
+    def scan(self):
+        t0 = time.time()
+        # Files directly under the root are indexed here; each top-level directory is walked by a worker
+        top_dirs, root_files, root_build_files, root_module_dirs = [], [], [], set()
+        self._scan_dir("", top_dirs, root_files, root_build_files, root_module_dirs)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = [(root_files, root_build_files, root_module_dirs)] + list(pool.map(self._walk, top_dirs))
+        for files, build_files, module_dirs in results:
+            self.files.update(files)
+            self.build_files.extend(build_files)
+            self.module_dirs.update(module_dirs)
+        self.module_dirs.add("")
+        self.build_files.sort()
+        self.language_counts = collections.Counter(os.path.splitext(path)[1].lower() or "(none)" for path in self.files)
+        print(f"[Done] Indexed {len(self.files)} files in {time.time() - t0:.2f}s.", flush=True)
+        return self
+
+    def _walk(self, top_dir):
+        files, build_files, module_dirs = [], [], set()
+        stack = [top_dir]
+        while stack:
+            self._scan_dir(stack.pop(), stack, files, build_files, module_dirs)
+        return files, build_files, module_dirs
+
+    def _scan_dir(self, rel_dir, subdirs, files, build_files, module_dirs):
+        try:
+            entries = list(os.scandir(os.path.join(self.root, rel_dir)))
+        except OSError:
+            return
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in self.PRUNE_DIRS:
+                    continue
+                if entry.name in self.OUTPUT_DIRS:
+                    module_dirs.add(rel_dir)
+                    continue
+                if entry.name == "src":
+                    module_dirs.add(rel_dir)
+                subdirs.append(rel_path)
+            elif entry.is_file(follow_symlinks=False):
+                files.append(rel_path)
+                if entry.name in self.BUILD_FILES:
+                    build_files.append(rel_path)
+                    module_dirs.add(rel_dir)
+
+    def files_with_extension(self, extension):
+        return sorted(os.path.join(self.root, path) for path in self.files if path.endswith(extension))
+
+    def contains(self, rel_path):
+        return rel_path.replace(os.sep, "/").lstrip("/") in self.files
+
+    def binary_dirs(self, patterns):
+        """
+        Return existing class output directories matching any of the patterns (lists of
+        path parts) under a module directory. Checked on demand, so outputs of a build
+        that ran after the scan are found too.
+        """
+        matches = []
+        for module_dir in sorted(self.module_dirs):
+            for pattern in patterns:
+                candidate = os.path.join(self.root, module_dir, *pattern)
+                if os.path.isdir(candidate):
+                    matches.append(os.path.normpath(candidate))
+        return matches
+
+class BuildVerifier:
+    """
+    Checks that fixed files still compile, without a clean rebuild of the project per file.
+    Strategies:
+        'javac'  - compile only the touched files against the classpath cached from the
+                   initial build (fastest; used by 'auto' when the classpath can be resolved).
+                   Test sources (src/<set>/java with a set other than main) are compiled
+                   against the test classpath, with the source roots on -sourcepath so
+                   helpers that were not built yet still resolve
+        'gradle' - incremental `classes` build on a kept-warm Gradle daemon (no clean, no tests)
+        'maven'  - incremental offline `compile` (no clean, no tests)
+        'auto'   - javac if a classpath is available, otherwise the project's build tool
+    Results are cached per file content hash, so an unchanged file is never verified twice.
+    """
+    # Matches compiler errors from javac/Gradle ("/path/A.java:12: error:") and Maven ("/path/A.java:[12,5]")
+    ERROR_FILE_REGEX = re.compile(r"((?:[A-Za-z]:)?[^\s:\[\]]+\.java):\[?\d+")
+    GRADLE_CLASSPATH_SCRIPT = """
+allprojects {
+    tasks.register("cqePrintClasspath") {
+        doLast {
+            def sourceSets = project.extensions.findByName("sourceSets")
+            if (sourceSets != null) {
+                println "CQE_CLASSPATH=" + sourceSets.getByName("main").compileClasspath.asPath
+                def test = sourceSets.findByName("test")
+                if (test != null) {
+                    println "CQE_TEST_CLASSPATH=" + test.compileClasspath.asPath
+                }
+            }
+        }
+    }
+}
+"""
+
+    def __init__(self, repo_path, strategy="auto", binary_dirs=None, timeout=1800):
+        self.repo_path = repo_path
+        self.strategy = strategy
+        self.binary_dirs = list(binary_dirs or [])
+        self.timeout = timeout
+        self.classpath = None
+        self.test_classpath = None
+        self.results = {}
+        self.build_system, self.build_tool = self.detect_build_system()
+
+    def detect_build_system(self):
+        if os.path.exists(os.path.join(self.repo_path, 'build.gradle')) or os.path.exists(os.path.join(self.repo_path, 'build.gradle.kts')):
+            wrapper = os.path.exists(os.path.join(self.repo_path, 'gradlew'))
+            return "gradle", "./gradlew" if wrapper else "gradle"
+        if os.path.exists(os.path.join(self.repo_path, 'pom.xml')):
+            wrapper = os.path.exists(os.path.join(self.repo_path, 'mvnw'))
+            return "maven", "./mvnw" if wrapper else "mvn"
+        return None, None
+
+    def prepare(self):
+        """
+        Resolve and cache the compile classpath once, after the initial build.
+        """
+        t0 = time.time()
+        if self.build_system == "maven":
+            self._fetch_maven_test_dependencies()
+        if self.strategy not in ("auto", "javac"):
+            return
+        entries, test_entries = [], []
+        try:
+            if self.build_system == "gradle":
+                entries, test_entries = self._gradle_classpath()
+            elif self.build_system == "maven":
+                # build-classpath covers every scope, test dependencies included
+                entries = test_entries = self._maven_classpath()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError) as e:
+            print(f"[Info] Could not resolve the compile classpath ({e}); verifying with the build tool instead.", flush=True)
+            return
+        self.classpath = self.existing_entries(self.binary_dirs + entries)
+        self.test_classpath = self.existing_entries(self.binary_dirs + self.test_binary_dirs() + test_entries)
+        print(f"[Done] Cached compile classpath ({len(self.classpath)} entries, {len(self.test_classpath)} for tests) in {time.time() - t0:.2f}s.", flush=True)
+
+    @staticmethod
+    def existing_entries(entries):
+        return [entry for entry in dict.fromkeys(entries) if entry and os.path.exists(entry)]
+
+    def test_binary_dirs(self):
+        # target/classes -> target/test-classes (Maven), build/classes/java/main -> .../test (Gradle)
+        dirs = []
+        for binary_dir in self.binary_dirs:
+            head, tail = os.path.split(binary_dir.rstrip(os.sep))
+            if tail == "classes":
+                dirs.append(os.path.join(head, "test-classes"))
+            elif tail == "main":
+                dirs.append(os.path.join(head, "test"))
+        return dirs
+
+    def _gradle_classpath(self):
+        fd, script_path = tempfile.mkstemp(prefix="cqe-classpath-", suffix=".gradle")
+        with os.fdopen(fd, "w") as script:
+            script.write(self.GRADLE_CLASSPATH_SCRIPT)
+        try:
+            result = subprocess.run([self.build_tool, "-q", "--daemon", "--init-script", script_path, "cqePrintClasspath"],
+                                    cwd=self.repo_path, check=True, capture_output=True, text=True, timeout=self.timeout)
         finally:
-            conn.close()
-            
+            os.remove(script_path)
+        entries, test_entries = [], []
+        for line in result.stdout.splitlines():
+            if line.startswith("CQE_CLASSPATH="):
+                entries.extend(line[len("CQE_CLASSPATH="):].split(os.pathsep))
+            elif line.startswith("CQE_TEST_CLASSPATH="):
+                test_entries.extend(line[len("CQE_TEST_CLASSPATH="):].split(os.pathsep))
+        return entries, test_entries
+
+    def _fetch_maven_test_dependencies(self):
+        # The initial `mvn clean compile` only downloads compile-scope dependencies; the offline
+        # test-compile runs of verify() also need the test scope and the test compiler setup
+        try:
+            subprocess.run([self.build_tool, "-q", "test-compile"], cwd=self.repo_path, check=True,
+                           capture_output=True, text=True, timeout=self.timeout)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError) as e:
+            print(f"[Warning] Could not fetch the test dependencies ({e}); fixes to test sources may fail verification.", flush=True)
+
+    def _maven_classpath(self):
+        fd, output_path = tempfile.mkstemp(prefix="cqe-classpath-", suffix=".txt")
+        os.close(fd)
+        try:
+            # Online: the dependency plugin itself is not fetched by the initial build
+            subprocess.run([self.build_tool, "-q", "dependency:build-classpath",
+                            f"-Dmdep.outputFile={output_path}", "-Dmdep.appendOutput=true"],
+                           cwd=self.repo_path, check=True, capture_output=True, text=True, timeout=self.timeout)
+            with open(output_path) as f:
+                return [entry for line in f.read().splitlines() for entry in line.split(os.pathsep)]
+        finally:
+            os.remove(output_path)
+
+    def active_strategy(self):
+        if self.strategy == "auto":
+            if self.classpath is not None:
+                return "javac"
+            return self.build_system
+        return self.strategy
+
+    def verify(self, file_paths):
+        """
+        Verify a batch of changed files with one compiler or build run.
+        Files other than Java sources are checked with the project's build tool.
+        Returns {file_path: True (compiles), False (broken) or None (not checked)}.
+        """
+        strategy = self.active_strategy()
+        # javac only sees Java sources; other files (resources, build scripts) need the build tool,
+        # except with an explicit 'javac' strategy, which is a syntax check only
+        other_strategy = self.build_system if self.strategy != "javac" else None
+        results = {}
+        pending = []
+        for file_path in file_paths:
+            file_strategy = strategy if file_path.endswith('.java') else other_strategy
+            if file_strategy is None:
+                results[file_path] = None
+                continue
+            key = (file_strategy, file_path, self.file_hash(file_path))
+            if key in self.results:
+                results[file_path] = self.results[key]
+            else:
+                pending.append((file_path, key))
+        if pending:
+            t0 = time.time()
+            paths = [file_path for file_path, key in pending]
+            java_paths = [path for path in paths if path.endswith('.java')]
+            other_paths = [path for path in paths if not path.endswith('.java')]
+            if strategy == "javac":
+                failed = self._verify_with_javac(java_paths) if java_paths else set()
+                if other_paths:
+                    # The Java files of the batch are still on disk, so pass them along: a build
+                    # failure the compiler puts on them is not blamed on the other files
+                    failed |= self._run_build_tool(other_strategy, java_paths + other_paths) - set(java_paths)
+            else:
+                failed = self._run_build_tool(strategy, paths)
+            for file_path, key in pending:
+                results[file_path] = self.results[key] = file_path not in failed
+            print(f"[Done] Verified {len(paths)} files with {strategy if java_paths else other_strategy} in {time.time() - t0:.2f}s ({len(failed)} failed).", flush=True)
+        return {file_path: results[file_path] for file_path in file_paths}
+
+    @staticmethod
+    def file_hash(file_path):
+        with open(file_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def source_set(self, file_path):
+        """
+        Return the source set of a file in the conventional src/<set>/java layout
+        ('main', 'test', 'integrationTest', ...), or None for other layouts.
+        """
+        parts = os.path.relpath(file_path, self.repo_path).split(os.sep)
+        for i in range(len(parts) - 2):
+            if parts[i] == "src" and parts[i + 2] in ("java", "kotlin", "groovy"):
+                return parts[i + 1]
+        return None
+
+    def is_test_source(self, file_path):
+        return self.source_set(file_path) not in (None, "main")
+
+    def source_roots(self, paths):
+        """
+        Source roots for -sourcepath: the root of each file (its directory minus the
+        package path) and, in the src/<set>/java layout, the other source sets of the module.
+        """
+        roots = []
+        for file_path in paths:
+            directory = os.path.dirname(os.path.abspath(os.path.join(self.repo_path, file_path)))
+            try:
+                with open(os.path.join(self.repo_path, file_path), encoding="utf-8", errors="replace") as f:
+                    match = LocalRuleChecker.PACKAGE_REGEX.search(f.read())
+            except OSError:
+                continue
+            root = directory
+            if match:
+                package_dir = os.sep + match.group(1).replace(".", os.sep)
+                if not directory.endswith(package_dir):
+                    continue
+                root = directory[:-len(package_dir)]
+            roots.append(root)
+            source_dir, language = os.path.split(root)
+            sets_dir = os.path.dirname(source_dir)
+            if os.path.basename(sets_dir) == "src":
+                for name in sorted(os.listdir(sets_dir)):
+                    if os.path.isdir(os.path.join(sets_dir, name, language)):
+                        roots.append(os.path.join(sets_dir, name, language))
+        return list(dict.fromkeys(roots))
+
+    def _verify_with_javac(self, paths):
+        main_paths = [path for path in paths if not self.is_test_source(path)]
+        test_paths = [path for path in paths if self.is_test_source(path)]
+        failed = set()
+        if main_paths:
+            failed |= self._run_javac(main_paths, self.classpath)
+        if test_paths:
+            if self.test_classpath is None and self.build_system:
+                # No test classpath (e.g. a checkpoint from before it was recorded): let the build tool compile the tests
+                failed |= self._run_build_tool(self.build_system, test_paths)
+            else:
+                failed |= self._run_javac(test_paths, self.test_classpath if self.test_classpath is not None else self.classpath)
+        return failed
+
+    def _run_javac(self, paths, classpath):
+        out_dir = tempfile.mkdtemp(prefix="cqe-javac-")
+        cmd = ["javac", "-d", out_dir, "-proc:none", "-implicit:none", "-nowarn", "-encoding", "UTF-8"]
+        if classpath:
+            cmd += ["-cp", os.pathsep.join(classpath)]
+        source_roots = self.source_roots(paths)
+        if source_roots:
+            cmd += ["-sourcepath", os.pathsep.join(source_roots)]
+        try:
+            result = subprocess.run(cmd + paths, cwd=self.repo_path, capture_output=True, text=True, timeout=self.timeout)
+        except FileNotFoundError:
+            print("[Error] javac not found; skipping verification.", flush=True)
+            return set()
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+        return self.failed_files(result, paths)
+
+    def _run_build_tool(self, strategy, paths):
+        # Test sources are only compiled by the test compile tasks
+        tests = any(self.is_test_source(path) for path in paths)
+        if strategy == "gradle":
+            cmd = [self.build_tool, "testClasses" if tests else "classes", "--daemon", "-q"]
+        else:
+            cmd = [self.build_tool, "-q", "-o", "test-compile" if tests else "compile"]
+        try:
+            result = subprocess.run(cmd, cwd=self.repo_path, capture_output=True, text=True, timeout=self.timeout)
+        except FileNotFoundError:
+            print(f"[Error] {cmd[0]} not found; skipping verification.", flush=True)
+            return set()
+        return self.failed_files(result, paths)
+
+    def failed_files(self, result, paths):
+        """
+        Work out which of the touched files broke the build from the compiler output.
+        If the build failed without naming any of them, all of them are treated as failed.
+        """
+        if result.returncode == 0:
+            return set()
+        by_real_path = {os.path.realpath(os.path.join(self.repo_path, path)): path for path in paths}
+        failed = set()
+        for match in self.ERROR_FILE_REGEX.finditer(result.stdout + "\n" + result.stderr):
+            real_path = os.path.realpath(os.path.join(self.repo_path, match.group(1)))
+            if real_path in by_real_path:
+                failed.add(by_real_path[real_path])
+        return failed or set(paths)
+
+class LocalRuleChecker:
+    """
+    Offline stand-in for a subset of SonarCloud's Java rules, used to confirm a fix
+    before paying for a remote scan. Checks are line-based approximations of the real
+    rules; issues for rules it does not know are left to the remote analysis.
+    """
+    IMPORT_REGEX = re.compile(r"^\s*import\s+(static\s+)?([\w.]+)\s*;", re.MULTILINE)
+    PACKAGE_REGEX = re.compile(r"^\s*package\s+([\w.]+)\s*;", re.MULTILINE)
+
+    def __init__(self):
+        self.rules = {
+            "java:S106": self.check_system_out,
+            "java:S108": self.check_empty_block,
+            "java:S125": self.check_commented_out_code,
+            "java:S1128": self.check_unused_import,
+            "java:S1135": self.check_todo,
+            "java:S1444": self.check_public_static_field,
+            "java:S1598": self.check_package_path,
+            "java:S2293": self.check_diamond,
+        }
+
+    def supports(self, rule):
+        return rule in self.rules
+
+    def check(self, text, file_path=None, rules=None):
+        """
+        Return the sorted (rule, line) findings for a file's text.
+        """
+        findings = []
+        for rule in rules or self.rules:
+            if rule in self.rules:
+                findings.extend((rule, line) for line in self.rules[rule](text, file_path))
+        return sorted(findings)
+
+    @staticmethod
+    def line_of(text, offset):
+        return text.count("\n", 0, offset) + 1
+
+    def regex_lines(self, regex, text):
+        return [self.line_of(text, match.start()) for match in regex.finditer(text)]
+
+    def check_system_out(self, text, file_path):
+        return self.regex_lines(re.compile(r"\bSystem\.(out|err)\b"), text)
+
+    def check_empty_block(self, text, file_path):
+        return self.regex_lines(re.compile(r"\b(catch\s*\([^)]*\)|try|finally|else|synchronized\s*\([^)]*\))\s*\{\s*\}"), text)
+
+    def check_commented_out_code(self, text, file_path):
+        lines = []
+        previous = False
+        for number, line in enumerate(text.splitlines(), start=1):
+            stripped = line.strip()
+            is_code = stripped.startswith("//") and stripped[2:].strip().endswith((";", "{", "}"))
+            # Sonar reports one issue per block of commented-out lines
+            if is_code and not previous:
+                lines.append(number)
+            previous = is_code
+        return lines
+
+    def check_unused_import(self, text, file_path):
+        body = self.IMPORT_REGEX.sub("", text)
+        lines = []
+        for match in self.IMPORT_REGEX.finditer(text):
+            name = match.group(2).rsplit(".", 1)[-1]
+            if name != "*" and not re.search(rf"\b{re.escape(name)}\b", body):
+                lines.append(self.line_of(text, match.start(2)))
+        return lines
+
+    def check_todo(self, text, file_path):
+        return self.regex_lines(re.compile(r"(//|/\*|^\s*\*).*\bTODO\b", re.MULTILINE), text)
+
+    def check_public_static_field(self, text, file_path):
+        regex = re.compile(r"^\s*(public\s+static|static\s+public)\s+(?!final\b)(?![^;=(]*\bfinal\b)[\w<>\[\], .?]+\s+\w+\s*(=|;)", re.MULTILINE)
+        return self.regex_lines(regex, text)
+
+    def check_package_path(self, text, file_path):
+        match = self.PACKAGE_REGEX.search(text)
+        if not match or not file_path:
+            return []
+        expected = match.group(1).replace(".", os.sep)
+        if os.path.dirname(os.path.abspath(file_path)).endswith(os.sep + expected):
+            return []
+        return [self.line_of(text, match.start())]
+
+    def check_diamond(self, text, file_path):
+        return self.regex_lines(re.compile(r"=\s*new\s+[\w.]+\s*<\s*[\w.?]+(\s*,\s*[\w.?<>]+)*\s*>\s*\("), text)
+
+    def verify_fix(self, file_path, issues, before_text, after_text):
+        """
+        Compare findings before and after a fix, by rule and line.
+        Returns (passed, resolved issue keys, reason). A fix fails if it introduces new
+        findings for any supported rule, or if every targeted issue is checkable locally
+        and none of them went away.
+        """
+        before = self.check(before_text, file_path)
+        after = self.check(after_text, file_path)
+        for rule in self.rules:
+            before_count = sum(1 for finding in before if finding[0] == rule)
+            after_count = sum(1 for finding in after if finding[0] == rule)
+            if after_count > before_count:
+                return False, set(), f"{rule} findings went from {before_count} to {after_count}"
+        supported = [issue for issue in issues if self.supports(issue.get('rule'))]
+        rules = {issue['rule'] for issue in supported}
+        if not rules:
+            return True, set(), "no locally checkable rules"
+        resolved = set()
+        for rule in sorted(rules):
+            before_count = sum(1 for finding in before if finding[0] == rule)
+            after_count = sum(1 for finding in after if finding[0] == rule)
+            remaining_lines = {line for finding_rule, line in after if finding_rule == rule}
+            rule_issues = [issue for issue in supported if issue['rule'] == rule]
+            # Issues whose line no longer has a finding are resolved, capped by how many findings disappeared
+            fixed = [issue for issue in rule_issues if (issue.get('line') or (issue.get('textRange') or {}).get('startLine')) not in remaining_lines]
+            resolved.update(issue['key'] for issue in fixed[:before_count - after_count])
+        if len(supported) == len(issues) and not resolved:
+            return False, set(), "none of the targeted issues were resolved"
+        return True, resolved, f"{len(resolved)} of {len(supported)} locally checkable issues resolved"
+
+class FixScheduler:
+    """
+    Decouples fix throughput from SonarCloud analysis. Issues are pulled from the queue
+    and fixed batch_size at a time; with group_key (an issue's file) a batch is only cut
+    where the key changes, so consecutive issues of one file are fixed by one request
+    instead of being split across two. Fixes are committed once commit_size issues are
+    pending or commit_interval seconds have passed, and a scan is only triggered once
+    scan_every_commits commits have built up or the queue has run dry.
+    Callbacks:
+        fix_batch(issues)  - apply fixes for a batch of issues
+        commit(issues)     - commit and push the fixes for these issues
+        scan()             - run an analysis; return False to stop the run
+    """
+    def __init__(self, fix_batch, commit, scan, batch_size=5, commit_size=25, commit_interval=600, scan_every_commits=4, group_key=None):
+        self.fix_batch = fix_batch
+        self.commit = commit
+        self.scan = scan
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.scan_every_commits = scan_every_commits
+        self.group_key = group_key
+        # Issues pulled from the queue but not handed to fix_batch yet
+        self.held = 0
+        self.uncommitted = []
+        self.last_commit = time.monotonic()
+        self.commits_since_scan = 0
+        self.scans = 0
+
+    def run(self, issues):
+        """
+        Fix every issue from the iterable. Returns False if a scan asked to stop.
+        """
+        for batch in self.batches(issues):
+            self.fix_batch(batch)
+            self.uncommitted.extend(batch)
+            if len(self.uncommitted) >= self.commit_size or time.monotonic() - self.last_commit >= self.commit_interval:
+                self.flush_commit()
+            if self.commits_since_scan >= self.scan_every_commits:
+                if not self.run_scan():
+                    return False
+        # Queue is empty: commit what is left and scan once for the next round
+        self.flush_commit()
+        if self.commits_since_scan:
+            return self.run_scan()
+        return True
+
+    def batches(self, issues):
+        batch = []
+        for issue in issues:
+            if len(batch) >= self.batch_size and (self.group_key is None or self.group_key(issue) != self.group_key(batch[-1])):
+                # The issue that ends a batch waits for the next one
+                self.held = 1
+                yield batch
+                batch = []
+            self.held = 0
+            batch.append(issue)
+        if batch:
+            yield batch
+
+    def flush_commit(self):
+        if not self.uncommitted:
+            return
+        self.commit(self.uncommitted)
+        self.uncommitted = []
+        self.last_commit = time.monotonic()
+        self.commits_since_scan += 1
+
+    def run_scan(self):
+        self.commits_since_scan = 0
+        self.scans += 1
+        return self.scan() is not False
+
+class IssuePrioritizer:
+    """
+    Reorders the issue queue so the batches clear as much technical debt as possible
+    per model token. Issues are grouped by file, because one request fixes every issue
+    of a file, and files are ranked by expected value per token:
+        value = sum over the file's issues of
+                P(fix passes | rule) * effort minutes * (1 + severity rank)
+        cost  = REQUEST_OVERHEAD_TOKENS + tokens to send and rewrite the file (from its
+                size), or WINDOW_TOKENS per issue when windowed fixes are cheaper
+    P(fix passes | rule) is the rule's share of applied fixes in the fix history
+    (DatabaseManager.fix_success_by_rule), smoothed towards the overall rate so rules
+    with few attempts are not written off. Rules with at least min_attempts attempts and
+    a rate below skip_below are skipped, except for up to probe_issues issues per rule per
+    run, so a rule whose fixes start passing (e.g. with a newer model) can recover.
+    The queue is ranked lookahead issues at a time, so fixing starts before the whole
+    queue has been fetched.
+    """
+    REQUEST_OVERHEAD_TOKENS = 400
+    WINDOW_TOKENS = 1000
+    DEFAULT_EFFORT_MINUTES = 5
+    PRIOR_WEIGHT = 5  # Attempts' worth of weight given to the overall success rate
+    EFFORT_REGEX = re.compile(r"(\d+)\s*(d|h|min)")
+    EFFORT_UNITS = {"d": 8 * 60, "h": 60, "min": 1}  # Sonar counts a day of effort as 8 hours
+
+    def __init__(self, planner, history, file_size, lookahead=1000, min_attempts=10, skip_below=0.05, probe_issues=5, probes=None):
+        """
+        Args:
+            planner (PromptPlanner): Source of severity ranks and token estimates.
+            history (dict): {rule: (attempts, successes, tokens)} from fix_success_by_rule().
+            file_size (callable): Returns the size in bytes of an issue's file, or None if it is missing.
+            probes (Counter, optional): Probe issues let through per skipped rule; pass the
+                same Counter to every prioritizer of a run to probe once per run.
+        """
+        self.planner = planner
+        self.history = history
+        self.file_size = file_size
+        self.lookahead = lookahead
+        self.min_attempts = min_attempts
+        self.skip_below = skip_below
+        self.probe_issues = probe_issues
+        self.probes = probes if probes is not None else collections.Counter()
+        attempts = sum(entry[0] for entry in history.values())
+        successes = sum(entry[1] for entry in history.values())
+        self.prior = (successes + 1) / (attempts + 2)
+        self.skipped = collections.Counter()
+
+    def success_rate(self, rule):
+        attempts, successes, tokens = self.history.get(rule, (0, 0, 0))
+        return (successes + self.PRIOR_WEIGHT * self.prior) / (attempts + self.PRIOR_WEIGHT)
+
+    def skips(self, rule):
+        attempts, successes, tokens = self.history.get(rule, (0, 0, 0))
+        return attempts >= self.min_attempts and successes / attempts < self.skip_below
+
+    def effort_minutes(self, issue):
+        # SonarCloud reports 'effort' ("1h 30min"); older servers call it 'debt'
+        text = str(issue.get('effort') or issue.get('debt') or "")
+        minutes = sum(int(amount) * self.EFFORT_UNITS[unit] for amount, unit in self.EFFORT_REGEX.findall(text))
+        return minutes or self.DEFAULT_EFFORT_MINUTES
+
+    def issue_value(self, issue):
+        return self.success_rate(issue.get('rule')) * self.effort_minutes(issue) * (1 + self.planner.issue_rank([issue]))
+
+    def file_cost(self, size, issue_count):
+        file_tokens = size // self.planner.CHARS_PER_TOKEN + 1
+        rewrite = file_tokens + max(self.planner.MIN_OUTPUT_TOKENS, int(file_tokens * 1.3) + 256)
+        return self.REQUEST_OVERHEAD_TOKENS + min(rewrite, issue_count * self.WINDOW_TOKENS)
+
+    def rank(self, issues):
+        """
+        Return the issues ordered file by file, best expected value per token first.
+        """
+        by_file = {}
+        for issue in issues:
+            rule = issue.get('rule')
+            if self.skips(rule):
+                if self.probes[rule] >= self.probe_issues:
+                    self.skipped[rule] += 1
+                    continue
+                self.probes[rule] += 1
+            by_file.setdefault(issue['component'], []).append(issue)
+        ranked = []
+        for component, file_issues in by_file.items():
+            size = self.file_size(file_issues[0])
+            values = {issue['key']: self.issue_value(issue) for issue in file_issues}
+            # Files that are gone cannot be fixed; keep them last
+            score = sum(values.values()) / self.file_cost(size, len(file_issues)) if size is not None else 0.0
+            ranked.append((score, sorted(file_issues, key=lambda issue: values[issue['key']], reverse=True)))
+        ranked.sort(key=lambda entry: entry[0], reverse=True)
+        return [issue for score, file_issues in ranked for issue in file_issues]
+
+    def prioritize(self, issues):
+        """
+        Yield the issues of an iterable in priority order, ranking lookahead issues at a time.
+        """
+        issues = iter(issues)
+        while True:
+            chunk = list(itertools.islice(issues, self.lookahead))
+            if not chunk:
+                return
+            yield from self.rank(chunk)
+
+def run_sonar_scanner(repo_path):
+    """
+    Run the SonarScanner CLI in the repo directory. Returns True on success.
+    The task id of the new analysis is then in .scannerwork/report-task.txt (see read_report_task).
+    """
+    # A report left over from an earlier run must never be mistaken for this one
+    report_path = os.path.join(repo_path, ".scannerwork", "report-task.txt")
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    try:
+        with shared_slot(SCAN_SLOTS), METRICS.span("scan"):
+            subprocess.run(["sonar-scanner"], cwd=repo_path, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        print("[Done] SonarScanner CLI completed.", flush=True)
+        return True
+    except FileNotFoundError:
+        print("[Error] sonar-scanner CLI not found. Please install SonarScanner CLI and ensure it is in your PATH.", flush=True)
+        return False
+    except subprocess.CalledProcessError as e:
+        print(f"[Error] SonarScanner CLI failed: {e}", flush=True)
+        if e.stderr:
+            print("[SonarScanner stderr output]:\n" + e.stderr, flush=True)
+        return False
+
+def read_report_task(repo_path):
+    """
+    Return the key=value pairs of .scannerwork/report-task.txt (ceTaskId, ceTaskUrl, ...),
+    or an empty dict if the scanner did not write it.
+    """
+    report_path = os.path.join(repo_path, ".scannerwork", "report-task.txt")
+    if not os.path.exists(report_path):
+        return {}
+    with open(report_path, encoding="utf-8") as f:
+        return dict(line.strip().split("=", 1) for line in f if "=" in line)
+
+def prefetch_iter(iterable, depth=2):
+    """
+    Consume an iterable in a background thread, keeping up to `depth` items ready.
+    Exceptions raised by the iterable are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(done)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
 def get_env_or_prompt(env_var_name, prompt_message):
     """Get environment variable or prompt user for input if it doesn't exist."""
     value = os.getenv(env_var_name)
@@ -429,44 +3186,134 @@ def get_env_or_prompt(env_var_name, prompt_message):
         return input(f"{prompt_message}: ")
 
 
-def main():
+def run_pipeline(repo_url, github_token, sonar_token, anthropic_api_key, local_dir, db_path="issues.db", export_path="issues_export.csv", resume=True,
+                 metrics_path=None, trace_path=None):
+    """
+    Run the fork -> clone -> build -> scan -> fix pipeline for one repository.
+    Every stage records a checkpoint in db_path; with resume=True an interrupted run
+    continues after the last completed stage, reusing the clone and build outputs.
+    Stage timings and counters are written to metrics_path (OpenMetrics text) and
+    trace_path (Chrome trace JSON), by default next to export_path, also when the
+    run fails or is stopped.
+    Returns the fork's clone URL, or None if the run stopped early.
+    """
+    export_base = os.path.splitext(export_path)[0]
+    metrics_path = metrics_path or f"{export_base}_metrics.txt"
+    trace_path = trace_path or f"{export_base}_trace.json"
+    METRICS.reset()
+    try:
+        with METRICS.span("pipeline", repo=repo_url):
+            return run_pipeline_stages(repo_url, github_token, sonar_token, anthropic_api_key, local_dir, db_path, export_path, resume)
+    finally:
+        try:
+            METRICS.write_openmetrics(metrics_path, labels={"repo": repo_url})
+            METRICS.write_chrome_trace(trace_path)
+            print(f"[Info] Wrote run metrics to {metrics_path} and a trace to {trace_path}", flush=True)
+        except OSError as e:
+            print(f"[Warning] Could not write run metrics: {e}", flush=True)
+
+def run_pipeline_stages(repo_url, github_token, sonar_token, anthropic_api_key, local_dir, db_path, export_path, resume):
+    """
+    The stages of run_pipeline, each timed with a METRICS span.
+    """
     # TOGGLE: Set to True for full build check, False for syntax check only
     USE_BUILD_CHECK = True
-    GITHUB_TOKEN = get_env_or_prompt("GITHUB_TOKEN", "Enter your GitHub token")
-    SONAR_TOKEN = get_env_or_prompt("SONAR_TOKEN", "Enter your SonarQube token")
-    ANTHROPIC_API_KEY = get_env_or_prompt("ANTHROPIC_API_KEY", "Enter your Anthropic API key")
-    LOCAL_DIR = os.environ['TMPDIR'] + "CQE"
-    REPO_URL =  input("Enter the GitHub repository URL: ")
     MAX_ITERATIONS = 30
     ISSUE_THRESHOLD = 10
-    DB_PATH = "issues.db"
     ORGANIZATION = "jayak-patel"  # SonarCloud organization key (change as needed)
+    SONAR_HOST_URL = os.getenv("SONAR_HOST_URL", "https://sonarcloud.io")  # Override to use a local SonarQube or mock
+    SONAR_WEBHOOK_URL = os.getenv("SONAR_WEBHOOK_URL")  # Optional: public URL of the local analysis webhook receiver
+    SONAR_WEBHOOK_PORT = int(os.getenv("SONAR_WEBHOOK_PORT", "8765"))
+    GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")  # Override for GitHub Enterprise or a mock
+    # "incremental" re-scans only the files changed since the last analysis (as a SonarCloud
+    # branch, which needs branch analysis on the plan); "full" re-analyzes the whole checkout.
+    # Falls back to full scans if a scoped analysis fails.
+    SCAN_MODE = "incremental"
+    SCOPED_BRANCH = "cqe-scoped"
+    FULL_SCAN_EVERY = 10  # Full scan after this many scoped scans, to pick up cross-file effects
+    MAX_SCOPED_FILES = 500  # Diffs touching more files than this get a full scan
 
     
-    github_manager = GitHubRepoManager(GITHUB_TOKEN, LOCAL_DIR)
-    sonar_analyzer = SonarCloudAnalyzer(SONAR_TOKEN)
-    issue_processor = IssueProcessor(ANTHROPIC_API_KEY)
-    db_manager = DatabaseManager(DB_PATH)
+    # One pooled, rate-limited HTTP session shared by the GitHub and SonarCloud clients
+    http_transport = HttpTransport(pool_connections=4, pool_maxsize=16)
+    # Clone options (off by default): CLONE_DEPTH=1 for a shallow clone, CLONE_FILTER="blob:none"
+    # for a partial clone; MIRROR_DIR (e.g. os.path.join(local_dir, ".mirrors")) keeps bare mirrors
+    # across runs so repeat runs only fetch new objects. The trade-off: SonarScanner's SCM blame
+    # needs full history in a plain checkout, so any of them turns it off (sonar.scm.disabled) and
+    # issues lose their author and new-code detection.
+    CLONE_DEPTH = None
+    CLONE_FILTER = None
+    MIRROR_DIR = None
+    github_manager = GitHubRepoManager(github_token, local_dir, transport=http_transport,
+                                       clone_depth=CLONE_DEPTH, clone_filter=CLONE_FILTER, mirror_dir=MIRROR_DIR,
+                                       api_url=GITHUB_API_URL)
+    sonar_analyzer = SonarCloudAnalyzer(sonar_token, transport=http_transport, base_url=SONAR_HOST_URL)
+    db_manager = DatabaseManager(db_path)
+    # Set replay=True to reuse fixes from earlier runs without calling the model
+    fix_cache = FixCache(db_path, max_entries=5000, replay=False)
+    # Chooses the model and max_tokens per request by file size and issue severity.
+    # Set MAX_MODEL_SPEND_USD to stop calling the model once the estimated spend reaches it.
+    MAX_MODEL_SPEND_USD = None
+    # "interactive" calls the model per request; "batch" submits each batch of issues as one
+    # Message Batches job (slower, half the price; for overnight runs). CQE_FIX_BACKEND overrides it.
+    FIX_BACKEND = os.getenv("CQE_FIX_BACKEND", "interactive")
+    if FIX_BACKEND not in ("interactive", "batch"):
+        raise ValueError(f"Unsupported fix backend: {FIX_BACKEND}. Use 'interactive' or 'batch'.")
+    # Model tiers: PromptPlanner.DEFAULT_TIERS, or the JSON list in CQE_MODEL_TIERS
+    prompt_planner = PromptPlanner.from_env(budget_usd=MAX_MODEL_SPEND_USD)
+    issue_processor = IssueProcessor(anthropic_api_key, max_concurrency=4, cache=fix_cache, planner=prompt_planner)
 
     # --- Signal handler to export issues.db on forced stop ---
     def export_on_exit(signum, frame):
         print(f"\n[Signal] Received signal {signum}. Exporting issues to CSV before exit...", flush=True)
         try:
-            db_manager.export_issues_to_csv("issues_export.csv")
+            db_manager.export_issues_to_csv(export_path)
         except Exception as e:
             print(f"[Error] Failed to export issues: {e}", flush=True)
         finally:
+            print("[Info] Progress is checkpointed; run again to resume.", flush=True)
             exit(0)
     signal.signal(signal.SIGINT, export_on_exit)
     signal.signal(signal.SIGTERM, export_on_exit)
 
+    # --- Checkpoints: skip stages a previous, interrupted run already completed ---
+    run_key = repo_url
+    checkpoints = db_manager.load_checkpoints(run_key) if resume else {}
+    if not checkpoints or checkpoints['last']['status'] == "done":
+        db_manager.clear_checkpoints(run_key)
+        checkpoints = {}
+    else:
+        print(f"[Info] Resuming {repo_url} after stage '{checkpoints['last']['stage']}'.", flush=True)
+    local_path = None
+
+    def checkpoint(stage, status="completed", queue_position=None, data=None):
+        commit_sha = github_manager.head_commit(local_path) if local_path else None
+        db_manager.save_checkpoint(run_key, stage, status=status, commit_sha=commit_sha, queue_position=queue_position, data=data)
 
     # Fork and clone the repository
-    forked_clone_url = github_manager.fork_repo(REPO_URL)
-    local_path = github_manager.clone_repo(forked_clone_url, force_delete=True)
+    if "fork" in checkpoints:
+        forked_clone_url = checkpoints["fork"]["data"]["clone_url"]
+        print(f"[Info] Reusing fork {forked_clone_url}", flush=True)
+    else:
+        with METRICS.span("fork"):
+            forked_clone_url = github_manager.fork_repo(repo_url)
+        checkpoint("fork", data={"clone_url": forked_clone_url})
+    clone_checkpoint = checkpoints.get("clone")
+    reuse_clone = clone_checkpoint is not None and os.path.isdir(os.path.join(clone_checkpoint["data"]["local_path"], ".git"))
+    with METRICS.span("clone", reuse=reuse_clone):
+        local_path = github_manager.clone_repo(forked_clone_url, force_delete=not reuse_clone)
+    if not reuse_clone:
+        # A fresh checkout invalidates everything recorded after the fork
+        checkpoints = {stage: cp for stage, cp in checkpoints.items() if stage == "fork"}
+        checkpoint("clone", data={"local_path": local_path})
+    elif checkpoints["last"]["commit_sha"]:
+        # Model output written after the last checkpoint was never verified; go back
+        # to the commit the checkpoint recorded so it is not committed and pushed
+        print(f"[Info] Restoring {local_path} to checkpointed commit {checkpoints['last']['commit_sha'][:12]}.", flush=True)
+        github_manager.restore_checkout(local_path, checkpoints["last"]["commit_sha"])
 
     # Parse repo name from URL
-    parsed = urlparse(REPO_URL)
+    parsed = urlparse(repo_url)
     path_parts = parsed.path.strip("/").split("/")
     if len(path_parts) != 2:
         raise ValueError("Invalid GitHub repository URL format.")
@@ -475,162 +3322,138 @@ def main():
 
 
     # Create SonarCloud project (if not exists)
-    sonar_analyzer.create_project(project_key, repo, organization=ORGANIZATION, visibility="private")
-
-    # Detect if Java files exist
-    print("[Stage] Scanning for Java files ...", flush=True)
-    t0 = time.time()
-    java_files = []
-    for root, dirs, files in os.walk(local_path):
-        for file in files:
-            if file.endswith('.java'):
-                java_files.append(os.path.join(root, file))
-    print(f"[Done] Found {len(java_files)} Java files in {time.time() - t0:.2f}s.", flush=True)
+    with METRICS.span("create_project"):
+        sonar_analyzer.create_project(project_key, repo, organization=ORGANIZATION, visibility="private")
+
+    # Index the checkout once; later stages look files up here instead of walking it again
+    print("[Stage] Indexing repository files ...", flush=True)
+    with METRICS.span("index"):
+        file_index = FileIndex(local_path).scan()
+    java_files = file_index.files_with_extension(".java")
+    languages = ", ".join(f"{ext} {count}" for ext, count in file_index.language_counts.most_common(5))
+    print(f"[Done] Found {len(java_files)} Java files (top file types: {languages or 'none'}).", flush=True)
 
     sonar_binaries = []
+    # Reuse the previous build if its class directories are still there
+    build_checkpoint = checkpoints.get("build")
+    if build_checkpoint and all(os.path.isdir(d) for d in build_checkpoint["data"]["binaries"]):
+        sonar_binaries = build_checkpoint["data"]["binaries"]
+        print(f"[Info] Reusing build outputs from the previous run ({len(sonar_binaries)} binary directories).", flush=True)
+    else:
+        build_checkpoint = None
+    if java_files and build_checkpoint is None:
+        with METRICS.span("build"):
+            print("[Stage] Java files detected. Attempting to build project for SonarCloud analysis...", flush=True)
+            t0 = time.time()
+            gradle_build_file = os.path.join(local_path, 'build.gradle')
+            maven_build_file = os.path.join(local_path, 'pom.xml')
+            gradle_wrapper = os.path.join(local_path, 'gradlew')
+            maven_wrapper = os.path.join(local_path, 'mvnw')
+            build_success = False
+
+            if os.path.exists(gradle_build_file):
+                gradle_cmds = []
+                if os.path.exists(gradle_wrapper):
+                    gradle_cmds.append(["./gradlew", "build"])
+                gradle_cmds.append(["gradle", "build"])
+                for cmd in gradle_cmds:
+                    try:
+                        subprocess.run(cmd, cwd=local_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                        build_success = True
+                        print(f"[Done] Gradle build succeeded with: {' '.join(cmd)} in {time.time() - t0:.2f}s.", flush=True)
+                        break
+                    except Exception:
+                        pass
+                gradle_patterns = [
+                    ["build", "classes", "java", "main"],
+                    ["build", "classes", "main"],
+                    ["build", "classes"]
+                ]
+                gradle_binaries = file_index.binary_dirs(gradle_patterns)
+                if gradle_binaries:
+                    sonar_binaries.extend(gradle_binaries)
+            elif os.path.exists(maven_build_file):
+                maven_cmds = []
+                if os.path.exists(maven_wrapper):
+                    maven_cmds.append(["./mvnw", "clean", "compile"])
+                maven_cmds.append(["mvn", "clean", "compile"])
+                for cmd in maven_cmds:
+                    try:
+                        subprocess.run(cmd, cwd=local_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                        build_success = True
+                        print(f"[Done] Maven build succeeded with: {' '.join(cmd)} in {time.time() - t0:.2f}s.", flush=True)
+                        break
+                    except Exception:
+                        pass
+                maven_patterns = [["target", "classes"]]
+                maven_binaries = file_index.binary_dirs(maven_patterns)
+                if maven_binaries:
+                    sonar_binaries.extend(maven_binaries)
+            else:
+                print("[Info] No supported Java build system (Gradle or Maven) found. Please build manually and set sonar.java.binaries.", flush=True)
+            if not build_success:
+                print("[Info] Java build failed or not found. SonarScanner will likely fail unless binaries are provided.", flush=True)
+            # Only keep existing directories that end with 'classes' or a valid Java binary dir
+            valid_binary_suffixes = (os.sep + "classes", os.sep + "classes" + os.sep, os.sep + "main", os.sep + "main" + os.sep)
+            filtered_binaries = []
+            for d in sonar_binaries:
+                if os.path.isdir(d) and (d.endswith("classes") or d.endswith("classes" + os.sep) or d.endswith("main") or d.endswith("main" + os.sep)):
+                    filtered_binaries.append(d)
+                else:
+                    print(f"[Warning] Skipping invalid sonar.java.binaries path: {d}", flush=True)
+            sonar_binaries = filtered_binaries
+            if not sonar_binaries:
+                print("[Info] No valid sonar.java.binaries directories found. Not setting property.", flush=True)
+
+    # Verifies fixed files incrementally instead of a clean build per file.
+    # With USE_BUILD_CHECK off, only the touched files are compiled with javac.
+    build_verifier = BuildVerifier(local_path, strategy="auto" if USE_BUILD_CHECK else "javac", binary_dirs=sonar_binaries)
     if java_files:
-        print("[Stage] Java files detected. Attempting to build project for SonarCloud analysis...", flush=True)
-        t0 = time.time()
-        gradle_build_file = os.path.join(local_path, 'build.gradle')
-        maven_build_file = os.path.join(local_path, 'pom.xml')
-        gradle_wrapper = os.path.join(local_path, 'gradlew')
-        maven_wrapper = os.path.join(local_path, 'mvnw')
-        build_success = False
-
-        def find_all_binaries(root, patterns):
-            matches = []
-            for dirpath, dirnames, filenames in os.walk(root):
-                for pattern in patterns:
-                    candidate = os.path.join(dirpath, *pattern)
-                    if os.path.isdir(candidate):
-                        matches.append(candidate)
-            return matches
-
-        if os.path.exists(gradle_build_file):
-            gradle_cmds = []
-            if os.path.exists(gradle_wrapper):
-                gradle_cmds.append(["./gradlew", "build"])
-            gradle_cmds.append(["gradle", "build"])
-            for cmd in gradle_cmds:
-                try:
-                    subprocess.run(cmd, cwd=local_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    build_success = True
-                    print(f"[Done] Gradle build succeeded with: {' '.join(cmd)} in {time.time() - t0:.2f}s.", flush=True)
-                    break
-                except Exception:
-                    pass
-            gradle_patterns = [
-                ["build", "classes", "java", "main"],
-                ["build", "classes", "main"],
-                ["build", "classes"]
-            ]
-            gradle_binaries = find_all_binaries(local_path, gradle_patterns)
-            if gradle_binaries:
-                sonar_binaries.extend(gradle_binaries)
-        elif os.path.exists(maven_build_file):
-            maven_cmds = []
-            if os.path.exists(maven_wrapper):
-                maven_cmds.append(["./mvnw", "clean", "compile"])
-            maven_cmds.append(["mvn", "clean", "compile"])
-            for cmd in maven_cmds:
-                try:
-                    subprocess.run(cmd, cwd=local_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    build_success = True
-                    print(f"[Done] Maven build succeeded with: {' '.join(cmd)} in {time.time() - t0:.2f}s.", flush=True)
-                    break
-                except Exception:
-                    pass
-            maven_patterns = [["target", "classes"]]
-            maven_binaries = find_all_binaries(local_path, maven_patterns)
-            if maven_binaries:
-                sonar_binaries.extend(maven_binaries)
+        if build_checkpoint and build_checkpoint["data"].get("classpath") is not None:
+            build_verifier.classpath = build_checkpoint["data"]["classpath"]
+            build_verifier.test_classpath = build_checkpoint["data"].get("test_classpath")
         else:
-            print("[Info] No supported Java build system (Gradle or Maven) found. Please build manually and set sonar.java.binaries.", flush=True)
-        if not build_success:
-            print("[Info] Java build failed or not found. SonarScanner will likely fail unless binaries are provided.", flush=True)
-        # Only keep existing directories that end with 'classes' or a valid Java binary dir
-        valid_binary_suffixes = (os.sep + "classes", os.sep + "classes" + os.sep, os.sep + "main", os.sep + "main" + os.sep)
-        filtered_binaries = []
-        for d in sonar_binaries:
-            if os.path.isdir(d) and (d.endswith("classes") or d.endswith("classes" + os.sep) or d.endswith("main") or d.endswith("main" + os.sep)):
-                filtered_binaries.append(d)
-            else:
-                print(f"[Warning] Skipping invalid sonar.java.binaries path: {d}", flush=True)
-        sonar_binaries = filtered_binaries
-        if not sonar_binaries:
-            print("[Info] No valid sonar.java.binaries directories found. Not setting property.", flush=True)
+            with METRICS.span("classpath"):
+                build_verifier.prepare()
+    if build_checkpoint is None:
+        checkpoint("build", data={"binaries": sonar_binaries, "classpath": build_verifier.classpath,
+                                  "test_classpath": build_verifier.test_classpath})
 
     # Generate sonar-project.properties in the repo directory
     sonar_properties_path = os.path.join(local_path, "sonar-project.properties")
-    with open(sonar_properties_path, "w") as sonar_prop:
-        sonar_prop.write(f"""
+
+    def write_sonar_properties(inclusions=None):
+        # With inclusions, only those files are analyzed, as the SCOPED_BRANCH branch
+        with open(sonar_properties_path, "w") as sonar_prop:
+            sonar_prop.write(f"""
 sonar.projectKey={project_key}
 sonar.organization={ORGANIZATION}
-sonar.host.url=https://sonarcloud.io
-sonar.token={SONAR_TOKEN}
+sonar.host.url={SONAR_HOST_URL}
+sonar.token={sonar_token}
 sonar.sources=.
+sonar.analysisCache.enabled=true
 sonar.exclusions=**/node_modules/**,**/build/**,**/dist/**,**/out/**,**/.scannerwork/**,**/target/**,**/.git/**,**/.idea/**,**/.vscode/**,**/venv/**,**/__pycache__/**,**/.DS_Store,**/tmp/**,**/temp/**,**/var/**,**/System/**,**/Library/**,**/com.apple.*/**,**/Store/**,**/.*/**
 """)
-        # Only write sonar.java.binaries if there are valid directories
-        if sonar_binaries:
-            sonar_prop.write(f"sonar.java.binaries={','.join(sonar_binaries)}\n")
-    print(f"[Stage] Created sonar-project.properties at {sonar_properties_path}", flush=True)
-
-    # Run SonarScanner CLI in the repo directory
-    print("[Stage] Running SonarScanner CLI...", flush=True)
-    try:
-        result = subprocess.run(["sonar-scanner"], cwd=local_path, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        print("[Done] SonarScanner CLI completed.", flush=True)
-    except FileNotFoundError:
-        print("[Error] sonar-scanner CLI not found. Please install SonarScanner CLI and ensure it is in your PATH.", flush=True)
-        return
-    except subprocess.CalledProcessError as e:
-        print(f"[Error] SonarScanner CLI failed: {e}", flush=True)
-        if e.stderr:
-            print("[SonarScanner stderr output]:\n" + e.stderr, flush=True)
-        return
-
-    # Wait for SonarCloud analysis to complete (exponential backoff)
-    delay = 5
-    max_delay = 120
-    analysis_complete = False
-    while not analysis_complete:
-        try:
-            analysis_results = sonar_analyzer.analyze_repo(project_key)
-            issues = analysis_results.get('issues', [])
-            if len(issues) > 0:
-                print(f"[Done] Analysis complete: issues found ({len(issues)})", flush=True)
-                break
-            ce_url = f"https://sonarcloud.io/api/ce/component"
-            params = {"component": project_key}
-            ce_response = requests.get(ce_url, headers=sonar_analyzer.headers, params=params)
-            if ce_response.status_code == 200:
-                ce_data = ce_response.json()
-                queue = ce_data.get('queue', [])
-                current = ce_data.get('current', {})
-                if current and current.get('status') == 'SUCCESS':
-                    print("[Done] SonarCloud analysis completed successfully.", flush=True)
-                    break
-                elif current and current.get('status') == 'FAILED':
-                    print("[Error] SonarCloud analysis failed.", flush=True)
-                    break
-                else:
-                    print(f"[Stage] Analysis in progress (status: {current.get('status', 'UNKNOWN')}). Waiting {delay} seconds...", flush=True)
-            else:
-                print(f"[Error] Error checking analysis status: {ce_response.status_code} - {ce_response.text}", flush=True)
-        except Exception as e:
-            print(f"[Error] Waiting for SonarCloud analysis to complete: {e}", flush=True)
-        time.sleep(delay)
-        delay = min(delay * 2, max_delay)
+            # Only write sonar.java.binaries if there are valid directories
+            if sonar_binaries:
+                sonar_prop.write(f"sonar.java.binaries={','.join(sonar_binaries)}\n")
+            if CLONE_DEPTH or CLONE_FILTER or MIRROR_DIR:
+                # Blame would fail (or fetch every blob) on shallow, partial or worktree checkouts
+                sonar_prop.write("sonar.scm.disabled=true\n")
+            if inclusions is not None:
+                sonar_prop.write(f"sonar.branch.name={SCOPED_BRANCH}\n")
+                sonar_prop.write(f"sonar.inclusions={','.join(inclusions)}\n")
 
+    write_sonar_properties()
+    print(f"[Stage] Created sonar-project.properties at {sonar_properties_path}", flush=True)
 
     def wait_for_sonarcloud_analysis(project_key, sonar_analyzer, max_delay=120):
         delay = 5
         while True:
             try:
-                ce_url = f"https://sonarcloud.io/api/ce/component"
+                ce_url = f"{sonar_analyzer.base_url}/api/ce/component"
                 params = {"component": project_key}
-                ce_response = requests.get(ce_url, headers=sonar_analyzer.headers, params=params)
+                ce_response = sonar_analyzer.transport.get(ce_url, headers=sonar_analyzer.headers, params=params)
                 if ce_response.status_code == 200:
                     ce_data = ce_response.json()
                     current = ce_data.get('current', {})
@@ -649,24 +3472,305 @@ sonar.exclusions=**/node_modules/**,**/build/**,**/dist/**,**/out/**,**/.scanner
             time.sleep(delay)
             delay = min(delay * 2, max_delay)
 
+    def wait_for_scan():
+        # Track the analysis of this scanner run by its task id; the project-level
+        # queue is only a fallback for scanners that write no report-task.txt
+        # Returns False if the analysis is known to have failed
+        task_id = read_report_task(local_path).get("ceTaskId")
+        if not task_id:
+            print("[Warning] No ceTaskId in .scannerwork/report-task.txt; waiting on the project's analysis queue instead.", flush=True)
+            with METRICS.span("ce_wait"):
+                wait_for_sonarcloud_analysis(project_key, sonar_analyzer)
+            return True
+        with METRICS.span("ce_wait", task=task_id):
+            status = sonar_analyzer.wait_for_task(task_id, webhook=analysis_webhook)
+        if status != "SUCCESS":
+            print(f"[Error] SonarCloud analysis {task_id} ended with status {status}.", flush=True)
+            return False
+        return True
+
+    # --- Incremental scans: analyze only the files changed since the last analyzed commit ---
+    # Scoped analyses run as a separate SonarCloud branch, so the main branch keeps the issues
+    # of the files they leave out; their results are merged into a local issue view.
+    issue_view = IssueView() if SCAN_MODE == "incremental" else None
+    scan_state = {"analyzed_sha": None, "full_sha": None, "scoped_scans": 0}
+
+    def load_issue_view():
+        total = sonar_analyzer.count_issues(project_key)
+        with METRICS.span("fetch_issues", scope="full"):
+            issue_view.load(sonar_analyzer.iter_issues(project_key, slice_by="rules" if total > sonar_analyzer.MAX_RESULTS else None))
+        print(f"[Done] Loaded {issue_view.total()} issues into the local issue view.", flush=True)
+
+    def full_scan():
+        print("[Stage] Running SonarScanner CLI...", flush=True)
+        write_sonar_properties()
+        # A failed analysis leaves the issues of the last good one on SonarCloud, so the
+        # scan state is not advanced past it
+        if not run_sonar_scanner(local_path) or not wait_for_scan():
+            return False
+        scan_state["analyzed_sha"] = scan_state["full_sha"] = github_manager.head_commit(local_path)
+        scan_state["scoped_scans"] = 0
+        if issue_view is not None:
+            load_issue_view()
+        return True
+
+    def scoped_scan(since):
+        nonlocal issue_view
+        changed, deleted = GitRepo(local_path).changed_files(since)
+        changed = [path for path in changed if path != "sonar-project.properties"]
+        if not changed and not deleted:
+            print("[Info] No files changed since the last analysis; skipping the scan.", flush=True)
+            scan_state["analyzed_sha"] = since
+            return True
+        if (len(changed) > MAX_SCOPED_FILES or scan_state["scoped_scans"] >= FULL_SCAN_EVERY
+                or any("," in path for path in changed)):
+            return full_scan()
+        print(f"[Stage] Running a scoped SonarScanner analysis of {len(changed)} changed files...", flush=True)
+        write_sonar_properties(inclusions=changed)
+        if not run_sonar_scanner(local_path) or not wait_for_scan():
+            # e.g. a plan or server edition without branch analysis
+            print("[Warning] Scoped analysis failed; using full scans for the rest of this run.", flush=True)
+            issue_view = None
+            return full_scan()
+        components = [f"{project_key}:{path}" for path in changed + deleted]
+        with METRICS.span("fetch_issues", scope="scoped"):
+            issue_view.merge(components, sonar_analyzer.iter_issues(project_key, prefetch=0, filters={"branch": SCOPED_BRANCH}))
+        scan_state["analyzed_sha"] = github_manager.head_commit(local_path)
+        scan_state["scoped_scans"] += 1
+        METRICS.count("scoped_scan_files", len(changed))
+        print(f"[Done] Merged the analysis of {len(changed) + len(deleted)} files; {issue_view.total()} issues open.", flush=True)
+        return True
+
+    # Optional webhook receiver: SonarCloud calls it when an analysis finishes, so nothing is polled.
+    # SONAR_WEBHOOK_URL is the public URL that reaches the receiver on SONAR_WEBHOOK_PORT.
+    # In a multi-repository run each worker listens on SONAR_WEBHOOK_PORT + its index, and
+    # "{port}" in the URL is replaced by that port, so every worker registers its own receiver.
+    analysis_webhook = None
+    if SONAR_WEBHOOK_URL and WORKER_INDEX and "{port}" not in SONAR_WEBHOOK_URL:
+        print("[Info] SONAR_WEBHOOK_URL has no {port} placeholder, so only the first worker can receive webhooks; polling instead.", flush=True)
+    elif SONAR_WEBHOOK_URL:
+        webhook_secret = os.getenv("SONAR_WEBHOOK_SECRET")
+        webhook_port = SONAR_WEBHOOK_PORT + (WORKER_INDEX or 0) if SONAR_WEBHOOK_PORT else 0
+        try:
+            analysis_webhook = AnalysisWebhook(port=webhook_port, secret=webhook_secret).start()
+        except OSError as e:
+            print(f"[Warning] Could not start the webhook receiver on port {webhook_port} ({e}); polling instead.", flush=True)
+        if analysis_webhook is not None:
+            webhook_url = SONAR_WEBHOOK_URL.replace("{port}", str(analysis_webhook.port))
+            if not sonar_analyzer.ensure_webhook(project_key, webhook_url, secret=webhook_secret, organization=ORGANIZATION):
+                analysis_webhook.stop()
+                analysis_webhook = None
+
+    if "scan" in checkpoints:
+        print("[Info] Skipping the initial SonarScanner run; the previous run already analyzed this checkout.", flush=True)
+        scan_state["full_sha"] = checkpoints["scan"]["data"].get("full_sha")
+        if issue_view is not None:
+            # The main branch still holds the last full analysis; bring the view up to date
+            # with the checkout, which makes skipping already handled issues unnecessary
+            load_issue_view()
+            if scan_state["full_sha"] and not scoped_scan(scan_state["full_sha"]):
+                return None
+    else:
+        # Run SonarScanner CLI in the repo directory
+        if not full_scan():
+            return None
+        checkpoint("scan", queue_position=0, data={"next_iteration": 0, "full_sha": scan_state["full_sha"]})
+
+    def record_attempts(file_path, issues_for_file, outcome, build_result):
+        usage = issue_processor.pop_usage(file_path)
+        issue_processor.settle_cached_fixes(file_path, outcome)
+        # An unchanged reply for a file an earlier request already fixed says nothing about
+        # the rule, and an issue is only counted once between scans; both would skew the
+        # success rates IssuePrioritizer ranks by
+        if outcome == "no_change" and file_path in fixed_files:
+            issues_for_file = []
+        issues_for_file = [issue for issue in issues_for_file if issue['key'] not in recorded_attempts]
+        if outcome == "applied":
+            fixed_files.add(file_path)
+        if not issues_for_file:
+            return
+        recorded_attempts.update(issue['key'] for issue in issues_for_file)
+        METRICS.count(f"fixes_{outcome}")
+        db_manager.record_fix_attempts(issues_for_file, usage["model"], usage["input_tokens"], usage["output_tokens"], outcome, build_result)
+
+    def record_dead_letters(file_path):
+        # Requests given up on are parked in the dead_letters table and not retried this run
+        for failure in issue_processor.pop_failures(file_path):
+            db_manager.record_dead_letters(failure["issues"], failure["error_type"], failure["error"], failure["attempts"])
+            dead_lettered.update(issue['key'] for issue in failure["issues"])
+            METRICS.count("dead_letters")
+
+    def apply_fixes(file_to_issues):
+        """
+        Generate fixes for all files in parallel, write them back in order, then verify
+        every changed file with one incremental build and revert the ones that broke it.
+        """
+        with METRICS.span("model_fixes", files=len(file_to_issues), backend=FIX_BACKEND):
+            if FIX_BACKEND == "batch":
+                fixed_contents = issue_processor.process_issues_batched(file_to_issues)
+            else:
+                fixed_contents = issue_processor.process_issues_concurrently(file_to_issues)
+        original_contents = {}
+        for file_path, issues_for_file in file_to_issues.items():
+            record_dead_letters(file_path)
+            file_content = fixed_contents[file_path]
+            if file_content is None:
+                print(f"No fix generated for {file_path}, leaving it unchanged.")
+                # Without any reply (dead-lettered, over budget, too long to rewrite) the
+                # attempt says nothing about the rule; fix_success_by_rule ignores it
+                outcome = "no_fix" if issue_processor.was_answered(file_path) else "request_failed"
+                record_attempts(file_path, issues_for_file, outcome, "skipped")
+                continue
+            with open(file_path, "r") as f:
+                original_content = f.read()
+            # Compare contents instead of running git status for every file
+            if file_content == original_content:
+                print(f"No change detected in {file_path}, skipping build/syntax check.")
+                record_attempts(file_path, issues_for_file, "no_change", "skipped")
+                continue
+            with open(file_path, "w") as f:
+                f.write(file_content)
+            original_contents[file_path] = original_content
+        if not original_contents:
+            return
+        # SAFETY CHECK: Build or Syntax, for the whole batch at once
+        with METRICS.span("verify", files=len(original_contents)):
+            verified = build_verifier.verify(list(original_contents))
+        for file_path, original_content in original_contents.items():
+            passed = verified[file_path]
+            build_result = {True: "passed", False: "failed", None: "skipped"}[passed]
+            if passed is False:
+                print(f"Build failed after AI fix for {file_path}, reverting changes.")
+                with open(file_path, "w") as f:
+                    f.write(original_content)
+                print(f"Reverted {file_path} to previous state due to failed build.")
+                record_attempts(file_path, file_to_issues[file_path], "reverted", build_result)
+                continue
+            # LOCAL CHECK: only files that pass the local rule checker go to the remote scan
+            with open(file_path, "r") as f:
+                fixed_content = f.read()
+            with METRICS.span("local_check", file=file_path):
+                local_pass, resolved, reason = local_checker.verify_fix(file_path, file_to_issues[file_path], original_content, fixed_content)
+            if not local_pass:
+                print(f"Local check failed after AI fix for {file_path} ({reason}), reverting changes.")
+                with open(file_path, "w") as f:
+                    f.write(original_content)
+                record_attempts(file_path, file_to_issues[file_path], "reverted_local", build_result)
+                continue
+            locally_resolved.update(resolved)
+            record_attempts(file_path, file_to_issues[file_path], "applied", build_result)
+
+    # Confirms fixes offline; issues it saw resolved are not retried before the next remote scan
+    local_checker = LocalRuleChecker()
+    locally_resolved = set()
+    dead_lettered = set()
+    # Files fixed and issues whose attempt was recorded since the last scan
+    fixed_files = set()
+    recorded_attempts = set()
+
+    # Position in the current issue stream, counted since the last scan
+    queue_position = 0
+    iteration = 0
+
+    def counted(stream):
+        nonlocal queue_position
+        for item in stream:
+            queue_position += 1
+            yield item
+
+    def fix_batch(batch):
+        # Group issues by file
+        file_to_issues = {}
+        for batch_issue in batch:
+            rel_path = batch_issue['component'].split(':')[-1]
+            file_path = os.path.join(local_path, rel_path)
+            # Files in pruned directories are not indexed, so fall back to the filesystem for them
+            if file_index.contains(rel_path) or os.path.exists(file_path):
+                file_to_issues.setdefault(file_path, []).append(batch_issue)
+        apply_fixes(file_to_issues)
+
+    # Fix batches are not checkpointed: their fixes are only safe once committed, so a
+    # resumed run continues from the last push
+    def commit_fixes(fixed_issues):
+        with METRICS.span("push", issues=len(fixed_issues)):
+            github_manager.commit_and_push_changes(local_path, f"Fix batch of {len(fixed_issues)} issues")
+        db_manager.insert_issues(fixed_issues)
+        checkpoint("push", queue_position=queue_position - scheduler.held, data={"iteration": iteration})
+
+    def rescan():
+        nonlocal queue_position
+        # Force SonarCloud analysis by running SonarScanner CLI again (only on the changed
+        # files in incremental mode); each scan also waits for its analysis to complete
+        if issue_view is not None and scan_state["analyzed_sha"]:
+            if not scoped_scan(scan_state["analyzed_sha"]):
+                return False
+        elif not full_scan():
+            return False
+        # The remote analysis is authoritative again from here on
+        locally_resolved.clear()
+        fixed_files.clear()
+        recorded_attempts.clear()
+        queue_position = 0
+        checkpoint("scan", queue_position=0, data={"next_iteration": iteration + 1, "full_sha": scan_state["full_sha"]})
+        return True
+
+    BATCH_SIZE = 500 if FIX_BACKEND == "batch" else 5  # Issues per model/verification batch (a whole page in batch mode)
+    COMMIT_SIZE = 25  # Commit once this many issues have been fixed...
+    COMMIT_INTERVAL = 600  # ...or after this many seconds
+    SCAN_EVERY_COMMITS = 10  # Re-scan after this many commits, or when the issue queue runs dry (fixes are checked locally first)
+    # Batches are cut on file boundaries, so one file's issues go to the model in one request
+    scheduler = FixScheduler(fix_batch, commit_fixes, rescan, batch_size=BATCH_SIZE, commit_size=COMMIT_SIZE,
+                             commit_interval=COMMIT_INTERVAL, scan_every_commits=SCAN_EVERY_COMMITS,
+                             group_key=lambda issue: issue['component'])
+
     IGNORE_ALREADY_FIXED_ISSUES = True  # Set to True to retry fixing all issues, even those already in DB
+    # Fix the issues with the most expected debt cleared per model token first (see IssuePrioritizer)
+    # instead of in SonarCloud's order; rules that almost never get a passing fix are skipped
+    PRIORITIZE_ISSUES = True
+
+    # Issues of rarely fixed rules that are still tried this run, so those rules can recover
+    rule_probes = collections.Counter()
 
-    for iteration in range(MAX_ITERATIONS):
+    def issue_file_size(issue):
+        try:
+            return os.path.getsize(os.path.join(local_path, issue['component'].split(':')[-1]))
+        except OSError:
+            return None
+
+    # Continue where the last checkpoint left off: after a scan the issue list is fetched
+    # again from the start; after a push, the issues already committed are skipped
+    last = checkpoints.get("last")
+    if last and last["stage"] == "fix_batch":
+        # Runs of older versions checkpointed uncommitted batches, whose fixes the restore dropped
+        last = max((checkpoints[stage] for stage in ("push", "scan") if stage in checkpoints),
+                   key=lambda cp: cp["updated_at"], default=None)
+    start_iteration, skip_issues = 0, 0
+    if last and last["stage"] == "push":
+        start_iteration, skip_issues = last["data"]["iteration"], last["queue_position"] or 0
+    elif last and last["stage"] == "scan":
+        start_iteration = last["data"]["next_iteration"]
+    if issue_view is not None:
+        skip_issues = 0
+    elif PRIORITIZE_ISSUES and skip_issues:
+        # A prioritized queue has no stable order to skip into; leave out the issues
+        # attempted between the last scan and the last push instead
+        locally_resolved.update(db_manager.attempted_issue_ids(checkpoints["scan"]["updated_at"], until=last["updated_at"]))
+        print(f"[Info] Resuming iteration {start_iteration + 1}; skipping {len(locally_resolved)} issues already attempted and committed since the last scan.", flush=True)
+        skip_issues = 0
+    if skip_issues:
+        print(f"[Info] Resuming iteration {start_iteration + 1} after the first {skip_issues} queued issues.", flush=True)
+
+    # Check if there are any new issues in the first 100
+    def has_new_issues(issues, db_manager, limit=100):
+        keys = [issue['key'] for issue in issues[:limit]]
+        return len(db_manager.existing_ids(keys)) < len(keys)
+
+    def fetch_issue_total():
         # Run SonarCloud analysis
-        analysis_results = sonar_analyzer.analyze_repo(project_key)
+        with METRICS.span("fetch_issues", iteration=iteration):
+            analysis_results = sonar_analyzer.analyze_repo(project_key)
         issues = analysis_results.get('issues', [])
 
-        # Check if there are any new issues in the first 100
-        def has_new_issues(issues, db_manager, limit=100):
-            count = 0
-            for issue in issues:
-                if count >= limit:
-                    break
-                if not db_manager.issue_exists(issue['key']):
-                    return True
-                count += 1
-            return False
-
         if not IGNORE_ALREADY_FIXED_ISSUES:
             # If all first 100 issues are already in DB, wait and poll until a new one appears or timeout
             wait_time = 0
@@ -680,137 +3784,207 @@ sonar.exclusions=**/node_modules/**,**/build/**,**/dist/**,**/out/**,**/.scanner
                 issues = analysis_results.get('issues', [])
             if not has_new_issues(issues, db_manager, limit=100):
                 print(f"Timeout waiting for new issues from SonarCloud. Continuing anyway.")
+        return sonar_analyzer.issue_total(analysis_results)
+
+    for iteration in range(start_iteration, MAX_ITERATIONS):
+        # Incremental scans keep the local issue view current, so SonarCloud is not asked again
+        total_issues = issue_view.total() if issue_view is not None else fetch_issue_total()
 
         # If there are no issues at all, or below threshold, stop
-        if len(issues) <= ISSUE_THRESHOLD:
-            print(f"Number of issues ({len(issues)}) is below or equal to the threshold ({ISSUE_THRESHOLD}). Stopping iterations.")
+        if total_issues <= ISSUE_THRESHOLD:
+            print(f"Number of issues ({total_issues}) is below or equal to the threshold ({ISSUE_THRESHOLD}). Stopping iterations.")
             break
 
-        # Process issues and apply fixes in batches, grouping by file
-        BATCH_SIZE = 5  # Reduce batch size for smaller pushes
-        batch_issues = []
-        for issue in issues:
-            if IGNORE_ALREADY_FIXED_ISSUES or not db_manager.issue_exists(issue['key']):
-                batch_issues.append(issue)
-            if len(batch_issues) >= BATCH_SIZE:
-                # Group issues by file
-                file_to_issues = {}
-                for batch_issue in batch_issues:
-                    file_path = os.path.join(local_path, batch_issue['component'].split(':')[-1])
-                    if os.path.exists(file_path):
-                        file_to_issues.setdefault(file_path, []).append(batch_issue)
-                # For each file, apply all fixes in order, with safety check
-                for file_path, issues_for_file in file_to_issues.items():
-                    with open(file_path, "r") as f:
-                        original_content = f.read()
-                    file_content = original_content
-                    for issue in issues_for_file:
-                        file_content = issue_processor.process_issue(issue, file_path)
-                    with open(file_path, "w") as f:
-                        f.write(file_content)
-                    # Check if file was actually changed by git
-                    rel_file_path = os.path.relpath(file_path, local_path)
-                    git_status = subprocess.run(["git", "status", "--porcelain", rel_file_path], cwd=local_path, capture_output=True, text=True)
-                    file_changed = bool(git_status.stdout.strip())
-                    if not file_changed:
-                        print(f"No change detected in {file_path}, skipping build/syntax check.")
-                        continue
-                    # SAFETY CHECK: Build or Syntax
-                    build_success = True
-                    if USE_BUILD_CHECK:
-                        gradle_build_file = os.path.join(local_path, 'build.gradle')
-                        maven_build_file = os.path.join(local_path, 'pom.xml')
-                        gradle_wrapper = os.path.join(local_path, 'gradlew')
-                        maven_wrapper = os.path.join(local_path, 'mvnw')
-                        build_cmd = None
-                        if os.path.exists(gradle_build_file):
-                            if os.path.exists(gradle_wrapper):
-                                build_cmd = ["./gradlew", "build"]
-                            else:
-                                build_cmd = ["gradle", "build"]
-                        elif os.path.exists(maven_build_file):
-                            if os.path.exists(maven_wrapper):
-                                build_cmd = ["./mvnw", "clean", "compile"]
-                            else:
-                                build_cmd = ["mvn", "clean", "compile"]
-                        if build_cmd:
-                            try:
-                                subprocess.run(build_cmd, cwd=local_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                            except subprocess.CalledProcessError as e:
-                                print(f"Build failed after AI fix for {file_path}, reverting changes.")
-                                with open(file_path, "w") as f:
-                                    f.write(original_content)
-                                build_success = False
-                        if not build_success:
-                            print(f"Reverted {file_path} to previous state due to failed build.")
-                    else:
-                        # Syntax check: javac for Java files
-                        if file_path.endswith('.java'):
-                            try:
-                                subprocess.run(["javac", file_path], cwd=local_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                            except subprocess.CalledProcessError as e:
-                                print(f"Syntax check failed after AI fix for {file_path}, reverting changes.")
-                                with open(file_path, "w") as f:
-                                    f.write(original_content)
-                                build_success = False
-                            if not build_success:
-                                print(f"Reverted {file_path} to previous state due to failed syntax check.")
-                github_manager.commit_and_push_changes(local_path, f"Fix batch of {len(batch_issues)} issues")
-                for batch_issue in batch_issues:
-                    db_manager.insert_issue(batch_issue)
-                batch_issues = []
-                # Force SonarCloud analysis by running SonarScanner CLI again
-                print("Forcing SonarCloud analysis by running SonarScanner CLI...")
-                try:
-                    result = subprocess.run(["sonar-scanner"], cwd=local_path, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                    print("[Done] SonarScanner CLI completed.", flush=True)
-                except FileNotFoundError:
-                    print("sonar-scanner CLI not found. Please install SonarScanner CLI and ensure it is in your PATH.")
-                    return
-                except subprocess.CalledProcessError as e:
-                    print(f"SonarScanner CLI failed: {e}")
-                    if e.stderr:
-                        print("[SonarScanner stderr output]:\n" + e.stderr, flush=True)
-                    return
-                # Wait for SonarCloud analysis to complete after push
-                wait_for_sonarcloud_analysis(project_key, sonar_analyzer)
-        # Commit and push any remaining files in the last batch
-        if batch_issues:
-            file_to_issues = {}
-            for batch_issue in batch_issues:
-                file_path = os.path.join(local_path, batch_issue['component'].split(':')[-1])
-                if os.path.exists(file_path):
-                    file_to_issues.setdefault(file_path, []).append(batch_issue)
-            for file_path, issues_for_file in file_to_issues.items():
-                with open(file_path, "r") as f:
-                    file_content = f.read()
-                for issue in issues_for_file:
-                    file_content = issue_processor.process_issue(issue, file_path)
-                with open(file_path, "w") as f:
-                    f.write(file_content)
-            github_manager.commit_and_push_changes(local_path, f"Fix batch of {len(batch_issues)} issues (final batch)")
-            for batch_issue in batch_issues:
-                db_manager.insert_issue(batch_issue)
-            # Force SonarCloud analysis by running SonarScanner CLI again
-            print("Forcing SonarCloud analysis by running SonarScanner CLI...")
-            try:
-                result = subprocess.run(["sonar-scanner"], cwd=local_path, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                print("[Done] SonarScanner CLI completed.", flush=True)
-            except FileNotFoundError:
-                print("sonar-scanner CLI not found. Please install SonarScanner CLI and ensure it is in your PATH.")
-                return
-            except subprocess.CalledProcessError as e:
-                print(f"SonarScanner CLI failed: {e}")
-                if e.stderr:
-                    print("[SonarScanner stderr output]:\n" + e.stderr, flush=True)
-                return
-            # Wait for SonarCloud analysis to complete after final push
-            wait_for_sonarcloud_analysis(project_key, sonar_analyzer)
+        if issue_view is not None:
+            queue_position = 0
+            issues = counted(issue_view.iter_issues())
+        else:
+            # Stream every page of issues so fixing starts while later pages download;
+            # slice by rule when the project has more issues than one search can return
+            slice_by = "rules" if total_issues > sonar_analyzer.MAX_RESULTS else None
+            issues = sonar_analyzer.iter_issues(project_key, slice_by=slice_by)
+            queue_position = skip_issues
+            issues = counted(itertools.islice(issues, skip_issues, None))
+            skip_issues = 0
+        if PRIORITIZE_ISSUES:
+            # Success rates are read again every iteration, so this run's outcomes count too
+            prioritizer = IssuePrioritizer(prompt_planner, db_manager.fix_success_by_rule(), issue_file_size, probes=rule_probes)
+            issues = prioritizer.prioritize(issues)
 
+        # Fix issues from the queue in batches; commits and scans are scheduled separately
+        pending_issues = (
+            issue for issue in issues
+            if issue['key'] not in locally_resolved and issue['key'] not in dead_lettered and (IGNORE_ALREADY_FIXED_ISSUES or not db_manager.issue_exists(issue['key']))
+        )
+        if not scheduler.run(pending_issues):
+            return None
+        if PRIORITIZE_ISSUES and prioritizer.skipped:
+            skipped_rules = ", ".join(f"{rule} ({count})" for rule, count in prioritizer.skipped.most_common(5))
+            print(f"[Info] Skipped {sum(prioritizer.skipped.values())} issues of rules that rarely get a passing fix: {skipped_rules}", flush=True)
+            METRICS.count("issues_skipped_low_success", sum(prioritizer.skipped.values()))
+
+    checkpoint("done", status="done")
     print(f"Process completed. New repository URL: {forked_clone_url}")
+    print(f"Fix cache: {fix_cache.stats()}")
+    print(f"Model usage: {prompt_planner.summary()}")
     # Export issues to CSV at the end
-    db_manager.export_issues_to_csv("issues_export.csv")
+    with METRICS.span("export"):
+        db_manager.export_issues_to_csv(export_path)
+    db_manager.close()
+    fix_cache.close()
+    if analysis_webhook is not None:
+        analysis_webhook.stop()
+    return forked_clone_url
+
+
+def main():
+    GITHUB_TOKEN = get_env_or_prompt("GITHUB_TOKEN", "Enter your GitHub token")
+    SONAR_TOKEN = get_env_or_prompt("SONAR_TOKEN", "Enter your SonarQube token")
+    ANTHROPIC_API_KEY = get_env_or_prompt("ANTHROPIC_API_KEY", "Enter your Anthropic API key")
+    LOCAL_DIR = os.environ['TMPDIR'] + "CQE"
+    REPO_URL =  input("Enter the GitHub repository URL: ")
+    run_pipeline(REPO_URL, GITHUB_TOKEN, SONAR_TOKEN, ANTHROPIC_API_KEY, LOCAL_DIR, db_path="issues.db", export_path="issues_export.csv")
+
+
+
+def init_worker(scan_slots, model_slots, worker_count):
+    """Process pool initializer: install the limits shared by all workers and take the next worker index."""
+    global SCAN_SLOTS, MODEL_SLOTS, WORKER_INDEX
+    SCAN_SLOTS = scan_slots
+    MODEL_SLOTS = model_slots
+    with worker_count.get_lock():
+        WORKER_INDEX = worker_count.value
+        worker_count.value += 1
+
+
+def repo_slug(repo_url):
+    """owner__repo name used for the per-repository work directory, database and log."""
+    path = urlparse(repo_url).path.strip("/")
+    if path.endswith(".git"):
+        path = path[:-4]
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", path.replace("/", "__"))
+
+
+@contextlib.contextmanager
+def redirect_output(log_path):
+    """
+    Send this process's stdout and stderr to a log file. The file descriptors are
+    redirected, so output of child processes (git, builds, sonar-scanner) goes there too.
+    """
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    with open(log_path, "a", buffering=1) as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+def run_repository(repo_url, github_token, sonar_token, anthropic_api_key, work_dir, resume=True):
+    """
+    Worker entry point: run the pipeline for one repository in its own local directory,
+    database partition and log file. Returns a summary dict for the parent process.
+    """
+    slug = repo_slug(repo_url)
+    local_dir = os.path.join(work_dir, "repos", slug)
+    db_dir = os.path.join(work_dir, "db")
+    log_path = os.path.join(work_dir, "logs", f"{slug}.log")
+    os.makedirs(local_dir, exist_ok=True)
+    os.makedirs(db_dir, exist_ok=True)
+    result = {"repo": repo_url, "status": "failed", "fork_url": None, "error": None, "log": log_path}
+    start = time.monotonic()
+    with redirect_output(log_path):
+        try:
+            result["fork_url"] = run_pipeline(
+                repo_url, github_token, sonar_token, anthropic_api_key, local_dir,
+                db_path=os.path.join(db_dir, f"{slug}.db"),
+                export_path=os.path.join(db_dir, f"{slug}_export.csv"),
+                resume=resume
+            )
+            result["status"] = "done" if result["fork_url"] else "stopped"
+        except Exception as e:
+            print(f"[Error] Pipeline failed for {repo_url}: {e}", flush=True)
+            result["error"] = str(e)
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def read_repo_list(path):
+    """Read repository URLs, one per line. Blank lines and # comments are ignored."""
+    with open(path, encoding="utf-8") as f:
+        lines = (line.split("#", 1)[0].strip() for line in f)
+        return [line for line in lines if line]
+
+
+def run_repositories(repo_urls, github_token, sonar_token, anthropic_api_key, work_dir, workers=None, max_scans=2, max_model_calls=8, resume=True):
+    """
+    Run the pipeline for many repositories in a process pool. The number of SonarScanner
+    runs and model calls in flight is limited across all workers.
+    """
+    scan_slots = multiprocessing.BoundedSemaphore(max_scans)
+    model_slots = multiprocessing.BoundedSemaphore(max_model_calls)
+    worker_count = multiprocessing.Value("i", 0)
+    results = []
+    print(f"[Stage] Processing {len(repo_urls)} repositories with {workers or os.cpu_count()} workers (logs in {os.path.join(work_dir, 'logs')})", flush=True)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(scan_slots, model_slots, worker_count)) as pool:
+        futures = {
+            pool.submit(run_repository, url, github_token, sonar_token, anthropic_api_key, work_dir, resume): url
+            for url in repo_urls
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"repo": futures[future], "status": "failed", "fork_url": None, "error": str(e), "log": None, "seconds": 0.0}
+            results.append(result)
+            if result["status"] == "failed":
+                print(f"[Error] {result['repo']}: failed after {result['seconds']:.0f}s: {result['error']} (log: {result['log']})", flush=True)
+            else:
+                print(f"[Done] {result['repo']}: {result['status']} in {result['seconds']:.0f}s -> {result['fork_url']} (log: {result['log']})", flush=True)
+    failed = sum(1 for r in results if r["status"] == "failed")
+    print(f"[Done] {len(results) - failed}/{len(results)} repositories processed without errors.", flush=True)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fix SonarCloud issues in GitHub repositories with Claude.")
+    subparsers = parser.add_subparsers(dest="command")
+    run = subparsers.add_parser("run", help="Process many repositories in parallel")
+    run.add_argument("--repos", required=True, help="File with one GitHub repository URL per line")
+    run.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    run.add_argument("--max-scans", type=int, default=2, help="Maximum concurrent SonarScanner runs across all workers")
+    run.add_argument("--max-model-calls", type=int, default=8, help="Maximum concurrent model calls across all workers")
+    run.add_argument("--fresh", action="store_true", help="Ignore checkpoints of interrupted runs and start every repository from scratch")
+    run.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "CQE"), help="Directory for clones, databases and logs")
+    return parser.parse_args(argv)
+
+
+def run_command(args):
+    GITHUB_TOKEN = get_env_or_prompt("GITHUB_TOKEN", "Enter your GitHub token")
+    SONAR_TOKEN = get_env_or_prompt("SONAR_TOKEN", "Enter your SonarQube token")
+    ANTHROPIC_API_KEY = get_env_or_prompt("ANTHROPIC_API_KEY", "Enter your Anthropic API key")
+    repo_urls = read_repo_list(args.repos)
+    if not repo_urls:
+        print(f"[Error] No repositories listed in {args.repos}", flush=True)
+        return 1
+    results = run_repositories(
+        repo_urls, GITHUB_TOKEN, SONAR_TOKEN, ANTHROPIC_API_KEY, os.path.abspath(args.work_dir),
+        workers=args.workers, max_scans=args.max_scans, max_model_calls=args.max_model_calls, resume=not args.fresh
+    )
+    return 1 if any(r["status"] == "failed" for r in results) else 0
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.command == "run":
+        sys.exit(run_command(args))
+    main()
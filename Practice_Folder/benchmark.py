@@ -0,0 +1,690 @@
+"""
+Offline end-to-end benchmark for CQE.py.
+
+Runs CQE.py's main() in a subprocess against local stand-ins for the GitHub API,
+SonarCloud and the Anthropic Messages API, with a fake sonar-scanner and javac on
+PATH and a generated Java repository, then reports issues fixed per minute, model
+calls per issue and peak RSS. The pipeline code itself runs unchanged; only its
+endpoints are redirected (GITHUB_API_URL, SONAR_HOST_URL, ANTHROPIC_BASE_URL).
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+CQE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CQE.py")
+BENCH_OWNER = "bench"
+BENCH_REPO = "synthetic-java"
+TODO_MARKER = "TODO bench"
+
+
+class StubBehaviour:
+    """
+    Latency, rate limiting and failure injection shared by the stub servers.
+    Args:
+        latency (float): Seconds added to every request.
+        failure_rate (float): Fraction of requests answered with failure_status.
+        failure_status (int): Status code of injected failures.
+        rate_limit (float, optional): Requests per second; requests over the limit get
+            a 429 with a retry-after header.
+        seed (int): Seed for the failure injection, so runs are reproducible.
+    """
+    def __init__(self, latency=0.0, failure_rate=0.0, failure_status=500, rate_limit=None, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def admit(self):
+        """
+        Count a request and decide how to answer it. Returns None to serve it normally,
+        or (status, headers) for an injected rate limit or failure.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit:
+                now = time.monotonic()
+                if now - self.window_start >= 1.0:
+                    self.window_start, self.window_count = now, 0
+                self.window_count += 1
+                if self.window_count > self.rate_limit:
+                    self.throttled += 1
+                    return 429, {"retry-after": "1"}
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                self.failed += 1
+                return self.failure_status, {}
+        return None
+
+    def stats(self):
+        return {"requests": self.requests, "throttled": self.throttled, "failed": self.failed}
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Base class of the stand-in servers: routes (method, path) to handler methods and
+    applies the StubBehaviour to every request. Subclasses define ROUTES, mapping
+    (method, path prefix) to the name of a method taking (path, query, body) and returning
+    (status, json_payload), or (status, body_text, content_type) for other content.
+    """
+    daemon_threads = True
+    ROUTES = {}
+
+    def __init__(self, behaviour=None):
+        self.behaviour = behaviour or StubBehaviour()
+        self.thread = None
+        super().__init__(("127.0.0.1", 0), StubRequestHandler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def route(self, method, path):
+        for (route_method, prefix), name in self.ROUTES.items():
+            if route_method == method and path.startswith(prefix):
+                return getattr(self, name)
+        return None
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        parsed = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        if raw_body and "json" in (self.headers.get("Content-Type") or ""):
+            body = json.loads(raw_body)
+        else:
+            body = {key: values[-1] for key, values in parse_qs(raw_body.decode()).items()}
+        handler = self.server.route(method, parsed.path)
+        if handler is None:
+            self.respond(404, {"error": f"no stub for {method} {parsed.path}"})
+            return
+        injected = self.server.behaviour.admit()
+        if injected is not None:
+            status, headers = injected
+            self.respond(status, {"type": "error", "error": {"type": "injected_failure", "message": f"injected {status}"}}, headers=headers)
+            return
+        self.respond(*handler(parsed.path, query, body))
+
+    def respond(self, status, payload, content_type=None, headers=None):
+        if content_type is None:
+            data, content_type = json.dumps(payload).encode(), "application/json"
+        else:
+            data = payload.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GitHubStub(StubServer):
+    """
+    Stand-in for the GitHub REST API. A fork is a bare clone of the upstream repository
+    in forks_dir; its clone_url is a file:// URL, so clones and pushes stay local.
+    """
+    ROUTES = {("POST", "/repos/"): "fork"}
+
+    def __init__(self, upstream_dir, forks_dir, behaviour=None):
+        super().__init__(behaviour)
+        self.upstream_dir = upstream_dir
+        self.forks_dir = forks_dir
+
+    def fork(self, path, query, body):
+        parts = path.strip("/").split("/")
+        if len(parts) != 4 or parts[3] != "forks":
+            return 404, {"message": "Not Found"}
+        fork_path = os.path.join(self.forks_dir, f"{parts[2]}.git")
+        if not os.path.exists(fork_path):
+            subprocess.run(["git", "clone", "-q", "--bare", self.upstream_dir, fork_path], check=True)
+        return 202, {"full_name": f"{BENCH_OWNER}-fork/{parts[2]}", "clone_url": f"file://{fork_path}"}
+
+
+class SonarStub(StubServer):
+    """
+    Stand-in for the SonarCloud Web API. The fake scanner posts the checkout it analyzed
+    to /bench/scan; every TODO_MARKER comment in a .java file is then an open java:S1135
+    issue, published analysis_delay seconds later when the Compute Engine task finishes.
+    Branch analyses (sonar.branch.name) are kept apart from the main branch and, like
+    sonar.inclusions, only cover the files they analyzed. Paging follows
+    api/issues/search: ps is capped at 500 and results at 10000.
+    """
+    ROUTES = {
+        ("POST", "/api/projects/create"): "create_project",
+        ("GET", "/api/issues/search"): "search_issues",
+        ("GET", "/api/ce/task"): "ce_task",
+        ("GET", "/api/ce/component"): "ce_component",
+        ("POST", "/bench/scan"): "scan",
+    }
+    MAX_PAGE_SIZE = 500
+    MAX_RESULTS = 10000
+
+    def __init__(self, analysis_delay=1.0, behaviour=None):
+        super().__init__(behaviour)
+        self.analysis_delay = analysis_delay
+        self.lock = threading.Lock()
+        self.projects = set()
+        self.issues = {}
+        self.tasks = {}
+        self.initial_issues = None
+        self.scans = 0
+
+    def settle(self):
+        # Publish the results of analyses whose Compute Engine task has finished
+        now = time.monotonic()
+        with self.lock:
+            for task in self.tasks.values():
+                if task["status"] == "IN_PROGRESS" and now >= task["ready_at"]:
+                    task["status"] = "SUCCESS"
+                    self.issues[(task["project"], task["branch"])] = task["issues"]
+                    if self.initial_issues is None:
+                        self.initial_issues = len(task["issues"])
+
+    def create_project(self, path, query, body):
+        key = body.get("project")
+        with self.lock:
+            if key in self.projects:
+                return 400, {"errors": [{"msg": f"Could not create Project, key already exists: {key}"}]}
+            self.projects.add(key)
+        return 200, {"project": {"key": key, "name": body.get("name"), "visibility": body.get("visibility")}}
+
+    def scan(self, path, query, body):
+        project, root, branch = body["project"], body["path"], body.get("branch") or None
+        inclusions = set(body["inclusions"].split(",")) if body.get("inclusions") else None
+        issues = []
+        analyzed = 0
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+            for filename in sorted(filenames):
+                file_path = os.path.join(directory, filename)
+                relative = os.path.relpath(file_path, root).replace(os.sep, "/")
+                if not filename.endswith(".java") or (inclusions is not None and relative not in inclusions):
+                    continue
+                analyzed += 1
+                with open(file_path, encoding="utf-8") as f:
+                    for number, line in enumerate(f, start=1):
+                        if TODO_MARKER in line:
+                            issues.append({
+                                "key": f"BENCH-{relative}-{number}",
+                                "rule": "java:S1135",
+                                "severity": "INFO",
+                                "component": f"{project}:{relative}",
+                                "project": project,
+                                "line": number,
+                                "textRange": {"startLine": number, "endLine": number, "startOffset": 0, "endOffset": len(line.rstrip())},
+                                "message": "Complete the task associated to this \"TODO\" comment.",
+                                "type": "CODE_SMELL",
+                                "status": "OPEN",
+                                "tags": ["cwe"],
+                                "impacts": [{"softwareQuality": "MAINTAINABILITY", "severity": "LOW"}],
+                            })
+        with self.lock:
+            self.scans += 1
+            task_id = f"AX-task-{self.scans}"
+            self.tasks[task_id] = {"project": project, "branch": branch, "issues": issues, "status": "IN_PROGRESS",
+                                   "ready_at": time.monotonic() + self.analysis_delay}
+        return 200, {"taskId": task_id, "files": analyzed}
+
+    def search_issues(self, path, query, body):
+        self.settle()
+        page = int(query.get("p", 1))
+        page_size = min(int(query.get("ps", 100)), self.MAX_PAGE_SIZE)
+        if (page - 1) * page_size >= self.MAX_RESULTS:
+            return 400, {"errors": [{"msg": f"Can return only the first {self.MAX_RESULTS} results."}]}
+        with self.lock:
+            issues = list(self.issues.get((query.get("componentKeys"), query.get("branch") or None), []))
+        if query.get("rules"):
+            issues = [issue for issue in issues if issue["rule"] in query["rules"].split(",")]
+        payload = {
+            "total": len(issues),
+            "paging": {"pageIndex": page, "pageSize": page_size, "total": len(issues)},
+            "issues": issues[(page - 1) * page_size:page * page_size],
+        }
+        if query.get("facets") == "rules":
+            counts = {}
+            for issue in issues:
+                counts[issue["rule"]] = counts.get(issue["rule"], 0) + 1
+            payload["facets"] = [{"property": "rules", "values": [{"val": rule, "count": count} for rule, count in counts.items()]}]
+        return 200, payload
+
+    def ce_task(self, path, query, body):
+        self.settle()
+        task = self.tasks.get(query.get("id"))
+        if task is None:
+            return 404, {"errors": [{"msg": "No activity found"}]}
+        return 200, {"task": {"id": query["id"], "status": task["status"]}}
+
+    def ce_component(self, path, query, body):
+        self.settle()
+        with self.lock:
+            tasks = [task for task in self.tasks.values() if task["project"] == query.get("component")]
+        queue = [{"status": "IN_PROGRESS"}] if any(task["status"] == "IN_PROGRESS" for task in tasks) else []
+        return 200, {"queue": queue, "current": {"status": "SUCCESS"} if tasks and not queue else {}}
+
+
+class ModelStub(StubServer):
+    """
+    Stand-in for the Anthropic Messages API. It "fixes" the code in the prompt by
+    rewriting every TODO_MARKER comment, keeping the line count, and answers with the
+    code in a fenced block. Usage is estimated at four characters per token and
+    output_latency is added per 1000 output tokens.
+    Message Batches are supported too: a batch ends batch_delay seconds after it is
+    created, its requests fail at the behaviour's failure_rate (as errored results),
+    and results are served as JSONL from the batch's results_url.
+    """
+    # Batch routes first: routes match by prefix
+    ROUTES = {
+        ("POST", "/v1/messages/batches"): "batch_post",
+        ("GET", "/v1/messages/batches/"): "batch_get",
+        ("POST", "/v1/messages"): "create_message",
+    }
+
+    def __init__(self, output_latency=0.0, batch_delay=1.0, behaviour=None):
+        super().__init__(behaviour)
+        self.output_latency = output_latency
+        self.batch_delay = batch_delay
+        self.lock = threading.Lock()
+        self.calls = 0
+        # Separate from self.lock, which answer() takes to count calls
+        self.batch_lock = threading.Lock()
+        self.batches = {}
+        self.batched = 0
+
+    def create_message(self, path, query, body):
+        return 200, self.answer(body)
+
+    def answer(self, body):
+        content = body["messages"][-1]["content"]
+        if isinstance(content, list):
+            content = "".join(block.get("text", "") for block in content)
+        # The prompts put the code after the first blank line
+        code = content.split("\n\n", 1)[1] if "\n\n" in content else content
+        fixed = code.replace(TODO_MARKER, "Done bench")
+        output_tokens = len(fixed) // 4 + 10
+        if self.output_latency:
+            time.sleep(self.output_latency * output_tokens / 1000)
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        return {
+            "id": f"msg_bench_{call}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model"),
+            "content": [{"type": "text", "text": f"```java\n{fixed}\n```"}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": len(content) // 4 + 1, "output_tokens": output_tokens},
+        }
+
+    def batch_post(self, path, query, body):
+        if path.rstrip("/") == "/v1/messages/batches":
+            return self.create_batch(body)
+        if path.endswith("/cancel"):
+            return self.cancel_batch(path.split("/")[-2])
+        return 404, {"type": "error", "error": {"type": "not_found_error", "message": path}}
+
+    def batch_get(self, path, query, body):
+        parts = path.rstrip("/").split("/")
+        if parts[-1] == "results":
+            return self.batch_results(parts[-2])
+        return self.retrieve_batch(parts[-1])
+
+    def create_batch(self, body):
+        with self.batch_lock:
+            batch_id = f"msgbatch_bench_{len(self.batches) + 1}"
+            self.batches[batch_id] = {"requests": body["requests"], "ready_at": time.monotonic() + self.batch_delay,
+                                      "created_at": time.time(), "results": None, "canceled": False}
+            self.batched += len(body["requests"])
+        return 200, self.batch_object(batch_id)
+
+    def retrieve_batch(self, batch_id):
+        if batch_id not in self.batches:
+            return 404, {"type": "error", "error": {"type": "not_found_error", "message": f"no batch {batch_id}"}}
+        return 200, self.batch_object(batch_id)
+
+    def cancel_batch(self, batch_id):
+        if batch_id not in self.batches:
+            return 404, {"type": "error", "error": {"type": "not_found_error", "message": f"no batch {batch_id}"}}
+        with self.batch_lock:
+            self.batches[batch_id]["canceled"] = True
+        return 200, self.batch_object(batch_id)
+
+    def batch_results(self, batch_id):
+        batch = self.batches.get(batch_id)
+        if batch is None or batch["results"] is None:
+            return 404, {"type": "error", "error": {"type": "not_found_error", "message": f"no results for {batch_id}"}}
+        return 200, "".join(json.dumps(result) + "\n" for result in batch["results"]), "application/binary"
+
+    def settle_batch(self, batch):
+        # Answer every request once the batch is due; called with batch_lock held
+        if batch["results"] is not None or (time.monotonic() < batch["ready_at"] and not batch["canceled"]):
+            return
+        results = []
+        for request in batch["requests"]:
+            if batch["canceled"]:
+                result = {"type": "canceled"}
+            elif self.behaviour.failure_rate and self.behaviour.random.random() < self.behaviour.failure_rate:
+                result = {"type": "errored", "error": {"type": "error", "error": {"type": "overloaded_error", "message": "injected failure"}}}
+            else:
+                result = {"type": "succeeded", "message": self.answer(request["params"])}
+            results.append({"custom_id": request["custom_id"], "result": result})
+        batch["results"] = results
+        batch["ended_at"] = time.time()
+
+    def batch_object(self, batch_id):
+        with self.batch_lock:
+            batch = self.batches[batch_id]
+            self.settle_batch(batch)
+            results = batch["results"]
+            counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+            if results is None:
+                counts["processing"] = len(batch["requests"])
+            else:
+                for result in results:
+                    counts[result["result"]["type"]] += 1
+            ended_at = batch.get("ended_at")
+        iso = lambda timestamp: time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp)) if timestamp else None
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if results is not None else ("canceling" if batch["canceled"] else "in_progress"),
+            "request_counts": counts,
+            "created_at": iso(batch["created_at"]),
+            "expires_at": iso(batch["created_at"] + 86400),
+            "ended_at": iso(ended_at),
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": f"{self.url}/v1/messages/batches/{batch_id}/results" if results is not None else None,
+        }
+
+
+FAKE_SCANNER = '''#!{python}
+"""Fake sonar-scanner: posts the checkout to the Sonar stub and writes report-task.txt."""
+import os, sys, time, json, urllib.parse, urllib.request
+properties = {{}}
+with open("sonar-project.properties") as f:
+    for line in f:
+        if "=" in line:
+            key, value = line.strip().split("=", 1)
+            properties[key] = value
+data = urllib.parse.urlencode({{"project": properties["sonar.projectKey"], "path": os.getcwd(),
+                               "branch": properties.get("sonar.branch.name", ""),
+                               "inclusions": properties.get("sonar.inclusions", "")}}).encode()
+with urllib.request.urlopen(properties["sonar.host.url"] + "/bench/scan", data=data) as response:
+    result = json.load(response)
+# Scanning takes a fixed startup time plus time per analyzed file
+time.sleep({scan_time} + {scan_time_per_file} * result["files"])
+task_id = result["taskId"]
+os.makedirs(".scannerwork", exist_ok=True)
+with open(os.path.join(".scannerwork", "report-task.txt"), "w") as f:
+    f.write(f"projectKey={{properties['sonar.projectKey']}}\\nserverUrl={{properties['sonar.host.url']}}\\nceTaskId={{task_id}}\\n")
+'''
+
+FAKE_JAVAC = '''#!{python}
+"""Fake javac: takes compile_time seconds and accepts every file."""
+import time
+time.sleep({compile_time})
+'''
+
+
+def write_tool(bin_dir, name, source):
+    path = os.path.join(bin_dir, name)
+    with open(path, "w") as f:
+        f.write(source)
+    os.chmod(path, 0o755)
+    return path
+
+
+def generate_java_repo(repo_dir, files, issues_per_file, file_lines, seed=0):
+    """
+    Create a git repository of `files` Java classes of about `file_lines` lines, each
+    with `issues_per_file` TODO_MARKER comments spread over its methods. Returns the
+    number of issues generated.
+    """
+    rng = random.Random(seed)
+    methods = max(issues_per_file, max(1, file_lines // 12))
+    for number in range(files):
+        package = f"bench.module{number % 10}"
+        package_dir = os.path.join(repo_dir, "src", "main", "java", *package.split("."))
+        os.makedirs(package_dir, exist_ok=True)
+        todo_methods = set(rng.sample(range(methods), issues_per_file))
+        lines = [f"package {package};", "", f"public class Class{number} {{", f"    private int state = {number};", ""]
+        for method in range(methods):
+            lines.append(f"    public int compute{method}(int value) {{")
+            if method in todo_methods:
+                lines.append(f"        // {TODO_MARKER}: handle negative values in compute{method}")
+            lines += [
+                f"        int result = value * {rng.randint(2, 97)} + state;",
+                f"        if (result > {rng.randint(100, 10000)}) {{",
+                f"            result -= {rng.randint(1, 50)};",
+                "        }",
+                "        for (int i = 0; i < 3; i++) {",
+                "            result += i;",
+                "        }",
+                "        state = result % 1000;",
+                "        return result;",
+                "    }",
+                "",
+            ]
+        lines.append("}")
+        with open(os.path.join(package_dir, f"Class{number}.java"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+    with open(os.path.join(repo_dir, "README.md"), "w") as f:
+        f.write(f"Synthetic benchmark repository: {files} files, {issues_per_file} issues per file.\n")
+    env = dict(os.environ, **git_identity())
+    subprocess.run(["git", "init", "-q", "-b", "main", repo_dir], check=True)
+    subprocess.run(["git", "add", "-A"], cwd=repo_dir, check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "Synthetic benchmark repository"], cwd=repo_dir, check=True, env=env)
+    return files * issues_per_file
+
+
+def git_identity():
+    return {"GIT_AUTHOR_NAME": "CQE Benchmark", "GIT_AUTHOR_EMAIL": "bench@example.com",
+            "GIT_COMMITTER_NAME": "CQE Benchmark", "GIT_COMMITTER_EMAIL": "bench@example.com"}
+
+
+def count_markers(git_dir):
+    """Count the TODO_MARKER comments left in the HEAD commit of a (bare) repository."""
+    if not os.path.exists(git_dir):
+        return 0
+    result = subprocess.run(["git", "--git-dir", git_dir, "grep", "-c", TODO_MARKER, "HEAD"], capture_output=True, text=True)
+    return sum(int(line.rsplit(":", 1)[1]) for line in result.stdout.splitlines() if ":" in line)
+
+
+def read_counters(metrics_path):
+    """Return the *_total counters of an OpenMetrics file written by the pipeline."""
+    counters = {}
+    if not os.path.exists(metrics_path):
+        return counters
+    with open(metrics_path) as f:
+        for line in f:
+            if line.startswith("cqe_") and "_total" in line:
+                name, value = line.rsplit(" ", 1)
+                counters[name.split("{")[0][len("cqe_"):-len("_total")]] = float(value)
+    return counters
+
+
+def run_benchmark(args):
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="cqe-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    upstream_dir = os.path.join(work_dir, "upstream")
+    forks_dir = os.path.join(work_dir, "forks")
+    bin_dir = os.path.join(work_dir, "bin")
+    run_dir = os.path.join(work_dir, "run")
+    for path in (upstream_dir, forks_dir, bin_dir, run_dir):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+    print(f"[Stage] Generating {args.files} Java files with {args.issues_per_file} issues each in {upstream_dir}", flush=True)
+    issues_generated = generate_java_repo(upstream_dir, args.files, args.issues_per_file, args.file_lines, seed=args.seed)
+    write_tool(bin_dir, "sonar-scanner", FAKE_SCANNER.format(python=sys.executable, scan_time=args.scan_time,
+                                                                scan_time_per_file=args.scan_time_per_file))
+    write_tool(bin_dir, "javac", FAKE_JAVAC.format(python=sys.executable, compile_time=args.compile_time))
+
+    github = GitHubStub(upstream_dir, forks_dir, StubBehaviour(latency=args.github_latency, seed=args.seed)).start()
+    sonar = SonarStub(analysis_delay=args.analysis_delay,
+                      behaviour=StubBehaviour(latency=args.sonar_latency, failure_rate=args.sonar_failure_rate,
+                                              failure_status=503, rate_limit=args.sonar_rate_limit, seed=args.seed)).start()
+    model = ModelStub(output_latency=args.model_output_latency, batch_delay=args.batch_delay,
+                      behaviour=StubBehaviour(latency=args.model_latency, failure_rate=args.model_failure_rate,
+                                              failure_status=529, rate_limit=args.model_rate_limit, seed=args.seed)).start()
+    env = dict(os.environ, **git_identity())
+    env.update({
+        "GITHUB_TOKEN": "bench-github-token",
+        "SONAR_TOKEN": "bench-sonar-token",
+        "ANTHROPIC_API_KEY": "bench-anthropic-key",
+        "GITHUB_API_URL": github.url,
+        "SONAR_HOST_URL": sonar.url,
+        "ANTHROPIC_BASE_URL": model.url,
+        "CQE_FIX_BACKEND": args.fix_backend,
+        "PATH": bin_dir + os.pathsep + env.get("PATH", ""),
+        # main() clones into $TMPDIR + "CQE"
+        "TMPDIR": run_dir + os.sep,
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.pop("SONAR_WEBHOOK_URL", None)
+
+    print(f"[Stage] Running CQE.py against the stubs (log: {os.path.join(run_dir, 'cqe.log')}) ...", flush=True)
+    t0 = time.monotonic()
+    with open(os.path.join(run_dir, "cqe.log"), "w") as log:
+        try:
+            result = subprocess.run([sys.executable, CQE_PATH], cwd=run_dir, env=env, timeout=args.timeout,
+                                    input=f"https://github.com/{BENCH_OWNER}/{BENCH_REPO}\n", text=True,
+                                    stdout=log, stderr=subprocess.STDOUT)
+            returncode = result.returncode
+        except subprocess.TimeoutExpired:
+            print(f"[Error] CQE.py did not finish within {args.timeout} seconds.", flush=True)
+            returncode = None
+    elapsed = time.monotonic() - t0
+    # ru_maxrss is the peak of the largest waited-for child, in kilobytes on Linux
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss_kb //= 1024
+
+    # What counts is what was pushed: the issues left in the fork's code
+    remaining = count_markers(os.path.join(forks_dir, f"{BENCH_REPO}.git"))
+    initial = sonar.initial_issues or 0
+    fixed = initial - remaining
+    counters = read_counters(os.path.join(run_dir, "issues_export_metrics.txt"))
+    # A batched request is one model call; submitting and polling the batch are not
+    model_calls = model.batched if args.fix_backend == "batch" else model.behaviour.requests
+    report = {
+        "files": args.files,
+        "issues_generated": issues_generated,
+        "issues_initial": initial,
+        "issues_remaining": remaining,
+        "issues_fixed": fixed,
+        "elapsed_seconds": round(elapsed, 2),
+        "issues_fixed_per_minute": round(fixed / (elapsed / 60), 2) if elapsed else 0.0,
+        "fix_backend": args.fix_backend,
+        "model_calls": model_calls,
+        "model_calls_per_issue": round(model_calls / fixed, 3) if fixed else None,
+        "model_batches": len(model.batches),
+        "model_successful_calls": model.calls,
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+        "scans": sonar.scans,
+        "returncode": returncode,
+        "stubs": {"github": github.behaviour.stats(), "sonar": sonar.behaviour.stats(), "model": model.behaviour.stats()},
+        "pipeline_counters": counters,
+        "work_dir": work_dir,
+    }
+    for server in (github, sonar, model):
+        server.stop()
+    if not args.keep and not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        report["work_dir"] = None
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark CQE.py offline against local GitHub, SonarCloud and model API stubs.")
+    repo = parser.add_argument_group("synthetic repository")
+    repo.add_argument("--files", type=int, default=20, help="Java files to generate")
+    repo.add_argument("--issues-per-file", type=int, default=3, help="issues (TODO comments) per file")
+    repo.add_argument("--file-lines", type=int, default=120, help="approximate lines per file")
+    stubs = parser.add_argument_group("stub behaviour")
+    stubs.add_argument("--github-latency", type=float, default=0.0, help="seconds per GitHub API request")
+    stubs.add_argument("--sonar-latency", type=float, default=0.0, help="seconds per SonarCloud API request")
+    stubs.add_argument("--sonar-rate-limit", type=float, default=None, help="SonarCloud requests per second before 429s")
+    stubs.add_argument("--sonar-failure-rate", type=float, default=0.0, help="fraction of SonarCloud requests failing with 503")
+    stubs.add_argument("--analysis-delay", type=float, default=1.0, help="seconds until a scanner run's analysis is published")
+    stubs.add_argument("--model-latency", type=float, default=0.2, help="seconds per model request")
+    stubs.add_argument("--model-output-latency", type=float, default=0.0, help="extra seconds per 1000 output tokens")
+    stubs.add_argument("--model-rate-limit", type=float, default=None, help="model requests per second before 429s")
+    stubs.add_argument("--model-failure-rate", type=float, default=0.0, help="fraction of model requests failing with 529")
+    stubs.add_argument("--batch-delay", type=float, default=1.0, help="seconds until a message batch has ended")
+    stubs.add_argument("--scan-time", type=float, default=0.5, help="seconds the fake sonar-scanner takes to start")
+    stubs.add_argument("--scan-time-per-file", type=float, default=0.01, help="seconds the fake sonar-scanner takes per analyzed file")
+    stubs.add_argument("--compile-time", type=float, default=0.1, help="seconds the fake javac takes")
+    parser.add_argument("--fix-backend", choices=("interactive", "batch"), default="interactive",
+                        help="model backend of the pipeline: one call per request, or Message Batches")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the generated code and failure injection")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds before the run is aborted")
+    parser.add_argument("--work-dir", help="directory for the repositories and run outputs (kept; default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary work directory")
+    parser.add_argument("--json", help="also write the report to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run_benchmark(args)
+    print("\n[Done] Benchmark results", flush=True)
+    print(f"  Issues fixed:          {report['issues_fixed']} of {report['issues_initial']} in {report['elapsed_seconds']}s", flush=True)
+    print(f"  Issues fixed/minute:   {report['issues_fixed_per_minute']}", flush=True)
+    print(f"  Model calls/issue:     {report['model_calls_per_issue']} ({report['model_calls']} calls, {report['fix_backend']})", flush=True)
+    print(f"  Peak RSS:              {report['peak_rss_mb']} MB", flush=True)
+    print(f"  Scanner runs:          {report['scans']}", flush=True)
+    if report["returncode"] != 0:
+        print(f"[Error] CQE.py exited with {report['returncode']}; see cqe.log in the work directory (use --keep).", flush=True)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[Info] Wrote {args.json}", flush=True)
+    return 0 if report["returncode"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())